@@ -0,0 +1,91 @@
+"""
+Measures the memory per observation of fhir_objects.Observation and of the compact
+fhir_objects.compact.CompactObservation: before their values are read, after the
+ObservationFeatureEngine read them and after they were read as attributes.
+
+    python benchmarks/compact_memory.py [number of observations]
+"""
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from fhir_objects.compact import CompactObservation, peek
+from fhir_objects.observation import Observation
+from fhir_objects.observation_index import get_coding_key
+
+# How the values used by the observation processors are read
+READS = {None: 'values not read:',
+         'engine': 'values read by the engine:',
+         'attributes': 'values read as attributes:'}
+
+
+def observation_json(i: int):
+    """
+    Returns:
+        str: The json of a vital sign observation like those of https://r3.smarthealthit.org
+    """
+    return json.dumps({
+        'resourceType': 'Observation', 'id': 'obs-{}'.format(i),
+        'meta': {'versionId': '1', 'lastUpdated': '2018-05-01T10:00:00.000+00:00'},
+        'status': 'final',
+        'category': [{'coding': [{'system': 'http://hl7.org/fhir/observation-category', 'code': 'vital-signs',
+                                  'display': 'vital-signs'}]}],
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '39156-5', 'display': 'Body Mass Index'}],
+                 'text': 'Body Mass Index'},
+        'subject': {'reference': 'Patient/{}'.format(i // 10)},
+        'context': {'reference': 'Encounter/{}'.format(i // 2)},
+        'effectiveDateTime': '2018-05-01T10:00:00+00:00',
+        'issued': '2018-05-01T10:00:00.000+00:00',
+        'valueQuantity': {'value': 20.0 + i % 100 / 10, 'unit': 'kg/m2', 'system': 'http://unitsofmeasure.org',
+                          'code': 'kg/m2'}})
+
+
+def measure(constructor, n: int, read: str=None):
+    """
+    Constructs n observations from their json like FHIRClient does
+
+    Args:
+        constructor: Observation or CompactObservation
+        n (int): Number of observations
+        read (str): How the values used by the observation processors are read after construction. None for not
+                    at all, engine for like the ObservationFeatureEngine (without keeping the parsed values) and
+                    attributes for as attributes (e.g. observation.valueQuantity, which keeps the parsed values).
+
+    Returns:
+        float: Bytes per observation that are kept by the observations
+    """
+    lines = [observation_json(i) for i in range(n)]
+    engine_attrs = ['code', 'effectiveDateTime', 'valueQuantity']
+    gc.collect()
+    tracemalloc.start()
+    observations = [constructor(resource_dict=json.loads(line), fhir_client=None) for line in lines]
+    for observation in observations:
+        if read == 'engine':
+            get_coding_key(observation), observation.effectiveDateTime, peek(observation, 'valueQuantity')
+        elif read == 'attributes':
+            for attr in engine_attrs:
+                getattr(observation, attr)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del observations
+    return size / n
+
+
+def main(n: int=10000):
+    results = dict()
+    for read, description in READS.items():
+        regular = measure(Observation, n, read)
+        compact = measure(CompactObservation, n, read)
+        results[read] = regular / compact
+        print("{:<28} Observation {:>7.0f} B   CompactObservation {:>7.0f} B   {:.1f}x less".format(
+            description, regular, compact, regular / compact))
+    return results
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,361 @@
+import asyncio
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import requests
+
+from fhir_client import FHIRClient
+from fhir_objects.patient import Patient
+from response_cache import ResponseCache
+from identity_map import IdentityMap
+from cohort import Cohort
+
+
+class AsyncFHIRClient():
+
+    def __init__(self, service_base_url: str, logger: logging.Logger=None, preprocessor=None,
+                 chunk_size: int=50, cache: ResponseCache=None, identity_map: IdentityMap=None,
+                 compact: bool=False, projection: bool=True, elements: dict=None,
+                 filter_observations: bool=True, max_concurrency: int=8):
+        """
+        asyncio counterpart of FHIRClient. The search methods are coroutines that return the same
+        fhir objects as their FHIRClient counterparts. Searches of several chunks (e.g. observations
+        of a cohort or control patients) and their pagination run concurrently, but never more
+        than max_concurrency requests at a time.
+
+        The requests are submitted by a FHIRClient (client), which is also the client of the returned
+        fhir objects. Its blocking methods (e.g. sync, the iter_* methods or get_bulk_export_patients)
+        are used through it. Observations that are accessed before they were loaded with
+        load_observations are retrieved by it synchronously, which blocks the event loop.
+
+        The client is closed with close or by using it as asynchronous context manager.
+
+        Attributes:
+            client (FHIRClient): The client that submits the requests
+            max_concurrency (int): Maximum number of concurrent requests
+
+        Args:
+            server_url (str): Base url to be used for all requests (e.g. https://r3.smarthealthit.org)
+            logger (logging.Logger): Logger to be used
+            preprocessor (module): Preprocessor module to be used
+            chunk_size (int): Number of ids per search for searches by several resources
+            cache (ResponseCache): Optional persistent cache for the responses of the server
+            identity_map (IdentityMap): Map of the objects constructed by this client, by default all patients
+            compact (bool): Whether observations, conditions and procedures are constructed as compact classes
+            projection (bool): Whether searches request only the elements that are used (_elements)
+            elements (dict): Elements to be requested by resource type (e.g. {'Patient': ['birthDate', 'gender']})
+            filter_observations (bool): Whether the observations of patients are restricted to the codes of the
+                                        observation processors if all processors declare their codes
+            max_concurrency (int): Maximum number of concurrent requests
+        """
+        self.client = FHIRClient(service_base_url, logger=logger, preprocessor=preprocessor, chunk_size=chunk_size,
+                                 cache=cache, identity_map=identity_map, compact=compact,
+                                 projection=projection, elements=elements, filter_observations=filter_observations)
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+        self._semaphore_loop = None
+
+        # Keep a pooled connection for each concurrent request
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_concurrency)
+        self.client.session.mount('http://', adapter)
+        self.client.session.mount('https://', adapter)
+
+    @property
+    def preprocessor(self):
+        """Preprocessing: The preprocessor of the client"""
+        return self.client.preprocessor
+
+    @property
+    def identity_map(self):
+        """IdentityMap: The map of the objects constructed by the client"""
+        return self.client.identity_map
+
+    def close(self):
+        """
+        Shuts down the threads of the requests. Pending requests are completed.
+        """
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_semaphore(self):
+        """
+        Returns:
+            The semaphore that bounds the concurrent requests within the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _get_page_async(self, url: str):
+        """
+        Requests a page without blocking the event loop
+
+        Args:
+            url (str): Url of the page
+
+        Returns:
+            The json of the page
+        """
+        async with self._get_semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self.client._get_page, url, self.client.session)
+
+    async def _get_response_async(self, url: str):
+        """
+        Requests an url without blocking the event loop
+
+        Args:
+            url (str): Url of the request
+
+        Returns:
+            The requests.Response
+        """
+        async with self._get_semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self.client._get_url, url, self.client.session)
+
+    async def _search(self, path: str, constructor: Callable, **query_params):
+        """
+        Submits a search and collects the objects of all pages. While a page is converted,
+        the next page is already requested.
+
+        Args:
+            path (str): FHIR resource to be queried (e.g. Patient or Observation)
+            constructor (Callable): The constructor with which to construct the results
+            **query_params: Dict of query parameters to build the query string
+
+        Returns:
+            A list of objects generated by the constructor. E.g. a list of Patient objects.
+        """
+        results, _ = await self._search_with_time(path, constructor, query_params)
+        return results
+
+    async def _search_with_time(self, path: str, constructor: Callable, query_params: dict):
+        """
+        Submits a search like _search
+
+        Returns:
+            (list, str): The objects and the time of the server at which the search was answered (see _search_time)
+        """
+        results = []
+        included_ids = set()
+        projected_params = self.client._project(path, constructor, query_params)
+        r = await self._get_response_async(self.client._build_url(path, **projected_params))
+        fallback = None if self.client._check_status(r.status_code) else self.client._operation_failed(path, query_params,
+                                                                                          r.status_code)
+        if fallback is not None:
+            path, query_params = fallback
+            projected_params = self.client._project(path, constructor, query_params)
+            r = await self._get_response_async(self.client._build_url(path, **projected_params))
+        if not self.client._check_status(r.status_code) and self.client._projection_failed(path, projected_params, r.status_code):
+            r = await self._get_response_async(self.client._build_url(path, **query_params))
+        if not self.client._check_status(r.status_code):
+            r.raise_for_status()
+        page = r.json()
+        search_time = self.client._search_time(r, page)
+        while page is not None:
+            next_url = self.client._next_url(page)
+            next_page = asyncio.ensure_future(self._get_page_async(next_url)) if next_url else None
+            results += self.client._construct(page.get('entry', []), constructor, included_ids)
+            page = await next_page if next_page else None
+        return results, search_time
+
+    async def _search_patients(self, path: str, controls: bool, **query_params):
+        """
+        Searches patients and adds a control group if requested
+
+        Returns:
+            Cohort: The patients, together with the search and the time of the server at which it was answered
+        """
+        start = time.time()
+        results, last_updated = await self._search_with_time(path, Patient, query_params)
+        self.client._log_received(results, 'patients', start)
+
+        # If controls are to be returned, load them
+        if controls:
+            results = await self.get_control_patients(results)
+
+        return Cohort(results, path, query_params, controls, last_updated, labels=getattr(results, 'labels', None))
+
+    async def _search_observations(self, patient_id: str, codes: list=None, max_per_code: int=None):
+        """
+        Searches the observations of patients, see FHIRClient.iter_observation_by_patient
+        """
+        path, query_params = self.client._observation_search(patient_id, codes, max_per_code)
+        return await self._search(path, self.client._constructor('Observation'), **query_params)
+
+    async def load_observations(self, patients: list, chunk_size: int=None):
+        """
+        Loads the observations of a cohort with concurrent searches of chunks of patients
+        (patient=id1,id2,...) and distributes them to the respective patients.
+        Patients whose observations have already been retrieved are skipped, unless observation
+        processors that need other observations were registered since.
+
+        Args:
+            patients (list): List of fhir_objects.Patient.patient
+            chunk_size (int): Number of patients per search, defaults to the chunk_size of the client
+        """
+        patients = [patient for patient in patients if not patient.observations_loaded]
+        patient_ids = list(dict.fromkeys(patient.id for patient in patients))
+
+        codes, max_per_code = self.client._observation_filter()
+        observations = await asyncio.gather(*[self._search_observations(','.join(chunk), codes, max_per_code)
+                                              for chunk in self.client._chunks(patient_ids, chunk_size)])
+        self.client._assign_observations(patients, itertools.chain.from_iterable(observations), (codes, max_per_code))
+
+    async def get_control_patients(self, results: list, random_seed=42):
+        """
+        Returns the control group for a set of patients
+
+        Args:
+            results: list of Patient object
+
+        Returns:
+            Cohort: The cases followed by the controls, with the labels case (False for controls)
+                    and matched_case (the id of the matched case)
+        """
+        # Group patients IDs from case group
+        case_ids = set([r.id for r in results])
+
+        # The sample is drawn from a sequential stream of IDs
+        loop = asyncio.get_running_loop()
+        control_ids = await loop.run_in_executor(
+            self._executor, self.client._sample_patient_ids, max(10, len(case_ids)), case_ids, random_seed)
+
+        # Controls that have not been constructed yet are retrieved concurrently in chunks
+        controls, missing_ids = self.client._mapped_patients(control_ids)
+        chunks = await asyncio.gather(*[self._search('Patient', Patient, _id=','.join(chunk), _count=len(chunk))
+                                        for chunk in self.client._chunks(missing_ids)])
+        for control in itertools.chain.from_iterable(chunks):
+            controls[control.id] = control
+
+        return self.client._control_cohort(results, control_ids, controls)
+
+    async def get_all_patients(self, max_count=1000):
+        """
+        Gets a all patients
+
+        Returns:
+            List of fhir_objects.Patient.patient
+        """
+        start = time.time()
+        results = await self._search('Patient', Patient)
+        self.client._log_received(results, 'patients', start)
+        return results
+
+    async def get_all_conditions(self):
+        """
+        Gets all conditions
+
+        Returns:
+            List of fhir_objects.Condition.condition
+        """
+        start = time.time()
+        results = await self._search('Condition', self.client._constructor('Condition'))
+        self.client._log_received(results, 'conditions', start)
+        return results
+
+    async def get_all_observations(self):
+        """
+        Gets all observations
+
+        Returns:
+            List of fhir_objects.Observation.observation
+        """
+        start = time.time()
+        results = await self._search('Observation', self.client._constructor('Observation'))
+        self.client._log_received(results, 'observations', start)
+        return results
+
+    async def get_all_procedures(self):
+        """
+        Gets all procedures
+
+        Returns:
+            List of fhir_objects.Procedure.procedure
+        """
+        start = time.time()
+        results = await self._search('Procedure', self.client._constructor('Procedure'))
+        self.client._log_received(results, 'procedures', start)
+        return results
+
+    async def get_patients_by_procedure_code(self, system: str, code: str, controls=False):
+        """
+        Gets all patients with procedure of a certain system code
+
+        Args:
+            system (str): System from which the code originates (e.g. 'http://snomed.info/sct')
+            code (str): Code (e.g. 73761001)
+
+        Returns:
+            Cohort of fhir_objects.Patient.patient
+        """
+        path, query_params = self.client._patients_by_code_query('Procedure', system, code)
+        return await self._search_patients(path, controls, **query_params)
+
+    async def get_patients_by_procedure_text(self, text: str, controls=False):
+        """
+        Gets all patients with procedure of a certain text (e.g. Colonoscopy)
+
+        Args:
+            text (str): Text of CodeableConcept.text, Coding.display, or Identifier.type.text.
+
+        Returns:
+            Cohort of fhir_objects.Patient.patient
+        """
+        path, query_params = self.client._patients_by_text_query('Procedure', text)
+        return await self._search_patients(path, controls, **query_params)
+
+    async def get_patients_by_condition_code(self, system: str, code: str, controls=False):
+        """
+        Gets all patients with condition of a certain system code
+
+        Args:
+            system (str): System from which the code originates (e.g. 'http://snomed.info/sct')
+            code (str): Code (e.g. 195662009)
+
+        Returns:
+            Cohort of fhir_objects.Patient.patient
+        """
+        path, query_params = self.client._patients_by_code_query('Condition', system, code)
+        return await self._search_patients(path, controls, **query_params)
+
+    async def get_patients_by_condition_text(self, text: str, controls=False):
+        """
+        Gets all patients with condition of a certain text (e.g 'Acute viral pharyngitis')
+
+        Args:
+            text (str): Text of CodeableConcept.text, Coding.display, or Identifier.type.text.
+
+        Returns:
+            Cohort of fhir_objects.Patient.patient
+        """
+        path, query_params = self.client._patients_by_text_query('Condition', text)
+        return await self._search_patients(path, controls, **query_params)
+
+    async def get_observation_by_patient(self, patient_id: str, codes: list=None, max_per_code: int=None):
+        """
+        Gets all observations for a given patient that is of status final, unknown, amended, corrected.
+
+        Args:
+            patient_id (str): The patient resource identifier. Several comma separated identifiers
+                              retrieve the observations of all of these patients.
+            codes (list): Dicts with system and code to retrieve only observations with these codes
+            max_per_code (int): Retrieve only the latest observations of every code with Observation/$lastn,
+                                if the server supports it
+        """
+        start = time.time()
+        results = await self._search_observations(patient_id, codes, max_per_code)
+        self.client._log_received(results, 'observations', start)
+        return results
@@ -0,0 +1,103 @@
+class Cohort(list):
+    """
+    List of patients returned by a patient search of FHIRClient. It remembers the search and
+    the time of the server up to which changes are contained, so that it can be updated in
+    place with FHIRClient.sync instead of being retrieved again.
+
+    Patient objects are shared between the cohorts of a client (see IdentityMap), so attributes
+    that depend on the cohort (e.g. whether a patient is a case or a control) are kept in the
+    cohort by patient id instead of being set on the patients.
+
+    Args:
+        patients (list): List of fhir_objects.Patient.patient
+        path (str): FHIR resource of the search (e.g. Patient or Condition)
+        query_params (dict): Query parameters of the search
+        controls (bool): Whether a control group was added to the cases
+        last_updated (str): FHIR instant of the server up to which changes are contained (high-water mark)
+        labels (dict): Cohort attributes (e.g. case or matched_case), each a dict of patient id to value
+
+    Attributes:
+        labels (dict): Cohort attributes, each a dict of patient id to value
+    """
+
+    def __init__(self, patients: list=(), path: str=None, query_params: dict=None, controls: bool=False,
+                 last_updated: str=None, labels: dict=None):
+        super().__init__(patients)
+        self.path = path
+        self.query_params = query_params or dict()
+        self.controls = controls
+        self.last_updated = last_updated
+        self.labels = labels if labels is not None else dict()
+
+    def __getitem__(self, item):
+        # Slices keep the labels of their patients
+        if isinstance(item, slice):
+            return self._subset(super().__getitem__(item))
+        return super().__getitem__(item)
+
+    def copy(self):
+        """
+        Returns:
+            Cohort: A shallow copy with the labels, but without the search (it can not be synchronized)
+        """
+        return self._subset(self)
+
+    def _subset(self, patients: list):
+        ids = set(patient.id for patient in patients)
+        return Cohort(patients, labels={attr: {i: value for i, value in values.items() if i in ids}
+                                        for attr, values in self.labels.items()})
+
+    @property
+    def query(self):
+        """tuple: Path and query parameters of the search"""
+        return self.path, self.query_params
+
+    def set_label(self, patient, attr: str, value):
+        """
+        Sets a cohort attribute of a patient (e.g. case)
+        """
+        self.labels.setdefault(attr, dict())[patient.id] = value
+
+    def remove_labels(self, patient_id: str):
+        """
+        Removes all cohort attributes of a patient
+        """
+        for values in self.labels.values():
+            values.pop(patient_id, None)
+
+    def get_attribute(self, patient, attr: str, default=None):
+        """
+        Returns an attribute of a patient of the cohort, the cohort attribute if the cohort
+        keeps one for the patient and the attribute of the patient object otherwise
+
+        Args:
+            patient (Patient): A patient of the cohort
+            attr (str): Name of the attribute (e.g. case or gender)
+            default: Returned if the patient has no such attribute
+
+        Returns:
+            The value of the attribute
+        """
+        values = self.labels.get(attr)
+        if values is not None and patient.id in values:
+            return values[patient.id]
+        return getattr(patient, attr, default)
+
+
+def get_attribute(patients, patient, attr: str, default=None):
+    """
+    Returns an attribute of a patient of a cohort (see Cohort.get_attribute) or of any other
+    collection of patients
+
+    Args:
+        patients (Iterable): The patients, a Cohort or e.g. a list
+        patient (Patient): One of the patients
+        attr (str): Name of the attribute
+        default: Returned if the patient has no such attribute
+
+    Returns:
+        The value of the attribute
+    """
+    if isinstance(patients, Cohort):
+        return patients.get_attribute(patient, attr, default)
+    return getattr(patient, attr, default)
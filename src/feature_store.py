@@ -0,0 +1,149 @@
+import json
+import os
+from typing import Iterable, List
+
+import numpy as np
+
+from cohort import Cohort, get_attribute
+from fhir_objects.patient import Patient
+from preprocessing import Preprocessing, ObservationFeatureEngine
+
+
+def iter_chunks(patients: Iterable[Patient], chunk_size: int):
+    """
+    Splits a cohort into lists of at most chunk_size patients
+
+    Args:
+        patients (Iterable[Patient]): The cohort, e.g. a list or a generator of patients
+        chunk_size (int): Maximum number of patients per chunk
+
+    Returns:
+        generator: The chunks
+    """
+    # Chunks of a cohort keep its labels, chunks of other iterables have none
+    new_chunk = (lambda chunk: Cohort(chunk, labels=patients.labels)) if isinstance(patients, Cohort) else list
+    chunk = []
+    for patient in patients:
+        chunk.append(patient)
+        if len(chunk) == chunk_size:
+            yield new_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield new_chunk(chunk)
+
+
+class CohortFeatureStore():
+    """
+    Columnar representation of a materialized cohort. Every patient attribute is stored as
+    one NumPy array, so a cohort can be saved as .npy files and reloaded as memory maps
+    instead of being retrieved from the server again.
+
+    Args:
+        columns (dict): Maps patient attribute names to arrays of equal length
+
+    Attributes:
+        attrs (List[str]): Names of the stored patient attributes
+    """
+
+    # Patient attributes that are stored by default besides the labels of the cohort and the observation attributes
+    default_attrs = ['id', 'birthDate', 'gender']
+
+    # Name of the file that lists the stored columns
+    columns_file = 'columns.json'
+
+    def __init__(self, columns: dict):
+        lengths = set(len(column) for column in columns.values())
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same length. Lengths are {}".format(lengths))
+        self._columns = columns
+
+    def __len__(self):
+        return len(next(iter(self._columns.values()))) if self._columns else 0
+
+    def __getitem__(self, attr: str):
+        return self._columns[attr]
+
+    def __contains__(self, attr: str):
+        return attr in self._columns
+
+    @property
+    def attrs(self):
+        """list: Names of the stored patient attributes"""
+        return list(self._columns.keys())
+
+    @classmethod
+    def from_patients(cls, patients: Iterable[Patient], attrs: List[str]=None, preprocessor: Preprocessing=None,
+                      chunk_size: int=1000):
+        """
+        Materializes the attributes of a cohort into columns
+
+        Args:
+            patients (Iterable[Patient]): The cohort, e.g. a list or a generator of patients
+            attrs (List[str]): Patient attributes to be stored. Defaults to id, birthDate, gender, all labels of
+                               the cohort if it is a Cohort (e.g. case and matched_case) and all attributes derived
+                               by the observation processors of preprocessor
+            preprocessor (Preprocessing): Preprocessor that defines the observation attributes
+            chunk_size (int): Number of patients whose observations are loaded at once
+
+        Returns:
+            CohortFeatureStore: The materialized cohort
+        """
+        preprocessor = preprocessor or Preprocessing()
+        if attrs is None:
+            labels = [attr for attr in patients.labels if attr not in cls.default_attrs] \
+                if isinstance(patients, Cohort) else []
+            attrs = cls.default_attrs + labels + preprocessor.get_observation_attributes()
+
+        observation_attrs = [attr for attr in attrs if preprocessor.get_observation_processor(attr)]
+        engine = ObservationFeatureEngine(preprocessor)
+
+        values = {attr: [] for attr in attrs}
+        for chunk in iter_chunks(patients, chunk_size):
+            # Observations are retrieved in bulk and reduced at once for each chunk of the cohort
+            if observation_attrs:
+                Patient.load_observations(chunk)
+                for attr, column in engine.transform(chunk, observation_attrs).items():
+                    values[attr].append(column)
+            for attr in attrs:
+                if attr not in observation_attrs:
+                    values[attr] += [get_attribute(chunk, patient, attr) for patient in chunk]
+
+        columns = dict()
+        for attr in attrs:
+            if attr in observation_attrs:
+                columns[attr] = np.concatenate(values[attr]).astype(float) if values[attr] else np.empty(0)
+            elif values[attr] and all(isinstance(v, (bool, np.bool_)) for v in values[attr]):
+                columns[attr] = np.array(values[attr], dtype=bool)
+            else:
+                columns[attr] = np.array(['' if v is None else str(v) for v in values[attr]], dtype=str)
+        return cls(columns)
+
+    def save(self, path: str):
+        """
+        Saves every column as .npy file into a directory
+
+        Args:
+            path (str): Directory of the store, created if it does not exist
+        """
+        os.makedirs(path, exist_ok=True)
+        for attr, column in self._columns.items():
+            np.save(os.path.join(path, attr + '.npy'), np.asarray(column))
+        with open(os.path.join(path, self.columns_file), 'w') as f:
+            json.dump({'attrs': self.attrs, 'length': len(self)}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str='r'):
+        """
+        Loads a store saved with save. By default the columns are memory mapped, so only the
+        parts that are accessed are read from disk.
+
+        Args:
+            path (str): Directory of the store
+            mmap_mode (str): Memory map mode of numpy.load, None to read the columns into memory
+
+        Returns:
+            CohortFeatureStore: The loaded cohort
+        """
+        with open(os.path.join(path, cls.columns_file)) as f:
+            attrs = json.load(f)['attrs']
+        return cls({attr: np.load(os.path.join(path, attr + '.npy'), mmap_mode=mmap_mode) for attr in attrs})
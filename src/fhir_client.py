@@ -3,20 +3,36 @@ from fhir_objects.patient import Patient
 from fhir_objects.condition import Condition
 from fhir_objects.observation import Observation
 from fhir_objects.procedure import Procedure
+from fhir_objects.fhir_base_object import FHIRBaseObject
+from fhir_objects.compact import compact_classes
+from fhir_objects.observation_index import parse_fhir_datetime
+from fhir_objects.fhir_resources import fhir_resources, choice_elements
 from preprocessing import Preprocessing
+from response_cache import ResponseCache
+from identity_map import IdentityMap
+from cohort import Cohort
 import time
+import datetime
+import email.utils
 import importlib.util
 import numpy as np
 
 
 from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
 import logging
-from typing import Callable
+import queue
+import threading
+from typing import Callable, Iterable, List
 
 
 class FHIRClient():
 
-    def __init__(self, service_base_url: str, logger: logging.Logger=None, preprocessor=None):
+    def __init__(self, service_base_url: str, logger: logging.Logger=None, preprocessor=None,
+                 chunk_size: int=50, cache: ResponseCache=None, identity_map: IdentityMap=None,
+                 compact: bool=False, projection: bool=True, elements: dict=None, filter_observations: bool=True):
         """
         Helper class to perform requests to a FHIR server.
 
@@ -24,14 +40,38 @@ class FHIRClient():
             server_url (str): Base url to be used for all requests (e.g. https://r3.smarthealthit.org)
             logger (logging.Logger): Logger to be used
             preprocessor (module): Preprocessor module to be used
+            chunk_size (int): Number of ids per search for searches by several resources
+                              (e.g. patient=id1,id2,... or _id=id1,id2,...)
+            cache (ResponseCache): Optional persistent cache for the responses of the server
+            identity_map (IdentityMap): Map of the objects constructed by this client, by default all patients.
+                                        Objects that are only streamed by the iter_* methods are not added.
+            compact (bool): Whether observations, conditions and procedures are constructed as memory
+                            efficient fhir_objects.compact classes, which keep no reference to the client
+            projection (bool): Whether searches request only the elements that are used (_elements)
+            elements (dict): Elements to be requested by resource type (e.g. {'Patient': ['birthDate', 'gender']}),
+                             by default the elements kept by the fhir_objects and needed by the observation processors
+            filter_observations (bool): Whether the observations of patients are restricted to the codes of the
+                                        observation processors if all processors declare their codes
         """
         self.server_url = service_base_url
         self.session = requests.Session()
         self.logger = logger
         self.preprocessor = preprocessor
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.identity_map = identity_map if identity_map is not None else IdentityMap(resource_types=['Patient'])
+        self.compact = compact
+        self.projection = projection
+        self.elements = elements or dict()
+        self.filter_observations = filter_observations
+
+        # Resource types for which the server rejected _elements
+        self._projection_rejected = set()
+        # Operations (resource type, name) that the server declares but does not answer
+        self._operations_rejected = set()
 
         # On initialization request the capability statement from the server
-        self.get_capability_statement()
+        self.capability_statement = self.get_capability_statement()
 
         # On success we tell the user
         if self.logger and self.logger.isEnabledFor(logging.INFO):
@@ -54,6 +94,126 @@ class FHIRClient():
     def preprocessor(self, preprocessor=None):
         del self._preprocessor
 
+    def _constructor(self, resource_type: str):
+        """
+        Returns:
+            The class with which resources of resource_type (e.g. Observation) are constructed
+        """
+        if self.compact and resource_type in compact_classes:
+            return compact_classes[resource_type]
+        return {'Patient': Patient, 'Condition': Condition, 'Observation': Observation,
+                'Procedure': Procedure}[resource_type]
+
+    def _elements(self, resource_type: str, processed: bool=False):
+        """
+        Computes the elements to be requested for a resource type: the elements that are kept by
+        the respective fhir_object, narrowed to the elements in self.elements or, for the observations
+        of patients that are derived into attributes, to the elements declared by all observation processors
+
+        Args:
+            resource_type (str): The resource type (e.g. Observation)
+            processed (bool): Whether the resources are only retrieved for the observation processors
+
+        Returns:
+            list: Names of the elements, with the base name of choice elements (e.g. value for valueQuantity).
+                  id, meta and resourceType are always returned by the server.
+        """
+        whitelist = fhir_resources[resource_type]
+        required = []
+        needed = self.elements.get(resource_type)
+        if resource_type == 'Observation' and processed:
+            # Observations are assigned to their patient and compared by effectiveDateTime
+            required = ['subject', 'effectiveDateTime']
+            if needed is None:
+                needed = self.preprocessor.get_observation_elements()
+        if needed is None:
+            needed = whitelist
+        return list(dict.fromkeys(self._element_name(element) for element in required + needed
+                                  if element in whitelist and element not in ['id', 'meta', 'resourceType']))
+
+    @staticmethod
+    def _element_name(attribute: str):
+        """
+        _elements takes the names of elements, so attributes of choice elements are requested by their base name
+
+        Returns:
+            str: The element of an attribute (e.g. effective for effectiveDateTime)
+        """
+        for element in choice_elements:
+            if attribute.startswith(element) and attribute[len(element):][:1].isupper():
+                return element
+        return attribute
+
+    def _project(self, path: str, constructor: Callable, query_params: dict):
+        """
+        Adds _elements to the query parameters of a search if the server supports it. Searches with
+        _include are not projected, since _elements would also apply to the included resources.
+
+        Args:
+            path (str): FHIR resource to be queried (e.g. Patient or Observation)
+            constructor (Callable): The constructor with which the results are constructed
+            query_params (dict): Query parameters of the search
+
+        Returns:
+            dict: The query parameters, with _elements if the search is projected
+        """
+        resource_type = path.split('/')[0]
+        if (not self.projection or resource_type != getattr(constructor, '__name__', None)
+                or resource_type not in fhir_resources or path in self._projection_rejected
+                or '_elements' in query_params or '_include' in query_params):
+            return query_params
+
+        # _elements is not part of DSTU1 (FHIR 0.x)
+        if str((self.capability_statement or {}).get('fhirVersion', '')).startswith('0.'):
+            return query_params
+
+        # Searches of the observations of patients (see _observation_search) only need the elements
+        # of the observation processors, other searches return all elements of the fhir_object
+        processed = resource_type == 'Observation' and 'patient' in query_params
+        return dict(query_params, _elements=','.join(self._elements(resource_type, processed)))
+
+    # Status codes with which servers reject search parameters they do not support, as opposed to
+    # e.g. 404 or 501 for an unknown path or operation
+    rejected_parameter_status_codes = [400, 422]
+
+    # Status codes with which servers answer operations they do not support
+    unsupported_operation_status_codes = [404, 405, 501]
+
+    # Parameters of operations that the corresponding search does not have
+    operation_params = {'lastn': ['max']}
+
+    def _projection_failed(self, path: str, query_params: dict, status_code: int):
+        """
+        Remembers that the server rejected _elements for a resource type
+
+        Returns:
+            True if the search should be repeated without _elements
+        """
+        if '_elements' in query_params and status_code in self.rejected_parameter_status_codes:
+            if self.logger and self.logger.isEnabledFor(logging.INFO):
+                self.logger.info(f"Server rejected _elements for {path}, requesting full resources instead.")
+            self._projection_rejected.add(path)
+            return True
+        return False
+
+    def _operation_failed(self, path: str, query_params: dict, status_code: int):
+        """
+        Remembers that the server does not answer an operation (e.g. Observation/$lastn), although its
+        capability statement declares it
+
+        Returns:
+            (str, dict): Path and query parameters of the search without the operation, None if the request
+                         did not fail because of the operation
+        """
+        resource_type, _, operation = path.partition('/$')
+        if not operation or status_code not in self.unsupported_operation_status_codes:
+            return None
+        if self.logger and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(f"Server does not support {path}, searching {resource_type} instead.")
+        self._operations_rejected.add((resource_type, operation))
+        return resource_type, {param: value for param, value in query_params.items()
+                               if param not in self.operation_params.get(operation, [])}
+
     def _check_status(self, status_code: int):
         """
         Checks whether returned status code is 200
@@ -94,63 +254,396 @@ class FHIRClient():
             The requests.Response
         """
         url = self._build_url(path, **query_params)
+        return self._get_url(url, session=session)
+
+    def _get_url(self, url: str, session: requests.Session=None):
+        """
+        Submits a GET request for a complete url (e.g. the next link of a paginated result)
+
+        Args:
+            url (str): Url to be requested
+            session (requests.Session): Session to be used for query
+
+        Returns:
+            The requests.Response
+        """
         if self.logger and self.logger.isEnabledFor(logging.DEBUG):
-            logger.DEBUG(f"Query: {url}")
+            self.logger.debug(f"Query: {url}")
+        if self.cache is not None:
+            return self.cache.get(url, session=session)
         if session:
             return session.get(url)
         else:
             return requests.get(url)
-    
-    def _get_patients_ids(self):
+
+    def _get_page(self, url: str, session: requests.Session=None):
         """
-        In order to efficiently load a control population for a case population,
-        patient IDs in the db are used to quickly load them recursively.
+        Requests a page of a paginated result
+
+        Args:
+            url (str): Url of the page
+            session (requests.Session): Session to be used for query
+
+        Returns:
+            The json of the page
+        """
+        r = self._get_url(url, session=session)
+        if not self._check_status(r.status_code):
+            r.raise_for_status()
+        return r.json()
+
+    @staticmethod
+    def _next_url(result_json: dict):
+        """
+        Returns:
+            The url of the next page of a paginated result or None for the last page
+        """
+        for link in result_json.get('link', []):
+            if link['relation'] == 'next':
+                return link['url']
+        return None
+
+    def _iter_entries(self, result_json: dict, session: requests.Session):
+        """
+        Iterates over the entries of a paginated result without recursion.
+        Once the first entry of a page has been consumed, the next page is requested in the background
+        while the rest of the page is processed, so that at most two pages are held in memory at any time.
+        No further page is requested if the generator is closed before and a pending request is dropped.
 
         Args:
             result_json (dict): The json result from the initial query
             session (requests.Session): Session to be used for all requests
 
         Returns:
-            A list of objects generated by the constructor. E.g. a list of Patient objects.
+            A generator of the entries of all pages, starting with those of result_json
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        next_page = None
+        try:
+            page = result_json
+            while page is not None:
+                next_url = self._next_url(page)
+                for i, entry in enumerate(page.get('entry', [])):
+                    yield entry
+                    if i == 0 and next_url:
+                        next_page = executor.submit(self._get_page, next_url, session)
+                if next_url and next_page is None:
+                    # A page without entries
+                    next_page = executor.submit(self._get_page, next_url, session)
+                page = next_page.result() if next_page else None
+                next_page = None
+        finally:
+            # Requests that have not been sent yet are cancelled, pages that are already requested are dropped
+            if next_page:
+                next_page.cancel()
+            executor.shutdown(wait=False)
+
+    def _sample_patient_ids(self, size: int, exclude_ids: set, random_seed=42, page_size: int=1000):
+        """
+        In order to efficiently load a control population for a case population,
+        a random sample of patient IDs in the db is drawn by reservoir sampling over
+        a stream of IDs only (_elements=id, full resources if the server rejects _elements).
+        Memory is bounded by the sample size and no list of all patient IDs is kept.
+
+        Args:
+            size (int): Number of IDs to be sampled
+            exclude_ids (set): IDs that must not be sampled (e.g. IDs of the case group)
+            random_seed (int): Seed of the sample
+            page_size (int): Number of IDs requested per page
+
+        Returns:
+            A list of at most size patient IDs
         """
+        random_state = np.random.RandomState(random_seed)
+        sample = []
+        n_seen = 0
+
+        query_params = {'_count': page_size}
+        if 'Patient' not in self._projection_rejected:
+            query_params['_elements'] = 'id'
+        r = self._get('Patient', session=self.session, **query_params)
+        if not self._check_status(r.status_code) and self._projection_failed('Patient', query_params, r.status_code):
+            # Full resources are streamed instead, only their IDs are kept
+            r = self._get('Patient', session=self.session, _count=page_size)
+        if not self._check_status(r.status_code):
+            r.raise_for_status()
 
-        # Build a dummy callable to use the self._collect function:
-        def PatientID(resource_dict, fhir_client=None):
-            return resource_dict['id']
-        PatientID.__name__ = 'Patient'
+        for entry in self._iter_entries(r.json(), self.session):
+            patient_id = entry['resource']['id']
+            if entry['resource']['resourceType'] != 'Patient' or patient_id in exclude_ids:
+                continue
+            n_seen += 1
+            if len(sample) < size:
+                sample.append(patient_id)
+            else:
+                # Replace a sampled ID with probability size / n_seen
+                j = random_state.randint(n_seen)
+                if j < size:
+                    sample[j] = patient_id
 
-        # Load Patient ids
-        r = self._get('Patient', session=self.session, **{'_summary': 'text'})
-        patient_ids = self._collect(r.json(), self.session, PatientID)
-        return patient_ids
+        logging.info("Sampled {} of {} patients IDs.".format(len(sample), n_seen))
+        return sample
 
-    def _collect(self, result_json: dict, session: requests.Session, constructor: Callable):
+    def _collect(self, result_json: dict, session: requests.Session, constructor: Callable, **constructor_kwargs):
         """
         A server might return a pageinated result due to its settings.
-        This method collects all results recursively.
+        This method collects the results of all pages.
 
         Args:
             result_json (dict): The json result from the initial query
             session (requests.Session): Session to be used for all requests
             constructor (Callable): The constructor with which to construct the result list
+            **constructor_kwargs: Additional keyword arguments passed to the constructor
 
         Returns:
             A list of objects generated by the constructor. E.g. a list of Patient objects.
         """
-        result = []
-        for link in result_json['link']:
-            if link['relation'] == 'next':
-                r = session.get(link['url'])
-                if self._check_status(r.status_code):
-                    result = self._collect(r.json(), session, constructor)
-                else:
-                    r.raise_for_status()
-            else:
+        return list(self._iter_collect(result_json, session, constructor, **constructor_kwargs))
+
+    def _iter_collect(self, result_json: dict, session: requests.Session, constructor: Callable,
+                      map_results: bool=True, **constructor_kwargs):
+        """
+        Generator equivalent of _collect that constructs the objects page by page.
+
+        Args:
+            result_json (dict): The json result from the initial query
+            session (requests.Session): Session to be used for all requests
+            constructor (Callable): The constructor with which to construct the results
+            map_results (bool): Whether new objects are added to the identity map
+            **constructor_kwargs: Additional keyword arguments passed to the constructor
+
+        Returns:
+            A generator of objects generated by the constructor. E.g. Patient objects.
+        """
+        # Resources added by _include may be returned on several pages
+        included_ids = set()
+
+        yield from self._construct(self._iter_entries(result_json, session), constructor, included_ids, map_results,
+                                   **constructor_kwargs)
+
+    def _construct(self, entries: Iterable, constructor: Callable, included_ids: set, map_results: bool=True,
+                   **constructor_kwargs):
+        """
+        Constructs the objects of the entries of a search. Objects of resources that are in the identity map
+        are reused and resources added by _include are constructed only once per search.
+
+        Args:
+            entries (Iterable): The entries of a page or of all pages of the search
+            constructor (Callable): The constructor with which to construct the results
+            included_ids (set): IDs of resources added by _include on previous pages of the search
+            map_results (bool): Whether new objects are added to the identity map
+            **constructor_kwargs: Additional keyword arguments passed to the constructor
+
+        Returns:
+            A generator of objects generated by the constructor. E.g. Patient objects.
+        """
+        for d in entries:
+            resource = d['resource']
+            if resource['resourceType'] != constructor.__name__:
                 continue
-        if 'entry' in result_json.keys():
-            result += [constructor(resource_dict=d['resource'], fhir_client=self) for d in result_json['entry'] if d[
-                'resource']['resourceType'] == constructor.__name__]
-        return result
+
+            if d.get('search', {}).get('mode') == 'include':
+                if resource['id'] in included_ids:
+                    continue
+                included_ids.add(resource['id'])
+
+            yield self._construct_resource(resource, constructor, map_results, **constructor_kwargs)
+
+    def _construct_resource(self, resource: dict, constructor: Callable, map_results: bool=True,
+                            **constructor_kwargs):
+        """
+        Constructs the object of a resource unless it is already in the identity map
+
+        Args:
+            resource (dict): The json of the resource
+            constructor (Callable): The constructor with which to construct the object
+            map_results (bool): Whether a new object is added to the identity map. Objects that are only
+                                streamed (see the iter_* methods) are not added, so that they are not kept
+                                in memory by the map.
+            **constructor_kwargs: Additional keyword arguments passed to the constructor
+
+        Returns:
+            The object generated by the constructor. E.g. a Patient object.
+        """
+        # Only FHIR objects are mapped
+        if not (isinstance(constructor, type) and issubclass(constructor, FHIRBaseObject)
+                and self.identity_map.maps(resource['resourceType'])):
+            return constructor(resource_dict=resource, fhir_client=self, **constructor_kwargs)
+
+        fhir_obj = self.identity_map.get(resource['resourceType'], resource['id'])
+        if fhir_obj is None:
+            fhir_obj = constructor(resource_dict=resource, fhir_client=self, **constructor_kwargs)
+            if map_results:
+                self.identity_map.add(resource['resourceType'], resource['id'], fhir_obj)
+        elif 'versionId' in resource.get('meta', {}) and \
+                getattr(fhir_obj, 'meta', {}).get('versionId') != resource['meta']['versionId']:
+            # Objects are updated in place when another version of their resource is received
+            fhir_obj.update_resource(resource)
+        return fhir_obj
+
+    @staticmethod
+    def _reference_id(reference: str):
+        """
+        Extracts the resource id from a FHIR reference (e.g. Patient/123 or http://server/Patient/123/_history/1)
+
+        Returns:
+            The id of the referenced resource
+        """
+        parts = reference.split('/')
+        if '_history' in parts:
+            parts = parts[:parts.index('_history')]
+        return parts[-1]
+
+    def _chunks(self, ids: list, chunk_size: int=None):
+        """
+        Splits a list of ids into chunks to be searched at once
+
+        Args:
+            ids (list): List of resource ids
+            chunk_size (int): Number of ids per chunk, defaults to the chunk_size of the client
+
+        Returns:
+            A generator of lists of ids
+        """
+        chunk_size = chunk_size or self.chunk_size or 1
+        for i in range(0, len(ids), chunk_size):
+            yield ids[i:i + chunk_size]
+
+    def load_observations(self, patients: list, chunk_size: int=None):
+        """
+        Loads the observations of a cohort with one search per chunk of patients
+        (patient=id1,id2,...) instead of one search per patient and distributes
+        them to the respective patients. Patients whose observations have already
+        been retrieved are skipped, unless observation processors that need other
+        observations were registered since.
+
+        Args:
+            patients (list): List of fhir_objects.Patient.patient
+            chunk_size (int): Number of patients per search, defaults to the chunk_size of the client
+        """
+        self._load_observations(patients, chunk_size)
+
+    def _load_observations(self, patients: list, chunk_size: int=None):
+        """
+        Synchronous implementation of load_observations that is used by the fhir objects
+        """
+        patients = [patient for patient in patients if not patient.observations_loaded]
+        patient_ids = list(dict.fromkeys(patient.id for patient in patients))
+
+        codes, max_per_code = self._observation_filter()
+        searches = (self._observation_search(','.join(chunk), codes, max_per_code)
+                    for chunk in self._chunks(patient_ids, chunk_size))
+        observations = itertools.chain.from_iterable(
+            self._iter_search(path, self._constructor('Observation'), **query_params) for path, query_params in searches)
+        self._assign_observations(patients, observations, (codes, max_per_code))
+
+    def _observation_filter(self):
+        """
+        Derives the observations of patients that are needed by the registered observation processors.
+        Observations are only restricted if filter_observations is set and all processors declare their codes.
+
+        Returns:
+            tuple: The codes of the needed observations or None for all observations and the number of
+                   latest observations per code or None for all of them. Only the latest observation is
+                   needed if all processors reduce to the latest value.
+        """
+        if not self.filter_observations:
+            return None, None
+
+        codes = self.preprocessor.get_observation_codes()
+        if not codes:
+            return None, None
+
+        processors = self.preprocessor.get_observation_preprocessors()
+        latest_only = all(getattr(processor, 'reduction', None) == 'latest' for processor in processors)
+        return codes, 1 if latest_only else None
+
+    def _observation_filter_covers(self, observation_filter: tuple):
+        """
+        Checks whether observations that were retrieved with a filter (see _observation_filter) contain
+        all observations that are needed by the currently registered observation processors
+
+        Args:
+            observation_filter (tuple): The codes and the number of latest observations per code
+
+        Returns:
+            True if no observations are missing
+        """
+        codes, max_per_code = observation_filter
+        needed_codes, needed_max_per_code = self._observation_filter()
+        if codes is not None:
+            if needed_codes is None:
+                return False
+            retrieved = set((code['system'], code['code']) for code in codes)
+            if any((code['system'], code['code']) not in retrieved for code in needed_codes):
+                return False
+        return max_per_code is None or (needed_max_per_code is not None and needed_max_per_code <= max_per_code)
+
+    def supports_operation(self, resource_type: str, operation: str):
+        """
+        Checks the capability statement of the server for an operation (e.g. Observation lastn)
+
+        Args:
+            resource_type (str): The resource type of the operation
+            operation (str): Name of the operation without $
+
+        Returns:
+            True if the server declares the operation for the resource type
+        """
+        for rest in (self.capability_statement or {}).get('rest', []):
+            for resource in rest.get('resource', []):
+                if resource.get('type') != resource_type:
+                    continue
+                for declared in resource.get('operation', []):
+                    # The definition is a reference object in DSTU2 and a canonical url in STU3
+                    definition = declared.get('definition') or ''
+                    if isinstance(definition, dict):
+                        definition = definition.get('reference') or ''
+                    if declared.get('name') == operation or definition.endswith('-' + operation):
+                        return (resource_type, operation) not in self._operations_rejected
+        return False
+
+    def _observation_search(self, patient_id: str, codes: List[dict]=None, max_per_code: int=None):
+        """
+        Builds the search for observations of patients of status final, unknown, amended, corrected
+
+        Args:
+            patient_id (str): Comma separated patient resource identifiers
+            codes (List[dict]): Dicts with system and code of the observations to be retrieved, None for all
+            max_per_code (int): Number of latest observations per patient and code to be retrieved, None for all.
+                                Only used if the server supports Observation/$lastn.
+
+        Returns:
+            tuple: The path and the query parameters of the search
+        """
+        query_params = {'status': 'final,unknown,amended,corrected', 'patient': patient_id}
+        if codes:
+            query_params['code'] = ','.join('{}|{}'.format(code['system'], code['code']) for code in codes)
+        if max_per_code and self.supports_operation('Observation', 'lastn'):
+            query_params['max'] = max_per_code
+            return 'Observation/$lastn', query_params
+        return 'Observation', query_params
+
+    def _assign_observations(self, patients: list, observations: Iterable, observation_filter: tuple=None):
+        """
+        Distributes observations to the patients they refer to
+
+        Args:
+            patients (list): List of fhir_objects.Patient.patient
+            observations (Iterable): fhir_objects.Observation.observation of these patients
+            observation_filter (tuple): Codes and number of latest observations per code the observations were
+                                        retrieved with (see _observation_filter), None for all observations
+        """
+        # A patient might appear more than once in a cohort
+        by_patient = {patient.id: [] for patient in patients}
+
+        for observation in observations:
+            patient_id = self._reference_id(observation.subject['reference'])
+            if patient_id in by_patient:
+                by_patient[patient_id].append(observation)
+
+        for patient in patients:
+            patient.set_observations(by_patient[patient.id], observation_filter)
 
     def get_control_patients(self, results: list, random_seed=42):
         """
@@ -160,35 +653,289 @@ class FHIRClient():
             results: list of Patient object
 
         Returns:
-            results: augmented results list with additional case flag 
-                     (case=False for controls)
+            Cohort: The cases followed by the controls, with the labels case (False for controls)
+                    and matched_case (the id of the matched case)
         """
-        # Start by retrieving all patients IDs
-        if not hasattr(self, 'patients_ids'):
-            self.patients_ids = self._get_patients_ids()
-            logging.info("Loaded {} patients IDs.".format(len(self.patients_ids)))
-        
         # Group patients IDs from case group
         case_ids = set([r.id for r in results])
 
-        # Check the difference
-        control_ids = set(self.patients_ids).difference(case_ids)
-
-        # Randomly sample from control ids, TODO: place general seed somewhere
-        np.random.seed(random_seed)
-        control_ids = np.random.choice(list(control_ids), size=min(len(control_ids), 
-                                        max(10, len(case_ids))),replace=False)
-        controls = []
-        for i in control_ids:
-            result_json = self._get('Patient', session=self.session, **{'_id': i}).json()
-            if 'entry' in result_json.keys():
-                controls.append(Patient(resource_dict=result_json['entry'][0]['resource'], fhir_client=self))
-                controls[-1].case=False
-        cases = []
+        # Randomly sample from the remaining patient ids, TODO: place general seed somewhere
+        control_ids = self._sample_patient_ids(max(10, len(case_ids)), case_ids, random_seed)
+
+        # Controls that have not been constructed yet are retrieved in chunks (_id=id1,id2,...)
+        controls, missing_ids = self._mapped_patients(control_ids)
+        for chunk in self._chunks(missing_ids):
+            for control in self._iter_search('Patient', Patient, _id=','.join(chunk), _count=len(chunk)):
+                controls[control.id] = control
+
+        return self._control_cohort(results, control_ids, controls)
+
+    def _mapped_patients(self, patient_ids: list):
+        """
+        Looks patients up in the identity map
+
+        Returns:
+            (dict, list): The mapped patients by id and the ids of the patients that are not mapped
+        """
+        patients = dict()
+        missing_ids = []
+        for i in patient_ids:
+            patient = self.identity_map.get('Patient', i)
+            if patient is None:
+                missing_ids.append(i)
+            else:
+                patients[i] = patient
+        return patients, missing_ids
+
+    @staticmethod
+    def _control_cohort(results: list, control_ids: list, controls: dict):
+        """
+        Combines cases and controls into a cohort with the labels case and matched_case
+
+        Args:
+            results (list): The cases
+            control_ids (list): The sampled ids of the controls
+            controls (dict): The retrieved controls by id
+
+        Returns:
+            Cohort: The cases followed by the controls in the order of the sample
+        """
+        controls = [controls[i] for i in control_ids if i in controls]
+        # The labels are kept in the cohort, as the patient objects are shared with other cohorts.
+        # Every control is matched to a case by the id in matched_case, so that cross-validation can keep them together
+        cohort = Cohort(list(results) + controls)
         for r in results:
-            r.case = True
-            cases.append(r)
-        return cases + controls
+            cohort.set_label(r, 'case', True)
+            cohort.set_label(r, 'matched_case', r.id)
+        for idx, control in enumerate(controls):
+            cohort.set_label(control, 'case', False)
+            cohort.set_label(control, 'matched_case', results[idx % len(results)].id if results else control.id)
+        return cohort
+
+    def _get_cohort(self, path: str, query_params: dict, controls: bool):
+        """
+        Searches patients and adds a control group if requested
+
+        Returns:
+            Cohort: The patients, together with the search and the time of the server at which it was answered
+        """
+        start = time.time()
+        r = self._search_response(path, Patient, query_params)
+        first_page = r.json()
+        last_updated = self._search_time(r, first_page)
+        results = list(self._iter_collect(first_page, self.session, Patient))
+        self._log_received(results, 'patients', start)
+
+        # If controls are to be returned, load them
+        if controls:
+            results = self.get_control_patients(results)
+
+        return Cohort(results, path, query_params, controls, last_updated, labels=getattr(results, 'labels', None))
+
+    @staticmethod
+    def _search_time(response: requests.Response, first_page: dict):
+        """
+        Returns the time of the server at which a search was answered, so that no extra request is needed
+
+        Args:
+            response (requests.Response): Response of the first page of the search
+            first_page (dict): Bundle of the first page
+
+        Returns:
+            str: FHIR instant in UTC, taken from the lastUpdated of the bundle or else from the Date header of the
+                 response. The time of the client is used if the server sends neither.
+        """
+        searched = parse_fhir_datetime(first_page.get('meta', {}).get('lastUpdated'))
+        if searched == datetime.datetime.min:
+            date = response.headers.get('Date')
+            searched = (email.utils.parsedate_to_datetime(date) if date else datetime.datetime.now(datetime.timezone.utc))
+            searched = searched.astimezone(datetime.timezone.utc)
+        return searched.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _iter_history(self, resource_type: str, since: str):
+        """
+        Iterates over the latest versions of all resources of a type that changed since a point in time
+
+        Args:
+            resource_type (str): The resource type (e.g. Patient)
+            since (str): FHIR instant
+
+        Returns:
+            Generator of (resource id, resource) tuples, the resource is None for deleted resources
+        """
+        r = self._get(resource_type + '/_history', session=self.session, _since=since)
+        if not self._check_status(r.status_code):
+            r.raise_for_status()
+
+        # The history contains the most recent versions first
+        seen = set()
+        for entry in self._iter_entries(r.json(), self.session):
+            resource = entry.get('resource')
+            if resource is None or entry.get('request', {}).get('method') == 'DELETE':
+                resource_id = self._reference_id(entry.get('request', {}).get('url') or entry.get('fullUrl', ''))
+                resource = None
+            else:
+                resource_id = resource['id']
+
+            if resource_id not in seen:
+                seen.add(resource_id)
+                yield resource_id, resource
+
+    def _latest_version(self, resource_type: str, resource_id: str):
+        """
+        Returns the latest version of a resource before it was deleted (e.g. to find its patient)
+
+        Args:
+            resource_type (str): The resource type (e.g. Condition)
+            resource_id (str): The resource identifier
+
+        Returns:
+            The json of the resource or None if the server keeps no version of it
+        """
+        r = self._get('{}/{}/_history'.format(resource_type, resource_id), session=self.session)
+        if not self._check_status(r.status_code):
+            r.raise_for_status()
+
+        for entry in self._iter_entries(r.json(), self.session):
+            if entry.get('resource') is not None and entry.get('request', {}).get('method') != 'DELETE':
+                return entry['resource']
+        return None
+
+    @staticmethod
+    def _match_query(cohort: Cohort):
+        """
+        Returns:
+            tuple: Resource type and query parameters of the resources that make patients match the search
+                   of the cohort (e.g. Condition and code), or (None, None) if the search is on the patients only
+        """
+        if cohort.path != 'Patient':
+            return cohort.path, {param: value for param, value in cohort.query_params.items() if param != '_include'}
+        for param, value in cohort.query_params.items():
+            if param.startswith('_has:'):
+                _, resource_type, _, search_param = param.split(':', 3)
+                return resource_type, {search_param: value}
+        return None, None
+
+    def _matching_patient_ids(self, resource_type: str, query_params: dict, patient_ids: list):
+        """
+        Searches which of the patients have a resource that matches the query (patient=id1,id2,...)
+
+        Returns:
+            set: The ids of the matching patients
+        """
+        matching = set()
+        for chunk in self._chunks(patient_ids):
+            r = self._search_response(resource_type, self._constructor(resource_type),
+                                      dict(patient=','.join(chunk), **query_params))
+            for entry in self._iter_entries(r.json(), self.session):
+                matching.add(self._reference_id(entry['resource'].get('subject', {}).get('reference', '')))
+        return matching
+
+    def sync(self, cohort: Cohort):
+        """
+        Applies the changes on the server since the cohort was retrieved (or last synchronized) to the cohort,
+        so that its cost depends on the number of changes instead of the size of the cohort:
+
+        * Patients with a searched resource (e.g. a condition of the code) that changed after the high-water
+          mark are added (as cases if the cohort has controls, controls among them become cases)
+        * Cases whose searched resources were changed or deleted since are searched again and removed
+          if none of their resources matches anymore (e.g. a condition that was recoded)
+        * Changed patients of the cohort are updated and deleted patients are removed (Patient/_history)
+        * The observations of patients with changed or deleted observations (Observation/_history) are
+          retrieved again on next access, and only their observation attributes are derived again
+
+        Args:
+            cohort (Cohort): Cohort returned by one of the get_patients_by_* methods
+
+        Returns:
+            Cohort: The updated cohort, which is the same object
+        """
+        since = cohort.last_updated
+        if since is None or cohort.path is None:
+            raise ValueError("Only cohorts returned by the get_patients_by_* methods can be synchronized, "
+                             "the cohort has no search or time of the server (last_updated)")
+        start = time.time()
+        patients = {patient.id: patient for patient in cohort}
+
+        # Patients that match the search since they (or the searched resources) changed. The time of this
+        # search is the new high-water mark, as the histories below are requested after it.
+        resource_type, match_params = self._match_query(cohort)
+        if resource_type is None:
+            path, query_params = cohort.path, dict(cohort.query_params)
+        else:
+            path, query_params = resource_type, dict(match_params, _include='{}:patient'.format(resource_type))
+        query_params['_lastUpdated'] = 'gt' + since
+
+        added = []
+        matched = set()
+        r = self._search_response(path, Patient, query_params)
+        first_page = r.json()
+        last_updated = self._search_time(r, first_page)
+        for patient in self._iter_collect(first_page, self.session, Patient):
+            matched.add(patient.id)
+            if patient.id not in patients:
+                patients[patient.id] = patient
+                added.append(patient)
+            elif not cohort.get_attribute(patient, 'case', True):
+                # A control that now matches the search is no longer a control
+                cohort.remove_labels(patient.id)
+            else:
+                continue
+            if cohort.controls:
+                cohort.set_label(patient, 'case', True)
+                cohort.set_label(patient, 'matched_case', patient.id)
+
+        # Cases whose searched resources changed or were deleted may no longer match the search.
+        # Deleted resources no longer refer to their patient, so their last version is looked up.
+        removed = set()
+        if resource_type is not None:
+            candidates = set()
+            for resource_id, resource in self._iter_history(resource_type, since):
+                if resource is None:
+                    resource = self._latest_version(resource_type, resource_id) or {}
+                patient_id = self._reference_id(resource.get('subject', {}).get('reference', ''))
+                if patient_id in patients and patient_id not in matched \
+                        and cohort.get_attribute(patients[patient_id], 'case', True):
+                    candidates.add(patient_id)
+            candidates = sorted(candidates)
+            removed = set(candidates) - self._matching_patient_ids(resource_type, match_params, candidates)
+
+        # Changed and deleted patients
+        for patient_id, resource in self._iter_history('Patient', since):
+            if patient_id in patients:
+                if resource is None:
+                    removed.add(patient_id)
+                    self.identity_map.remove('Patient', patient_id)
+                else:
+                    patients[patient_id].update_resource(resource)
+
+        # Patients with changed observations. Deleted observations no longer refer to their patient,
+        # so they are looked up in the observations of the cohort.
+        changed = dict()
+        observation_patients = None
+        for observation_id, resource in self._iter_history('Observation', since):
+            if resource is not None:
+                patient = patients.get(self._reference_id(resource.get('subject', {}).get('reference', '')))
+            else:
+                if observation_patients is None:
+                    observation_patients = {observation.id: patient for patient in cohort if patient.observations_loaded
+                                            for observation in patient.observations}
+                patient = observation_patients.get(observation_id)
+            if patient is not None and patient.observations_loaded:
+                changed[patient.id] = patient
+
+        for patient in changed.values():
+            patient.set_observations(None)
+
+        cohort[:] = [patient for patient in cohort + added if patient.id not in removed]
+        for patient_id in removed:
+            cohort.remove_labels(patient_id)
+        cohort.last_updated = last_updated
+
+        if self.logger and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Synchronized cohort in {:.2f} seconds: {} added, {} removed, {} with changed observations."
+                             .format(time.time() - start, len(added), len(removed), len(changed)))
+        return cohort
 
     def get_capability_statement(self):
         """
@@ -202,105 +949,229 @@ class FHIRClient():
         else:
             r.raise_for_status()
 
-    def get_all_patients(self, max_count=1000):
+    def _iter_search(self, path: str, constructor: Callable, map_results: bool=True, **query_params):
         """
-        Gets a all patients
+        Submits a search and yields the resulting objects page by page.
+        No further pages are requested once the generator is closed.
+
+        Args:
+            path (str): FHIR resource to be queried (e.g. Patient or Observation)
+            constructor (Callable): The constructor with which to construct the results
+            map_results (bool): Whether new objects are added to the identity map
+            **query_params: Dict of query parameters to build the query string
 
         Returns:
-            List of fhir_objects.Patient.patient
+            A generator of objects generated by the constructor. E.g. Patient objects.
+        """
+        r = self._search_response(path, constructor, query_params)
+        yield from self._iter_collect(r.json(), self.session, constructor, map_results)
+
+    def _search_response(self, path: str, constructor: Callable, query_params: dict):
+        """
+        Submits a search, without _elements if the server rejects it (see _project)
+
+        Args:
+            path (str): FHIR resource to be queried (e.g. Patient or Observation)
+            constructor (Callable): The constructor with which the results will be constructed
+            query_params (dict): Query parameters of the search
+
+        Returns:
+            The requests.Response of the first page
+        """
+        projected_params = self._project(path, constructor, query_params)
+        r = self._get(path, session=self.session, **projected_params)
+        fallback = None if self._check_status(r.status_code) else self._operation_failed(path, query_params,
+                                                                                          r.status_code)
+        if fallback is not None:
+            path, query_params = fallback
+            projected_params = self._project(path, constructor, query_params)
+            r = self._get(path, session=self.session, **projected_params)
+        if not self._check_status(r.status_code) and self._projection_failed(path, projected_params, r.status_code):
+            r = self._get(path, session=self.session, **query_params)
+        if not self._check_status(r.status_code):
+            r.raise_for_status()
+        return r
+
+    def _log_received(self, results: list, resource_name: str, start: float):
+        """
+        Logs the number of received resources and the time it took to receive them
         """
         if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
+            end = time.time()
+            logging.info("Received {} {} in {:.2f} seconds.".format(
+                len(results), resource_name, end - start))
 
-        r = self._get('Patient', session=self.session)
+    def iter_all_patients(self):
+        """
+        Iterates over all patients
 
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Patient)
+        Returns:
+            Generator of fhir_objects.Patient.patient
+        """
+        return self._iter_search('Patient', Patient, map_results=False)
 
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} patients in {:.2f} seconds.".format(
-                    len(results), end - start))
+    def iter_all_conditions(self):
+        """
+        Iterates over all conditions
 
-            return results
-        else:
-            r.raise_for_status()
+        Returns:
+            Generator of fhir_objects.Condition.condition
+        """
+        return self._iter_search('Condition', self._constructor('Condition'), map_results=False)
 
-    def get_all_conditions(self):
+    def iter_all_observations(self):
         """
-        Gets all conditions
+        Iterates over all observations
 
         Returns:
-            List of fhir_objects.Condition.condition
+            Generator of fhir_objects.Observation.observation
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
+        return self._iter_search('Observation', self._constructor('Observation'), map_results=False)
 
-        r = self._get('Condition', session=self.session)
+    def iter_all_procedures(self):
+        """
+        Iterates over all procedures
 
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Condition)
+        Returns:
+            Generator of fhir_objects.Procedure.procedure
+        """
+        return self._iter_search('Procedure', self._constructor('Procedure'), map_results=False)
 
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} conditions in {:.2f} seconds.".format(
-                    len(results), end - start))
+    @staticmethod
+    def _patients_by_code_query(resource_type: str, system: str, code: str):
+        """
+        Returns:
+            tuple: Path and query parameters of the search for patients with a resource (e.g. Condition) of a code
+        """
+        return 'Patient', {'_has:{}:patient:code'.format(resource_type): '{}|{}'.format(system, code)}
 
-            return results
-        else:
-            r.raise_for_status()
+    @staticmethod
+    def _patients_by_text_query(resource_type: str, text: str):
+        """
+        Returns:
+            tuple: Path and query parameters of the search for patients with a resource (e.g. Condition) of a text
+        """
+        return resource_type, {'code:text': text, '_include': '{}:patient'.format(resource_type)}
 
-    def get_all_observations(self):
+    def iter_patients_by_procedure_code(self, system: str, code: str):
         """
-        Gets all conditions
+        Iterates over all patients with procedure of a certain system code
+
+        Args:
+            system (str): System from which the code originates (e.g. 'http://snomed.info/sct')
+            code (str): Code (e.g. 73761001)
 
         Returns:
-            List of fhir_objects.Condition.condition
+            Generator of fhir_objects.Patient.patient
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
+        path, query_params = self._patients_by_code_query('Procedure', system, code)
+        return self._iter_search(path, Patient, map_results=False, **query_params)
 
-        r = self._get('Observation', session=self.session)
+    def iter_patients_by_procedure_text(self, text: str):
+        """
+        Iterates over all patients with procedure of a certain text (e.g. Colonoscopy)
 
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Observation)
+        Args:
+            text (str): Text of CodeableConcept.text, Coding.display, or Identifier.type.text.
 
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} observations in {:.2f} seconds.".format(
-                    len(results), end - start))
+        Returns:
+            Generator of fhir_objects.Patient.patient
+        """
+        path, query_params = self._patients_by_text_query('Procedure', text)
+        return self._iter_search(path, Patient, map_results=False, **query_params)
 
-            return results
-        else:
-            r.raise_for_status()
+    def iter_patients_by_condition_code(self, system: str, code: str):
+        """
+        Iterates over all patients with condition of a certain system code
 
-    def get_all_procedures(self):
+        Args:
+            system (str): System from which the code originates (e.g. 'http://snomed.info/sct')
+            code (str): Code (e.g. 195662009)
+
+        Returns:
+            Generator of fhir_objects.Patient.patient
+        """
+        path, query_params = self._patients_by_code_query('Condition', system, code)
+        return self._iter_search(path, Patient, map_results=False, **query_params)
+
+    def iter_patients_by_condition_text(self, text: str):
+        """
+        Iterates over all patients with condition of a certain text (e.g 'Acute viral pharyngitis')
+
+        Args:
+            text (str): Text of CodeableConcept.text, Coding.display, or Identifier.type.text.
+
+        Returns:
+            Generator of fhir_objects.Patient.patient
+        """
+        path, query_params = self._patients_by_text_query('Condition', text)
+        return self._iter_search(path, Patient, map_results=False, **query_params)
+
+    def iter_observation_by_patient(self, patient_id: str, codes: List[dict]=None, max_per_code: int=None):
+        """
+        Iterates over all observations for a given patient that is of status final, unknown, amended, corrected.
+
+        Args:
+            patient_id (str): The patient resource identifier. Several comma separated identifiers
+                              retrieve the observations of all of these patients.
+            codes (List[dict]): Dicts with system and code to retrieve only observations with these codes
+                                (e.g. [{'system': 'http://loinc.org', 'code': '39156-5'}])
+            max_per_code (int): Retrieve only the latest observations of every code with Observation/$lastn,
+                                if the server supports it
+
+        Returns:
+            Generator of fhir_objects.Observation.observation
+        """
+        path, query_params = self._observation_search(patient_id, codes, max_per_code)
+        return self._iter_search(path, self._constructor('Observation'), map_results=False, **query_params)
+
+    def get_all_patients(self, max_count=1000):
+        """
+        Gets a all patients
+
+        Returns:
+            List of fhir_objects.Patient.patient
+        """
+        start = time.time()
+        results = list(self._iter_search('Patient', Patient))
+        self._log_received(results, 'patients', start)
+        return results
+
+    def get_all_conditions(self):
         """
         Gets all conditions
 
         Returns:
             List of fhir_objects.Condition.condition
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
+        start = time.time()
+        results = list(self._iter_search('Condition', self._constructor('Condition')))
+        self._log_received(results, 'conditions', start)
+        return results
 
-        r = self._get('Procedure', session=self.session)
+    def get_all_observations(self):
+        """
+        Gets all observations
 
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(r.json(), self.session, Procedure)
+        Returns:
+            List of fhir_objects.Observation.observation
+        """
+        start = time.time()
+        results = list(self._iter_search('Observation', self._constructor('Observation')))
+        self._log_received(results, 'observations', start)
+        return results
 
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} procedures in {:.2f} seconds.".format(
-                    len(results), end - start))
+    def get_all_procedures(self):
+        """
+        Gets all procedures
 
-            return results
-        else:
-            r.raise_for_status()
+        Returns:
+            List of fhir_objects.Procedure.procedure
+        """
+        start = time.time()
+        results = list(self._iter_search('Procedure', self._constructor('Procedure')))
+        self._log_received(results, 'procedures', start)
+        return results
 
     def get_patients_by_procedure_code(self, system: str, code: str, controls=False):
         """
@@ -311,29 +1182,9 @@ class FHIRClient():
             code (str): Code (e.g. 73761001)
 
         Returns:
-            List of fhir_objects.Patient.patient
+            Cohort of fhir_objects.Patient.patient
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
-
-        r = self._get('Patient', session=self.session, **
-                      {'_has:Procedure:patient:code': '{}|{}'.format(system, code)})
-
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Patient)
-
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} patients in {:.2f} seconds.".format(
-                    len(results), end - start))
-            # If controls are to be returned, load them
-            if controls:
-                results = self.get_control_patients(results)
-
-            return results
-        else:
-            r.raise_for_status()
+        return self._get_cohort(*self._patients_by_code_query('Procedure', system, code), controls=controls)
 
     def get_patients_by_procedure_text(self, text: str, controls=False):
         """
@@ -343,29 +1194,9 @@ class FHIRClient():
             text (str): Text of CodeableConcept.text, Coding.display, or Identifier.type.text.
 
         Returns:
-            List of fhir_objects.Patient.patient
+            Cohort of fhir_objects.Patient.patient
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
-
-        r = self._get('Procedure', session=self.session, **
-                      {'code:text': text, '_include': 'Procedure:patient'})
-
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Patient)
-
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} patients in {:.2f} seconds.".format(
-                    len(results), end - start))
-            # If controls are to be returned, load them
-            if controls:
-                results = self.get_control_patients(results)
-
-            return results
-        else:
-            r.raise_for_status()
+        return self._get_cohort(*self._patients_by_text_query('Procedure', text), controls=controls)
 
     def get_patients_by_condition_code(self, system: str, code: str, controls=False):
         """
@@ -376,30 +1207,9 @@ class FHIRClient():
             code (str): Code (e.g. 195662009)
 
         Returns:
-            List of fhir_objects.Patient.patient
+            Cohort of fhir_objects.Patient.patient
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
-
-        r = self._get('Patient', session=self.session, **
-                      {'_has:Condition:patient:code': '{}|{}'.format(system, code)})
-
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Patient)
-
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} patients in {:.2f} seconds.".format(
-                    len(results), end - start))
-            # If controls are to be returned, load them
-            if controls:
-                results = self.get_control_patients(results)
-
-
-            return results
-        else:
-            r.raise_for_status()
+        return self._get_cohort(*self._patients_by_code_query('Condition', system, code), controls=controls)
 
     def get_patients_by_condition_text(self, text: str, controls=False):
         """
@@ -409,51 +1219,178 @@ class FHIRClient():
             text (str): Text of CodeableConcept.text, Coding.display, or Identifier.type.text.
 
         Returns:
-            List of fhir_objects.Patient.patient
+            Cohort of fhir_objects.Patient.patient
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
+        return self._get_cohort(*self._patients_by_text_query('Condition', text), controls=controls)
 
-        r = self._get('Condition', session=self.session, **
-                      {'code:text': text, '_include': 'Condition:patient'})
+    def get_observation_by_patient(self, patient_id: str, codes: List[dict]=None, max_per_code: int=None):
+        """
+        Gets all observations for a given patient that is of status final, unknown, amended, corrected.
 
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Patient)
+        Args:
+            patient_id (str): The patient resource identifier. Several comma separated identifiers
+                              retrieve the observations of all of these patients.
+            codes (List[dict]): Dicts with system and code to retrieve only observations with these codes
+            max_per_code (int): Retrieve only the latest observations of every code with Observation/$lastn,
+                                if the server supports it
+        """
+        start = time.time()
+        path, query_params = self._observation_search(patient_id, codes, max_per_code)
+        results = list(self._iter_search(path, self._constructor('Observation'), **query_params))
+        self._log_received(results, 'observations', start)
+        return results
+
+    def bulk_export(self, resource_types: List[str]=None, since: str=None, poll_interval: float=5.0,
+                    timeout: float=None):
+        """
+        Runs a FHIR Bulk Data export ($export): kicks off the export and polls its status
+        until the server has written the NDJSON files.
 
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} patients in {:.2f} seconds.".format(
-                    len(results), end - start))
-            # If controls are to be returned, load them
-            if controls:
-                results = self.get_control_patients(results)
-
-            return results
-        else:
+        Args:
+            resource_types (List[str]): Resource types to be exported (_type), all types if None
+            since (str): Only export resources updated after this instant (_since)
+            poll_interval (float): Seconds between status requests if the server sends no Retry-After header
+            timeout (float): Seconds after which to stop waiting for the export, None to wait forever
+
+        Returns:
+            list of dict: The output of the export, a dict with type and url per NDJSON file
+        """
+        r = self.session.get(self._build_url('$export', _type=','.join(resource_types or []), _since=since),
+                             headers={'Accept': 'application/fhir+json', 'Prefer': 'respond-async'})
+        if r.status_code != requests.codes.accepted:
             r.raise_for_status()
+            raise requests.HTTPError("Bulk data export was not accepted (status {})".format(r.status_code),
+                                     response=r)
+        status_url = r.headers['Content-Location']
+
+        start = time.time()
+        while True:
+            r = self.session.get(status_url, headers={'Accept': 'application/json'})
+            if self._check_status(r.status_code):
+                if self.logger and self.logger.isEnabledFor(logging.INFO):
+                    logging.info("Bulk data export completed in {:.2f} seconds.".format(time.time() - start))
+                return r.json().get('output', [])
+            if r.status_code != requests.codes.accepted:
+                r.raise_for_status()
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError("Bulk data export did not complete within {} seconds.".format(timeout))
+
+            retry_after = r.headers.get('Retry-After', '')
+            time.sleep(float(retry_after) if retry_after.isdigit() else poll_interval)
+
+    @staticmethod
+    def _put(resources: queue.Queue, item, stop: threading.Event):
+        """
+        Puts an item into a bounded queue unless the consumer has stopped
+        """
+        while not stop.is_set():
+            try:
+                resources.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
 
-    def get_observation_by_patient(self, patient_id: str):
+    def _stream_ndjson(self, url: str, resources: queue.Queue, stop: threading.Event):
         """
-        Gets all observations for a given patient that is of status final, unknown, amended, corrected.
+        Streams an NDJSON file line by line into a queue. Errors are put into the queue
+        and the end of the file is marked by None.
 
         Args:
-            patient_id (str): The patient resource identifier
+            url (str): Url of the NDJSON file
+            resources (queue.Queue): Queue for the parsed resources
+            stop (threading.Event): Set once the consumer has stopped
         """
-        if self.logger and self.logger.isEnabledFor(logging.INFO):
-            start = time.time()
+        try:
+            if stop.is_set():
+                return
+            with self.session.get(url, headers={'Accept': 'application/fhir+ndjson'}, stream=True) as r:
+                if not self._check_status(r.status_code):
+                    r.raise_for_status()
+                for line in r.iter_lines():
+                    if stop.is_set():
+                        return
+                    if line:
+                        self._put(resources, json.loads(line), stop)
+        except Exception as e:
+            self._put(resources, e, stop)
+        finally:
+            self._put(resources, None, stop)
+
+    def iter_bulk_export(self, resource_types: List[str]=None, since: str=None, max_workers: int=4,
+                         poll_interval: float=5.0, timeout: float=None, outputs: List[dict]=None,
+                         map_results: bool=False):
+        """
+        Iterates over the resources of a FHIR Bulk Data export. The NDJSON files are downloaded
+        in parallel and streamed line by line, so only a bounded number of resources is held in
+        memory. Closing the generator stops the downloads.
 
-        r = self._get('Observation', session=self.session,
-                      status='final,unknown,amended,corrected', patient=patient_id)
-        if self._check_status(r.status_code):
-            result = r.json()
-            results = self._collect(result, self.session, Observation)
+        Args:
+            resource_types (List[str]): Resource types to be exported (Patient, Condition, Observation, Procedure)
+            since (str): Only export resources updated after this instant (_since)
+            max_workers (int): Number of NDJSON files that are downloaded in parallel
+            poll_interval (float): Seconds between status requests if the server sends no Retry-After header
+            timeout (float): Seconds after which to stop waiting for the export, None to wait forever
+            outputs (List[dict]): Output of a completed export (see bulk_export) to be streamed instead of
+                                  starting a new export
+            map_results (bool): Whether the objects are added to the identity map of the client, e.g. because
+                                they are all kept. By default they are not, so that streamed objects can be freed.
 
-            if self.logger and self.logger.isEnabledFor(logging.INFO):
-                end = time.time()
-                logging.info("Received {} observations in {:.2f} seconds.".format(
-                    len(results), end - start))
+        Returns:
+            Generator of fhir_objects (e.g. Patient or Observation)
+        """
+        constructors = {resource_type: self._constructor(resource_type)
+                        for resource_type in ('Patient', 'Condition', 'Observation', 'Procedure')
+                        if not resource_types or resource_type in resource_types}
+
+        if outputs is None:
+            outputs = self.bulk_export(list(constructors.keys()), since=since, poll_interval=poll_interval,
+                                       timeout=timeout)
+        outputs = [output for output in outputs if output['type'] in constructors]
+
+        resources = queue.Queue(maxsize=1000)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        for output in outputs:
+            executor.submit(self._stream_ndjson, output['url'], resources, stop)
+
+        try:
+            remaining = len(outputs)
+            while remaining:
+                resource = resources.get()
+                if resource is None:
+                    remaining -= 1
+                elif isinstance(resource, Exception):
+                    raise resource
+                elif resource.get('resourceType') in constructors:
+                    yield self._construct_resource(resource, constructors[resource['resourceType']], map_results)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def get_bulk_export_patients(self, since: str=None, max_workers: int=4, poll_interval: float=5.0,
+                                 timeout: float=None):
+        """
+        Gets all patients together with their observations from a FHIR Bulk Data export,
+        so that no further searches are needed for their observations.
 
-            return results
-        else:
-            r.raise_for_status()
+        Args:
+            since (str): Only export resources updated after this instant (_since)
+            max_workers (int): Number of NDJSON files that are downloaded in parallel
+            poll_interval (float): Seconds between status requests if the server sends no Retry-After header
+            timeout (float): Seconds after which to stop waiting for the export, None to wait forever
+
+        Returns:
+            List of fhir_objects.Patient.patient
+        """
+        start = time.time()
+        patients = []
+        observations = []
+        for fhir_obj in self.iter_bulk_export(['Patient', 'Observation'], since=since, max_workers=max_workers,
+                                              poll_interval=poll_interval, timeout=timeout, map_results=True):
+            if isinstance(fhir_obj, Patient):
+                patients.append(fhir_obj)
+            else:
+                observations.append(fhir_obj)
+        self._assign_observations(patients, observations)
+        self._log_received(patients, 'patients', start)
+        return patients
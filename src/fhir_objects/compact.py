@@ -0,0 +1,120 @@
+import json
+
+from .fhir_resources import observation_resources, condition_resources, procedure_resources
+
+
+class _LazyValue():
+    """
+    Descriptor of a resource attribute. Nested values (dicts and lists) are stored as compact
+    JSON and parsed on first access. The parsed value replaces the JSON, so that it is parsed
+    only once and changes to it are kept. Primitive values are stored as they are.
+    """
+
+    def __init__(self, slot: str):
+        self.slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = getattr(instance, self.slot)
+        if type(value) is bytes:
+            value = json.loads(value)
+            setattr(instance, self.slot, value)
+        return value
+
+    def __set__(self, instance, value):
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, separators=(',', ':')).encode()
+        setattr(instance, self.slot, value)
+
+    def __delete__(self, instance):
+        delattr(instance, self.slot)
+
+
+def peek(fhir_object, attr: str, default=None):
+    """
+    Reads an attribute without keeping its parsed value. Nested values of compact objects are
+    parsed from their JSON each time, so values that are read only once (e.g. by the
+    ObservationFeatureEngine) do not take the memory of the parsed value afterwards.
+
+    Args:
+        fhir_object: A compact or a regular FHIR object
+        attr (str): The attribute (e.g. valueQuantity)
+        default: Returned if the object has no such attribute
+
+    Returns:
+        The value of the attribute
+    """
+    descriptor = getattr(type(fhir_object), attr, None)
+    if isinstance(descriptor, _LazyValue):
+        value = getattr(fhir_object, descriptor.slot, default)
+        return json.loads(value) if type(value) is bytes else value
+    return getattr(fhir_object, attr, default)
+
+
+class CompactFHIRObject():
+    """
+    Base class of the compact FHIR classes generated by compact_class. Instances have no
+    __dict__ and keep no reference to the client they were retrieved with.
+    """
+    __slots__ = ()
+
+    fhir_resources = []
+
+    def __init__(self, resource_dict: dict, fhir_client: object=None):
+        if resource_dict['resourceType'] != type(self).__name__:
+            raise ValueError("Can not generate a {} from {}".format(type(self).__name__,
+                                                                     resource_dict['resourceType']))
+        for resource in self.fhir_resources:
+            if resource in resource_dict:
+                setattr(self, resource, resource_dict[resource])
+
+    @property
+    def fhir_client(self):
+        return None
+
+
+def compact_class(resource_type: str, fhir_resources: list, base: type=CompactFHIRObject):
+    """
+    Generates a compact class for a FHIR resource, with one slot per attribute in fhir_resources
+
+    Args:
+        resource_type (str): The FHIR resource type, which is also the name of the class (e.g. Observation)
+        fhir_resources (list): The FHIR attributes to be stored (e.g. fhir_resources.observation_resources)
+        base (type): Base class, a subclass of CompactFHIRObject
+
+    Returns:
+        type: The generated class. Its qualified name is Compact<resource_type>, so that instances
+              can be pickled if the class is bound to that name in this module.
+    """
+    # The resource type is the same for all instances and is stored in the class
+    fhir_resources = [resource for resource in dict.fromkeys(fhir_resources) if resource != 'resourceType']
+    slots = tuple('_' + resource for resource in fhir_resources)
+
+    namespace = {'__slots__': slots, 'fhir_resources': fhir_resources, 'resourceType': resource_type,
+                 '__module__': __name__, '__qualname__': 'Compact' + resource_type,
+                 '__doc__': "Compact implementation of FHIR's {} resource.".format(resource_type)}
+    for resource, slot in zip(fhir_resources, slots):
+        namespace[resource] = _LazyValue(slot)
+    return type(resource_type, (base,), namespace)
+
+
+class _CompactObservationBase(CompactFHIRObject):
+    __slots__ = ()
+
+    def __lt__(self, other):
+        return (self.effectiveDateTime < other.effectiveDateTime)
+
+    def __le__(self, other):
+        return(self.effectiveDateTime <= other.effectiveDateTime)
+
+    def __gt__(self, other):
+        return(self.effectiveDateTime > other.effectiveDateTime)
+
+
+CompactObservation = compact_class('Observation', observation_resources, base=_CompactObservationBase)
+CompactCondition = compact_class('Condition', condition_resources)
+CompactProcedure = compact_class('Procedure', procedure_resources)
+
+# Compact classes by resource type
+compact_classes = {cls.__name__: cls for cls in (CompactObservation, CompactCondition, CompactProcedure)}
@@ -7,7 +7,21 @@ class FHIRBaseObject():
     """
     def __init__(self, resource_dict: dict, fhir_resources: list, fhir_client: object=None):
         self.fhir_client = fhir_client
+        self._fhir_resources = fhir_resources
 
         for resource in fhir_resources:
             if resource in resource_dict.keys():
                 setattr(self, resource, resource_dict[resource])
+
+    def update_resource(self, resource_dict: dict):
+        """
+        Replaces the FHIR attributes with those of another version of the resource
+
+        Args:
+            resource_dict (dict): The json of the resource
+        """
+        for resource in self._fhir_resources:
+            if resource in resource_dict.keys():
+                setattr(self, resource, resource_dict[resource])
+            else:
+                self.__dict__.pop(resource, None)
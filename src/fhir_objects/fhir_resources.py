@@ -3,7 +3,7 @@ Variables that define global properties of the module
 """
 
 patient_resources = ['identifier', 'resourceType', 'id', 'active', 'gender', 'name',
-                     'birthDate', 'deceased', 'deceased', 'maritalStatus']
+                     'birthDate', 'deceased', 'deceased', 'maritalStatus', 'meta']
 
 condition_resources = ['identifier', 'resourceType', 'id', 'clinicalStatus', 'verificationStatus', 'category',
                        'severity', 'code', 'subject', 'onset']
@@ -15,4 +15,11 @@ observation_resources = ['identifier', 'resourceType', 'id', 'status', 'category
 procedure_resources = ['identifier', 'resourceType', 'id', 'subject', 'status', 'notDone', 'notDoneReason', 'category', 'code',
                        'performed', 'reasonCode', 'bodySite', 'outcome', 'report', 'performedPeriod']
 
+# Choice elements (e.g. value[x]), whose attributes are named by element and type (e.g. valueQuantity)
+choice_elements = ['value', 'effective', 'performed', 'onset', 'deceased']
+
+# Attributes by resource type
+fhir_resources = {'Patient': patient_resources, 'Condition': condition_resources,
+                  'Observation': observation_resources, 'Procedure': procedure_resources}
+
 date_format = '%Y-%m-%d'
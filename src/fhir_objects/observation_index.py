@@ -0,0 +1,134 @@
+import datetime as dt
+import functools
+import heapq
+import re
+
+from .compact import peek
+
+# Matches FHIR dateTime values of all precisions, e.g. 2018, 2018-05, 2018-05-01 or 2018-05-01T10:00:00.000+02:00
+_datetime_pattern = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?'
+                               r'(Z|[+-]\d{2}:\d{2})?)?)?)?$')
+
+
+@functools.lru_cache(maxsize=2**16)
+def parse_fhir_datetime(value: str):
+    """
+    Parses a FHIR date or dateTime. Missing parts of partial dates default to the first
+    month or day and times with a timezone are converted to UTC.
+
+    Args:
+        value (str): The FHIR date or dateTime (e.g. 2018-05 or 2018-05-01T10:00:00+02:00)
+
+    Returns:
+        datetime.datetime: The naive UTC datetime, datetime.datetime.min if value is missing or invalid
+    """
+    match = _datetime_pattern.match(value) if isinstance(value, str) else None
+    if match is None:
+        return dt.datetime.min
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    parsed = dt.datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0),
+                         int(second or 0), int((fraction or '0')[:6].ljust(6, '0')))
+    if zone and zone != 'Z':
+        offset = dt.timedelta(hours=int(zone[1:3]), minutes=int(zone[4:6]))
+        parsed = parsed - offset if zone[0] == '+' else parsed + offset
+    return parsed
+
+
+def get_coding_key(observation):
+    """
+    Returns the (system, code) tuple of the first coding of an observation that defines
+    both a system and a code
+
+    Args:
+        observation (Observation): The observation
+
+    Returns:
+        tuple: (system, code) or None if no coding defines both
+    """
+    for code in peek(observation, 'code', {}).get('coding', []):
+        if 'system' in code and 'code' in code:
+            return code['system'], code['code']
+    return None
+
+
+class ObservationIndex():
+    """
+    Index of the observations of one patient by their (system, code). The observations of
+    every code are sorted by their parsed effectiveDateTime, observations with the same
+    effectiveDateTime keep their original order.
+
+    Args:
+        observations (list): List of fhir_objects.Observation
+
+    Attributes:
+        observations (list): The indexed observations in their original order
+    """
+
+    def __init__(self, observations: list):
+        self.observations = observations
+
+        self._entries = dict()
+        for position, observation in enumerate(observations):
+            key = get_coding_key(observation)
+            if key is not None:
+                timestamp = parse_fhir_datetime(getattr(observation, 'effectiveDateTime', None))
+                self._entries.setdefault(key, []).append((timestamp, position, observation))
+        for entries in self._entries.values():
+            entries.sort(key=lambda entry: entry[:2])
+
+    def __contains__(self, key: tuple):
+        return key in self._entries
+
+    def keys(self):
+        """
+        Returns:
+            The (system, code) tuples of all indexed observations
+        """
+        return self._entries.keys()
+
+    def _get_entries(self, codes: list):
+        keys = [(code['system'], code['code']) for code in codes]
+        entries = [self._entries[key] for key in keys if key in self._entries]
+        if len(entries) == 1:
+            return entries[0]
+        return list(heapq.merge(*entries, key=lambda entry: entry[:2]))
+
+    def get(self, codes: list):
+        """
+        Args:
+            codes (list): Dicts with system and code (e.g. [{'system': 'http://loinc.org', 'code': '39156-5'}])
+
+        Returns:
+            list: Observations with one of the codes, sorted by effectiveDateTime
+        """
+        return [entry[2] for entry in self._get_entries(codes)]
+
+    def latest(self, codes: list):
+        """
+        Args:
+            codes (list): Dicts with system and code
+
+        Returns:
+            Observation: The observation with one of the codes and the latest effectiveDateTime, the first
+                         of them if several share it. None if there is no such observation.
+        """
+        entries = self._get_entries(codes)
+        if not entries:
+            return None
+        first = len(entries) - 1
+        while first > 0 and entries[first - 1][0] == entries[-1][0]:
+            first -= 1
+        return entries[first][2]
+
+    def earliest(self, codes: list):
+        """
+        Args:
+            codes (list): Dicts with system and code
+
+        Returns:
+            Observation: The first observation with one of the codes and the earliest effectiveDateTime,
+                         None if there is no such observation.
+        """
+        entries = self._get_entries(codes)
+        return entries[0][2] if entries else None
@@ -1,5 +1,6 @@
 from .fhir_resources import patient_resources, date_format
 from .fhir_base_object import FHIRBaseObject
+from .observation_index import ObservationIndex
 
 import datetime as dt
 import logging
@@ -9,8 +10,13 @@ class Patient(FHIRBaseObject):
     """
     Class that implements FHIR's patient resource.
 
+    Observations are retrieved on first access of the observations attribute
+    (or in bulk for a cohort with FHIRClient.load_observations). Attributes
+    derived from observations (e.g. bmiLatest) are computed on first access
+    by their respective observation processor only.
+
     Attributes:
-         All FHIR attributes specified in patient_resources 
+         All FHIR attributes specified in patient_resources
     """
 
     def __init__(self, **kwargs):
@@ -19,23 +25,124 @@ class Patient(FHIRBaseObject):
             raise ValueError("Can not generate a Patient from {}".format(
                 resource_dict['resourceType']))
 
+        observations = kwargs.pop('observations', None)
+
         kwargs['fhir_resources'] = patient_resources
         super().__init__(**kwargs)
 
-        # Retrieve all observations for the patient
-        self.observations = self.fhir_client.get_observation_by_patient(
-            self.id)
+        # None until the observations are retrieved
+        self._observations = observations
+        self._observation_index = None
 
-        self._process_observations()
+        # Codes and number per code the observations were retrieved with, None for all observations
+        self._observation_filter = None
 
-    def _process_observations(self):
+        # Incremented whenever the observations are replaced
+        self._observations_revision = 0
+
+    def __getattr__(self, name: str):
+        """
+        Derives observation attributes (e.g. bmiLatest) on first access.
+        Only called if the attribute has not been set yet.
         """
-        Sets observations as patient attributes
+        if name.startswith('_') or 'fhir_client' not in self.__dict__ or self.fhir_client is None:
+            raise AttributeError("'Patient' object has no attribute '{}'".format(name))
+
+        processor = self.fhir_client._preprocessor.get_observation_processor(name)
+        if processor is None:
+            raise AttributeError("'Patient' object has no attribute '{}'".format(name))
+
+        attribute, value = processor().fit(self.observations).transform_index(self.observation_index)
+        setattr(self, attribute, value)
+        return value
+
+    @property
+    def observations(self):
+        """
+        list: Observations of the patient, retrieved from the server on first access. Unless disabled with
+        the filter_observations option of the client, only the observations needed by the observation
+        processors are retrieved if all processors declare their codes. They are retrieved again if
+        processors that need other observations are registered later.
+
+        Accessing it retrieves the observations of this patient only, i.e. one search per patient. Load the
+        observations of a cohort beforehand with load_observations to retrieve them in bulk.
+        """
+        if not self.observations_loaded:
+            self.fhir_client._load_observations([self])
+        return self._observations
+
+    @observations.setter
+    def observations(self, observations: list):
+        self.set_observations(observations)
+
+    @property
+    def observation_index(self):
+        """ObservationIndex: Observations of the patient by code, built on first access"""
+        if self._observation_index is None:
+            self._observation_index = ObservationIndex(self.observations)
+        return self._observation_index
+
+    @property
+    def observations_loaded(self):
+        """bool: Whether the observations needed by the observation processors of the client have been retrieved"""
+        if self._observations is None:
+            return False
+        return self._observation_filter is None or self.fhir_client is None or \
+            self.fhir_client._observation_filter_covers(self._observation_filter)
+
+    @staticmethod
+    def load_observations(patients: list):
+        """
+        Loads the observations of all patients that have not been retrieved yet in bulk,
+        with one FHIRClient.load_observations call per client the patients were retrieved with
+
+        Args:
+            patients (list): List of Patient
+        """
+        pending = dict()
+        for patient in patients:
+            if patient.fhir_client is not None and not patient.observations_loaded:
+                pending.setdefault(id(patient.fhir_client), (patient.fhir_client, []))[1].append(patient)
+
+        for fhir_client, client_patients in pending.values():
+            fhir_client._load_observations(client_patients)
+
+    @staticmethod
+    def release(patients: list):
+        """
+        Releases patients that are no longer needed, e.g. a processed chunk of a stream: they are
+        removed from the identity map of their client together with their observations, which are
+        retrieved again on next access
+
+        Args:
+            patients (list): List of Patient
+        """
+        for patient in patients:
+            if patient.fhir_client is None:
+                continue
+            identity_map = patient.fhir_client.identity_map
+            identity_map.remove('Patient', patient.id)
+            for observation in patient._observations or []:
+                identity_map.remove('Observation', getattr(observation, 'id', None))
+            patient.set_observations(None)
+
+    def set_observations(self, observations: list, observation_filter: tuple=None):
+        """
+        Sets the observations of the patient and discards attributes derived from previous observations
+
+        Args:
+            observations (list): List of fhir_objects.Observation of this patient,
+                                 None to retrieve them from the server again on next access
+            observation_filter (tuple): Codes and number of latest observations per code the observations were
+                                        retrieved with (see FHIRClient._observation_filter), None for all observations
         """
-        for preprocessor in self.fhir_client._preprocessor.get_observation_preprocessors():
-            attribute, value = preprocessor().fit(
-                self.observations).transform(self.observations)
-            setattr(self, attribute, value)
+        self._observations = observations
+        self._observation_filter = observation_filter
+        self._observation_index = None
+        self._observations_revision += 1
+        if self.fhir_client is not None:
+            for attribute in self.fhir_client._preprocessor.get_observation_attributes():
+                self.__dict__.pop(attribute, None)
 
     def __str__(self):
         if hasattr(self, 'name'):
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import List
+
+
+class IdentityMap():
+    """
+    Maps resource type and id to the fhir object that was constructed for it, so that
+    a resource that is returned several times (e.g. by _include searches or in a case
+    and a later control query) is constructed and enriched only once.
+
+    Note that objects are shared between all results of a client. Attributes that depend
+    on a cohort (e.g. case) are therefore kept in the Cohort instead of the objects.
+
+    Args:
+        max_size (int): Maximum number of mapped objects. The least recently used objects are
+                        dropped first. None for no limit.
+        resource_types (List[str]): Resource types to be mapped (e.g. ['Patient']). None for all types.
+    """
+
+    def __init__(self, max_size: int=None, resource_types: List[str]=None):
+        self.max_size = max_size
+        self.resource_types = resource_types
+        self._objects = OrderedDict()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, key: tuple):
+        return key in self._objects
+
+    def maps(self, resource_type: str):
+        """
+        Returns:
+            bool: Whether objects of the resource type are mapped
+        """
+        return self.resource_types is None or resource_type in self.resource_types
+
+    def get(self, resource_type: str, resource_id: str):
+        """
+        Returns:
+            The object mapped to the resource or None
+        """
+        key = (resource_type, resource_id)
+        fhir_obj = self._objects.get(key)
+        if fhir_obj is not None:
+            self._objects.move_to_end(key)
+        return fhir_obj
+
+    def add(self, resource_type: str, resource_id: str, fhir_obj: object):
+        """
+        Maps a resource to its object
+        """
+        if not self.maps(resource_type):
+            return
+        key = (resource_type, resource_id)
+        self._objects[key] = fhir_obj
+        self._objects.move_to_end(key)
+        if self.max_size is not None:
+            while len(self._objects) > self.max_size:
+                self._objects.popitem(last=False)
+
+    def remove(self, resource_type: str, resource_id: str):
+        """
+        Removes the mapping of a resource if it exists
+        """
+        self._objects.pop((resource_type, resource_id), None)
+
+    def clear(self):
+        """
+        Removes all mappings
+        """
+        self._objects.clear()
@@ -1,17 +1,25 @@
+import json
+import os
 import sys
-from typing import List, Union, Callable
+from typing import Iterable, List, Union, Callable
 from importlib import import_module
 import logging
 import numpy as np
+import joblib
 
 from fhir_objects.patient import Patient
-from preprocessing import Preprocessing
+from preprocessing import Preprocessing, ObservationFeatureEngine, FHIRColumnTransformer, typed_column
+from feature_store import CohortFeatureStore, iter_chunks
+from cohort import get_attribute
 
 from sklearn.base import BaseEstimator, ClassifierMixin, ClusterMixin
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import SGDClassifier
+from sklearn.exceptions import NotFittedError
+import sklearn.model_selection as model_selection
+from sklearn.utils import check_random_state
 from sklearn.utils.validation import column_or_1d
 from sklearn.utils.multiclass import type_of_target
 import sklearn.metrics as m
@@ -34,6 +42,14 @@ class MLOnFHIR(BaseEstimator):
                              (e.g preprocessing.PatientBirthdateProcessor)
     """
 
+    # Files of a saved model, see save
+    model_file = 'model.json'
+    transformers_file = 'transformers.joblib'
+    estimator_file = 'estimator.joblib'
+
+    # Attribute of the fitted sklearn estimator
+    _estimator_attr = None
+
     def __init__(self, fhir_class: Union[Patient], feature_attrs: List[str], label_attrs: List[str] = [], random_state = 42, preprocessor: Preprocessing=None):
         self.fhir_class = fhir_class
         self.preprocessor = preprocessor
@@ -41,6 +57,12 @@ class MLOnFHIR(BaseEstimator):
         self.feature_attrs = feature_attrs
         self.transformers = (feature_attrs, label_attrs)
         self.random_state = random_state
+
+        # Memoized preprocessing, see _fit_transform
+        self.column_transformer = None
+        self._observation_rows = dict()
+        self._observation_rows_key = None
+        self._transformed = None
         # The easiest way to initiate sklearn random state globally is to set the np.random.seed(), although this might not be stable for
         # multithreading situations (https://stackoverflow.com/questions/31057197/should-i-use-random-seed-or-numpy-random-seed-to-control-random-number-gener)
         if self.random_state is not None:
@@ -146,33 +168,467 @@ class MLOnFHIR(BaseEstimator):
         """
         return ''.join([class_name.capitalize(), fhir_attr, "Processor"])
 
-    def _get_data_matrix(self, data: List[Union[Patient]]):
+    def _get_data_matrix(self, data: Union[List[Union[Patient]], CohortFeatureStore], attrs: List[str]=None,
+                         memoize: bool=True):
+        """
+        Transform the list of fhir objects into typed columns of their attributes. The dtype of
+        every column is the dtype declared by the transformer of the attribute.
+
+        Args:
+            data (list):    A list of fhir objects (e.g. Patient) or a CohortFeatureStore
+            attrs (list):   The fhir attributes to extract, defaults to all features and labels
+            memoize (bool): Whether observation attributes are kept for later cohorts (see _observation_columns)
+
+        Returns:
+            dict: Maps every fhir attribute to an array with one value per fhir object of the input
+        """
+        attrs = self.feature_attrs + self.label_attrs if attrs is None else attrs
+        dtypes = {fhir_attr: np.dtype(getattr(self.transformers[fhir_attr], 'dtype', object)) for fhir_attr in attrs}
+
+        if isinstance(data, CohortFeatureStore):
+            missing = [fhir_attr for fhir_attr in attrs if fhir_attr not in data]
+            if missing:
+                raise ValueError("The store has no columns {}. Labels of a cohort are only stored if the store is "
+                                 "built from the Cohort.".format(', '.join(missing)))
+            # Columns of the right kind (e.g. memory mapped floats) are used without copy
+            return {fhir_attr: data[fhir_attr] if data[fhir_attr].dtype.kind == dtypes[fhir_attr].kind
+                    else data[fhir_attr].astype(dtypes[fhir_attr]) for fhir_attr in attrs}
+
+        self._load_observations(data)
+
+        observation_attrs = [fhir_attr for fhir_attr in attrs if self.preprocessor.get_observation_processor(fhir_attr)]
+        if memoize:
+            observation_columns = self._observation_columns(data, observation_attrs)
+        elif observation_attrs:
+            observation_columns = ObservationFeatureEngine(self.preprocessor).transform(data, observation_attrs)
+        else:
+            observation_columns = dict()
+
+        data_matrix = dict()
+        for fhir_attr in attrs:
+            if fhir_attr in observation_columns:
+                values = observation_columns[fhir_attr]
+            elif fhir_attr in self.label_attrs:
+                values = self._label_values(data, fhir_attr)
+            else:
+                values = (get_attribute(data, fhir_obj, fhir_attr) for fhir_obj in data)
+            data_matrix[fhir_attr] = typed_column(values, dtypes[fhir_attr], len(data))
+        return data_matrix
+
+    @staticmethod
+    def _label_values(data: List[Union[Patient]], fhir_attr: str):
+        """
+        Returns:
+            list: The label of every fhir object
+
+        Raises:
+            ValueError: If an object has no such label, instead of training on a default value
+        """
+        values = [get_attribute(data, fhir_obj, fhir_attr) for fhir_obj in data]
+        missing = [getattr(fhir_obj, 'id', None) for fhir_obj, value in zip(data, values) if value is None]
+        if missing:
+            raise ValueError("The label {} is missing for {} of {} objects (e.g. {}). Labels of a cohort (e.g. case) "
+                             "are kept in the Cohort, pass the Cohort or a slice of it instead of a list or a "
+                             "generator of its patients.".format(fhir_attr, len(missing), len(values), missing[0]))
+        return values
+
+    @staticmethod
+    def _resource_key(fhir_obj):
+        """
+        Returns:
+            tuple: Identifies a fhir object by its resource type, id, version and the revision of its observations
+        """
+        return (type(fhir_obj).__name__, getattr(fhir_obj, 'id', None),
+                getattr(fhir_obj, 'meta', {}).get('versionId'), getattr(fhir_obj, '_observations_revision', None))
+
+    def _processor_key(self, fhir_attr: str):
         """
-        Transform the list of fhir objects into a list of their attributes
+        Returns:
+            tuple: Identifies the observation processor that derives a fhir attribute by its class and the
+                   declaration of its observations, None if the attribute is not derived from observations
+        """
+        processor = self.preprocessor.get_observation_processor(fhir_attr)
+        if processor is None:
+            return None
+        return processor, joblib.hash([getattr(processor, declared, None)
+                                       for declared in ['codes', 'reduction', 'default_value']])
+
+    def _observation_columns(self, data: List[Union[Patient]], observation_attrs: List[str]):
+        """
+        Computes observation attributes for all objects at once. The values of the objects of the last
+        cohort are kept, so that they are only computed for objects that were not part of it
+        (e.g. the patients added to a cohort by sync).
+
+        Args:
+            data (list):                A list of fhir objects (e.g. Patient)
+            observation_attrs (list):   Observation attributes to be computed (e.g. bmiLatest)
+
+        Returns:
+            dict: Maps every attribute to a list of one value per object
+        """
+        if not observation_attrs:
+            return dict()
+
+        rows_key = [(fhir_attr, self._processor_key(fhir_attr)) for fhir_attr in observation_attrs]
+        if rows_key != self._observation_rows_key:
+            self._observation_rows = dict()
+            self._observation_rows_key = rows_key
+
+        keys = [self._resource_key(fhir_obj) for fhir_obj in data]
+        missing = list({key: fhir_obj for key, fhir_obj in zip(keys, data) if key not in self._observation_rows}.items())
+        if missing:
+            logging.info("Computing observation attributes of {} new objects".format(len(missing)))
+            columns = ObservationFeatureEngine(self.preprocessor).transform(
+                [fhir_obj for _, fhir_obj in missing], observation_attrs)
+            for idx, (key, _) in enumerate(missing):
+                self._observation_rows[key] = tuple(columns[fhir_attr][idx] for fhir_attr in observation_attrs)
+
+        rows = [self._observation_rows[key] for key in keys]
+        # Rows of objects that left the cohort or changed are dropped, so the memo stays the size of one cohort
+        self._observation_rows = dict(zip(keys, rows))
+        return {fhir_attr: [row[idx] for row in rows] for idx, fhir_attr in enumerate(observation_attrs)}
+
+    def _fit_transform(self, data: Union[List[Union[Patient]], CohortFeatureStore]):
+        """
+        Fits the preprocessing pipeline on a cohort and transforms it. The result is memoized by the
+        cohort (its resource ids, versions and attribute values), the attributes, the transformers
+        with their parameters and the observation processors, so that fitting several estimators on
+        the same cohort preprocesses it only once.
+
+        Args:
+            data (list):    A list of fhir objects (e.g. Patient) or a CohortFeatureStore
+
+        Returns:
+            np.ndarray: The preprocessed features and labels
+        """
+        attrs = self.feature_attrs + self.label_attrs
+        transformers_key = [(fhir_attr, id(self.transformers[fhir_attr]), joblib.hash(self.transformers[fhir_attr].get_params()),
+                             self._processor_key(fhir_attr)) for fhir_attr in attrs]
+
+        # Stores are compared by identity, lists of fhir objects by their contents
+        if isinstance(data, CohortFeatureStore):
+            cohort_key = data
+        else:
+            self._load_observations(data)
+            plain_attrs = [fhir_attr for fhir_attr in attrs if not self.preprocessor.get_observation_processor(fhir_attr)]
+            cohort_key = [self._resource_key(fhir_obj) + tuple(get_attribute(data, fhir_obj, fhir_attr) for fhir_attr in plain_attrs)
+                          for fhir_obj in data]
+
+        if self._transformed is not None:
+            cached_transformers_key, cached_cohort_key, column_transformer, complete_data_matrix = self._transformed
+            if cached_transformers_key == transformers_key and (
+                    cached_cohort_key is cohort_key if isinstance(data, CohortFeatureStore)
+                    else cached_cohort_key == cohort_key):
+                logging.info("Using preprocessed data")
+                self.column_transformer = column_transformer
+                return complete_data_matrix
+
+        # Get typed columns of the fhir attrs of the patients
+        logging.info("Extracting attributes from data set")
+        data_matrix = self._get_data_matrix(data)
+
+        # Generate feature and label preprocessing pipeline
+        pipeline = self._generate_pipeline()
+        ct = FHIRColumnTransformer(pipeline)
+
+        logging.info("Preprocessing data")
+        complete_data_matrix = ct.fit_transform(data_matrix)
+
+        self.column_transformer = ct
+        self._transformed = (transformers_key, cohort_key, ct, complete_data_matrix)
+        return complete_data_matrix
+
+    def _load_observations(self, data: List[Union[Patient]]):
+        """
+        Observations are retrieved lazily by the fhir objects. If observation attributes
+        are used, the observations of all objects are loaded in bulk beforehand.
 
         Args:
             data (list):    A list of fhir objects (e.g. Patient)
+        """
+        if not any(self.preprocessor.get_observation_processor(fhir_attr)
+                   for fhir_attr in self.feature_attrs + self.label_attrs):
+            return
+
+        self.fhir_class.load_observations(data)
+
+    def _split_data_matrix(self, complete_data_matrix: np.ndarray):
+        """
+        Returns:
+            (np.ndarray, np.ndarray): Features and labels of a preprocessed data matrix, labels are None
+                                      if there are no label attributes
+        """
+        X = complete_data_matrix[:, :len(self.feature_attrs)]
+        if not self.label_attrs:
+            return X, None
+        return X, column_or_1d(complete_data_matrix[:, len(self.feature_attrs):])
+
+    def _get_groups(self, data: Union[List[Union[Patient]], CohortFeatureStore], groups):
+        """
+        Args:
+            data (list):    A list of fhir objects (e.g. Patient) or a CohortFeatureStore
+            groups:         A fhir attribute (e.g. matched_case) or one group per fhir object
+
+        Returns:
+            array-like: One group per fhir object. Objects without the attribute form their own group.
+        """
+        if not isinstance(groups, str):
+            return groups
+        if isinstance(data, CohortFeatureStore):
+            if groups not in data:
+                raise ValueError("The store has no column {} to group by".format(groups))
+            return np.where(data[groups].astype(str) == '', data['id'], data[groups].astype(str))
+        return np.array([str(get_attribute(data, fhir_obj, groups) or fhir_obj.id) for fhir_obj in data])
+
+    def _prepare_validation(self, data: Union[List[Union[Patient]], CohortFeatureStore], cv, groups):
+        complete_data_matrix = self._fit_transform(data)
+        X, y = self._split_data_matrix(complete_data_matrix)
+        groups = self._get_groups(data, groups)
+        # Integer folds ignore groups in sklearn, so they are split with GroupKFold instead
+        if groups is not None and isinstance(cv, int):
+            cv = model_selection.GroupKFold(cv)
+        return X, y, groups, cv
+
+    def cross_validate(self, data: Union[List[Union[Patient]], CohortFeatureStore], estimator: BaseEstimator,
+                       cv=5, scoring=None, groups=None, n_jobs: int=None, **cv_params):
+        """
+        Cross-validates an estimator on a cohort. The cohort is extracted and preprocessed once (see
+        _fit_transform) and the folds are fitted in parallel with joblib, which memory maps large
+        matrices so that the workers share them instead of receiving copies.
+
+        Args:
+            data (list):                A list of fhir objects (e.g. Patient) or a CohortFeatureStore
+            estimator (BaseEstimator):  Instance of a sklearn estimator, cloned for every fold
+            cv:                         Number of folds or a sklearn cross-validation splitter
+            scoring:                    Scoring of sklearn.model_selection.cross_validate, defaults to the score
+                                        method of the estimator
+            groups:                     A fhir attribute (e.g. matched_case to keep cases and their controls in
+                                        the same fold) or one group per fhir object
+            n_jobs (int):               Number of folds fitted in parallel, -1 for all cores
+            cv_params:                  Further arguments of sklearn.model_selection.cross_validate
+
+        Returns:
+            dict: The scores and times of every fold (see sklearn.model_selection.cross_validate)
+        """
+        X, y, groups, cv = self._prepare_validation(data, cv, groups)
+        logging.info("Cross-validating {} on {} objects".format(type(estimator).__name__, len(X)))
+        return model_selection.cross_validate(estimator, X, y, groups=groups, cv=cv, scoring=scoring,
+                                              n_jobs=n_jobs, **cv_params)
+
+    def search(self, data: Union[List[Union[Patient]], CohortFeatureStore], estimator: BaseEstimator,
+               param_grid: Union[dict, list], cv=5, scoring=None, groups=None, n_jobs: int=None, n_iter: int=None,
+               **search_params):
+        """
+        Searches the hyperparameters of an estimator with cross-validation. The cohort is extracted and
+        preprocessed once and all candidates and folds are fitted in parallel with joblib.
+
+        Args:
+            data (list):                A list of fhir objects (e.g. Patient) or a CohortFeatureStore
+            estimator (BaseEstimator):  Instance of a sklearn estimator
+            param_grid (dict):          Parameter names mapped to the values to try (or distributions if n_iter is set)
+            cv:                         Number of folds or a sklearn cross-validation splitter
+            scoring:                    Scoring of the candidates, defaults to the score method of the estimator
+            groups:                     A fhir attribute (e.g. matched_case) or one group per fhir object
+            n_jobs (int):               Number of fits run in parallel, -1 for all cores
+            n_iter (int):               Number of sampled candidates, None to try all combinations of param_grid
+            search_params:              Further arguments of sklearn's GridSearchCV or RandomizedSearchCV
+
+        Returns:
+            BaseSearchCV: The fitted search, e.g. with best_params_ and best_estimator_
+        """
+        X, y, groups, cv = self._prepare_validation(data, cv, groups)
+        if n_iter is None:
+            search = model_selection.GridSearchCV(estimator, param_grid, cv=cv, scoring=scoring, n_jobs=n_jobs,
+                                                  **search_params)
+        else:
+            search = model_selection.RandomizedSearchCV(estimator, param_grid, n_iter=n_iter, cv=cv, scoring=scoring,
+                                                        n_jobs=n_jobs, random_state=self.random_state, **search_params)
+        logging.info("Searching parameters of {} on {} objects".format(type(estimator).__name__, len(X)))
+        return search.fit(X, y, groups=groups)
+
+    def _partial_fit(self, data: List[Union[Patient]], estimator: BaseEstimator, **partial_fit_params):
+        """
+        Fits the preprocessing pipeline and the estimator incrementally on one chunk of fhir objects.
+        Nothing but the fitted transformers and the estimator is kept between chunks.
+
+        Args:
+            data (list):                A chunk of fhir objects (e.g. Patient)
+            estimator (BaseEstimator):  Instance of a sklearn estimator with partial_fit (e.g. SGDClassifier)
+            partial_fit_params:         Further arguments of the partial_fit method of the estimator
+        """
+        if not hasattr(estimator, 'partial_fit'):
+            raise ValueError("{} does not support incremental training with partial_fit".format(type(estimator).__name__))
+        if self.column_transformer is None:
+            self.column_transformer = FHIRColumnTransformer(self._generate_pipeline())
+
+        self._load_observations(data)
+        complete_data_matrix = self.column_transformer.partial_fit_transform(self._get_data_matrix(data, memoize=False))
+        X, y = self._split_data_matrix(complete_data_matrix)
+        estimator.partial_fit(X, y, **partial_fit_params)
+
+    def _fit_stream(self, patients: Iterable[Patient], estimator: BaseEstimator, chunk_size: int, release: bool,
+                    **partial_fit_params):
+        # A stream starts with new transformers instead of the ones of a previous fit
+        self.column_transformer = None
+        self._transformed = None
+        n_patients = 0
+        for chunk in iter_chunks(patients, chunk_size):
+            self._partial_fit(chunk, estimator, **partial_fit_params)
+            n_patients += len(chunk)
+            if release:
+                self.fhir_class.release(chunk)
+        logging.info("Trained {} on {} objects".format(type(estimator).__name__, n_patients))
+        return estimator
+
+    def _iter_features(self, patients: Iterable[Patient], chunk_size: int, release: bool=False):
+        """
+        Preprocesses the features of patients with the fitted preprocessing pipeline, one chunk
+        of patients at a time. Nothing is refitted.
+
+        Args:
+            patients (Iterable[Patient]): A list or a generator of fhir objects (e.g. Patient)
+            chunk_size (int): Number of patients that are preprocessed at once
+            release (bool): Whether the patients of a chunk are released once it is processed (see Patient.release)
 
         Returns:
-            list: A list of fhir attribute dictionaries for fhir object of the input
+            generator: The feature matrix of every chunk
         """
-        return [[getattr(fhir_obj, fhir_attr)
-                 for fhir_attr in self.feature_attrs + self.label_attrs] for fhir_obj in data]
+        if self.column_transformer is None:
+            raise NotFittedError("{} is not fitted yet. Call fit before predicting patients".format(type(self).__name__))
+
+        for chunk in iter_chunks(patients, chunk_size):
+            self._load_observations(chunk)
+            data_matrix = self._get_data_matrix(chunk, self.feature_attrs, memoize=False)
+            yield self.column_transformer.transform(data_matrix, columns=self.feature_attrs)
+            if release:
+                self.fhir_class.release(chunk)
+
+    def _predict_patients(self, predict: Callable, patients: Iterable[Patient], chunk_size: int, release: bool):
+        predictions = [predict(X) for X in self._iter_features(patients, chunk_size, release)]
+        return np.concatenate(predictions) if predictions else np.empty(0)
+
+    def predict_patients(self, patients: Iterable[Patient], chunk_size: int=1000, release: bool=False):
+        """
+        Predicts patients that were not part of the training data
+
+        Args:
+            patients (Iterable[Patient]): A list or a generator of fhir objects (e.g. Patient)
+            chunk_size (int): Number of patients that are preprocessed and predicted at once
+            release (bool): Whether the patients of a chunk are released from the identity map of their client
+                            with their observations once it is predicted (see Patient.release). Only for patients
+                            that are not used afterwards, e.g. from a generator over a get_* result.
+
+        Returns:
+            np.ndarray: One prediction per patient
+        """
+        return self._predict_patients(self.predict, patients, chunk_size, release)
+
+    def inverse_transform_labels(self, y):
+        """
+        Maps encoded labels (e.g. predictions or the classes of the estimator) back to the values of the
+        label attribute, e.g. True/False for case. Labels are returned unchanged if there is no label
+        attribute or its processor has no inverse_transform.
+
+        Args:
+            y (array-like): Encoded labels
+
+        Returns:
+            np.ndarray: The labels
+        """
+        if self.column_transformer is None:
+            raise NotFittedError("{} is not fitted yet. Call fit before mapping labels".format(type(self).__name__))
+        y = np.asarray(y)
+        if not self.label_attrs:
+            return y
+        label_transformer = self.column_transformer.transformers_[-1][1]
+        if not hasattr(label_transformer, 'inverse_transform'):
+            return y
+        return np.asarray(label_transformer.inverse_transform(y))
 
     def _generate_pipeline(self):
         """
-        Generates a list of tuples of the form (name, preprocessor_class, [col_index])
+        Generates a list of tuples of the form (name, preprocessor, fhir_attr)
 
         Returns:
-            list: A list to be used in sklearn.compose.ColumnTransformer
+            list: A list to be used in preprocessing.FHIRColumnTransformer
         """
         pipeline = []
         for idx, fhir_attr in enumerate(self.feature_attrs + self.label_attrs):
             step_name = "{}_{}".format(idx, fhir_attr)
             step_class = self.transformers[fhir_attr]
-            pipeline.append((step_name, step_class, [idx]))
+            pipeline.append((step_name, step_class, fhir_attr))
         return pipeline
 
+    def save(self, path: str):
+        """
+        Saves the fitted model into a directory: the attributes and transformer classes as json, the
+        state of the fitted transformers and the estimator with joblib. Transformer classes are not
+        pickled, as they are generated by Preprocessing, but looked up by name on load.
+
+        Args:
+            path (str): Directory of the model, created if it does not exist
+        """
+        if self.column_transformer is None:
+            raise NotFittedError("{} is not fitted yet. Call fit before saving it".format(type(self).__name__))
+
+        os.makedirs(path, exist_ok=True)
+        model = {'class': type(self).__name__,
+                 'fhir_class': [self.fhir_class.__module__, self.fhir_class.__name__],
+                 'feature_attrs': self.feature_attrs,
+                 'label_attrs': self.label_attrs,
+                 'random_state': self.random_state,
+                 'transformers': [{'name': name, 'fhir_attr': fhir_attr, 'class': type(transformer).__name__}
+                                  for name, transformer, fhir_attr in self.column_transformer.transformers_]}
+        with open(os.path.join(path, self.model_file), 'w') as f:
+            json.dump(model, f)
+
+        joblib.dump([transformer.__dict__ for _, transformer, _ in self.column_transformer.transformers_],
+                    os.path.join(path, self.transformers_file))
+        joblib.dump(getattr(self, self._estimator_attr), os.path.join(path, self.estimator_file))
+
+    @classmethod
+    def load(cls, path: str, preprocessor: Preprocessing=None, mmap_mode: str='r'):
+        """
+        Loads a model saved with save. By default the arrays of the estimator (e.g. the trees of a
+        random forest) are memory mapped instead of being read into memory.
+
+        Args:
+            path (str): Directory of the model
+            preprocessor (Preprocessing): Preprocessor with the processor classes of the model, including
+                                          custom observation processors. Defaults to Preprocessing()
+            mmap_mode (str): Memory map mode of joblib.load, None to read the estimator into memory
+
+        Returns:
+            MLOnFHIR: The fitted model, an instance of the class it was saved from
+        """
+        with open(os.path.join(path, cls.model_file)) as f:
+            model = json.load(f)
+        preprocessor = preprocessor or Preprocessing()
+
+        model_class = getattr(sys.modules[__name__], model['class'])
+        fhir_class = getattr(import_module(model['fhir_class'][0]), model['fhir_class'][1])
+        ml = model_class(fhir_class, model['feature_attrs'], model['label_attrs'], model['random_state'], preprocessor)
+
+        # The fitted transformers are restored without calling their constructors
+        transformers = []
+        states = joblib.load(os.path.join(path, cls.transformers_file))
+        for transformer, state in zip(model['transformers'], states):
+            try:
+                transformer_class = getattr(preprocessor, transformer['class'])
+            except AttributeError:
+                raise AttributeError("The preprocessor has no processor {}. Register the observation processors of "
+                                     "the model before loading it.".format(transformer['class']))
+            fitted = transformer_class.__new__(transformer_class)
+            fitted.__dict__.update(state)
+            ml.transformers[transformer['fhir_attr']].set_params(**fitted.get_params())
+            transformers.append((transformer['name'], fitted, transformer['fhir_attr']))
+
+        ml.column_transformer = FHIRColumnTransformer(ml._generate_pipeline())
+        ml.column_transformer.transformers_ = transformers
+        setattr(ml, ml._estimator_attr, joblib.load(os.path.join(path, cls.estimator_file), mmap_mode=mmap_mode))
+        return ml
+
+
 class MLOnFHIRClassifier(MLOnFHIR, ClassifierMixin):
     """
     Classifier class that acts as the ClassifierMixin equivalent
@@ -186,33 +642,26 @@ class MLOnFHIRClassifier(MLOnFHIR, ClassifierMixin):
         transformers (dict): Dictionary that maps a fhir attribute to its respective transformer class 
                              (e.g preprocessing.PatientBirthdateProcessor)
     """
+    _estimator_attr = 'clf'
+
     def __init__(self, fhir_class: Union[Patient], feature_attrs: List[str], label_attrs: List[str], random_state: int = 42, preprocessor: Preprocessing=None):
         super().__init__(fhir_class, feature_attrs, label_attrs, random_state, preprocessor)
         
-    def fit(self, data: List[Union[Patient]], sklearn_clf: ClassifierMixin = RandomForestClassifier(), **fit_params):
+    def fit(self, data: Union[List[Union[Patient]], CohortFeatureStore], sklearn_clf: ClassifierMixin = RandomForestClassifier(), **fit_params):
         """
         Generates and executes the preprocessing and training pipeline.
         For each fhir attribute its respective preprocessor will be used
 
         Args:
-            data (list):    A list of fhir objects (e.g. Patient)
+            data (list):    A list of fhir objects (e.g. Patient) or a CohortFeatureStore
             sklearn_clf (BaseEstimator): Instance of a sklearn classifier
 
         Returns:
             (list, list, object): A tuple of complete data matrix, labels and trained clf
         """
 
-        # Get list of patients and their fhir attrs represented as list
-        logging.info("Extracting attributes from data set")
-        data_matrix = self._get_data_matrix(data)
-
-        # Generate feature and label preprocessing pipeline
-        pipeline = self._generate_pipeline()
-        ct = ColumnTransformer(pipeline)
-
-        logging.info("Preprocessing data")
         # Caution: The pipeline returns preprocessed features AND label
-        complete_data_matrix = ct.fit_transform(data_matrix)
+        complete_data_matrix = self._fit_transform(data)
         X = complete_data_matrix[:, :len(self.feature_attrs)]
         y = complete_data_matrix[:, len(self.feature_attrs):]
         y = column_or_1d(y)
@@ -233,9 +682,72 @@ class MLOnFHIRClassifier(MLOnFHIR, ClassifierMixin):
                      .format(self.train_eval['accuracy'], self.train_eval['f1_score']))
         return X, y, self.clf
 
+    def fit_stream(self, patients: Iterable[Patient], sklearn_clf: ClassifierMixin = None, chunk_size: int=1000,
+                   release: bool=False, **partial_fit_params):
+        """
+        Trains a classifier out of core: the patients are preprocessed and passed to partial_fit of the
+        classifier one chunk at a time. Only the current chunk is referenced, so for a generator of patients
+        (e.g. FHIRClient.iter_all_patients) peak memory depends on the chunk size instead of the cohort size.
+
+        Labels of a cohort (e.g. case) are only known to the Cohort. A list or a generator of patients
+        without such a label attribute raises a ValueError instead of being trained on a default label.
+
+        Args:
+            patients (Iterable[Patient]): A Cohort, a list or a generator of fhir objects (e.g. Patient)
+            sklearn_clf (ClassifierMixin): Instance of a sklearn classifier with partial_fit, defaults to SGDClassifier
+            chunk_size (int):   Number of patients per chunk
+            release (bool):     Whether processed chunks are released from the identity map of their client with
+                                their observations (see Patient.release). Only for patients that are not used
+                                afterwards, e.g. from a generator over a get_* result.
+            partial_fit_params: Further arguments of partial_fit, e.g. classes=[0, 1] which is required by most
+                                classifiers as the first chunk might not contain all classes
+
+        Returns:
+            object: The trained clf
+        """
+        self.clf = SGDClassifier() if sklearn_clf is None else sklearn_clf
+        return self._fit_stream(patients, self.clf, chunk_size, release, **partial_fit_params)
+
+    def partial_fit(self, data: List[Union[Patient]], sklearn_clf: ClassifierMixin = None, **partial_fit_params):
+        """
+        Continues the training of the classifier on one chunk of patients
+
+        Args:
+            data (list):    A chunk of fhir objects (e.g. Patient)
+            sklearn_clf (ClassifierMixin): Instance of a sklearn classifier with partial_fit, to replace the
+                                           classifier (e.g. on the first chunk)
+            partial_fit_params: Further arguments of partial_fit, e.g. classes
+
+        Returns:
+            MLOnFHIRClassifier: self
+        """
+        if sklearn_clf is not None:
+            self.clf = sklearn_clf
+        elif getattr(self, 'clf', None) is None:
+            raise ValueError("No classifier to train. Pass sklearn_clf to the first call of partial_fit")
+        self._partial_fit(data, self.clf, **partial_fit_params)
+        return self
+
     def predict(self, X):
         return self.clf.predict(X)
 
+    def predict_proba(self, X):
+        return self.clf.predict_proba(X)
+
+    def predict_proba_patients(self, patients: Iterable[Patient], chunk_size: int=1000, release: bool=False):
+        """
+        Predicts class probabilities of patients that were not part of the training data
+
+        Args:
+            patients (Iterable[Patient]): A list or a generator of fhir objects (e.g. Patient)
+            chunk_size (int): Number of patients that are preprocessed and predicted at once
+            release (bool): Whether the patients of a chunk are released once it is predicted (see predict_patients)
+
+        Returns:
+            np.ndarray: Class probabilities of every patient, one column per class of the classifier
+        """
+        return self._predict_patients(self.predict_proba, patients, chunk_size, release)
+
     def score(self, X, y):
         return self.clf.score(X, y)
 
@@ -345,32 +857,39 @@ class MLOnFHIRCluster(MLOnFHIR, ClusterMixin):
         transformers (dict): Dictionary that maps a fhir attribute to its respective transformer class 
                              (e.g preprocessing.PatientBirthdateProcessor)
     """
+    # Metrics that compare the clusters with the true labels
+    supervised_metrics = {'rand_index': m.adjusted_rand_score,
+                          'mutual_information': m.adjusted_mutual_info_score,
+                          'fowlkes_mallows_score': m.fowlkes_mallows_score}
+
+    # Label-agnostic metrics, the silhouette score is computed on a sample (see evaluate)
+    unsupervised_metrics = {'silhouette_score': m.silhouette_score,
+                            'calinski_harabasz_score': m.calinski_harabasz_score,
+                            'davies_bouldin_score': m.davies_bouldin_score}
+
+    _estimator_attr = 'cluster'
+
     def __init__(self, fhir_class: Union[Patient], feature_attrs: List[str], label_attrs: List[str]=[], random_state: int = 42, preprocessor: Preprocessing=None):
         super(MLOnFHIRCluster, self).__init__(fhir_class, feature_attrs, label_attrs, random_state, preprocessor)
         
-    def fit(self, data: List[Union[Patient]], sklearn_cluster: ClusterMixin = KMeans(), **fit_params):
+    def fit(self, data: Union[List[Union[Patient]], CohortFeatureStore], sklearn_cluster: ClusterMixin = KMeans(),
+            evaluate: bool=True, metrics: List[str]=None, sample_size: int=10000, **fit_params):
         """
         Generates and executes the preprocessing and training pipeline.
         For each fhir attribute its respective preprocessor will be used
 
         Args:
-            data (list):    A list of fhir objects (e.g. Patient)
+            data (list):    A list of fhir objects (e.g. Patient) or a CohortFeatureStore
             sklearn_cluster (ClusterMixin): Instance of a sklearn cluster
+            evaluate (bool): Whether the clustering is evaluated on the training data (see evaluate)
+            metrics (List[str]): Metrics of the evaluation, defaults to all available
+            sample_size (int): Number of samples on which the silhouette score is computed, None for all
 
         Returns:
             (list, list, object): A tuple of complete data matrix, labels and trained clf
         """
-        # Get list of patients and their fhir attrs represented as list
-        logging.info("Extracting attributes from data set")
-        data_matrix = self._get_data_matrix(data)
-
-        # Generate feature and label preprocessing pipeline
-        pipeline = self._generate_pipeline()
-        ct = ColumnTransformer(pipeline)
-
-        logging.info("Preprocessing data")
         # Caution: The pipeline returns preprocessed features AND label
-        complete_data_matrix = ct.fit_transform(data_matrix)
+        complete_data_matrix = self._fit_transform(data)
         X = complete_data_matrix[:, :len(self.feature_attrs)]
         if len(self.label_attrs) > 0:
             y = complete_data_matrix[:, len(self.feature_attrs):]
@@ -382,47 +901,119 @@ class MLOnFHIRCluster(MLOnFHIR, ClusterMixin):
         self.cluster = sklearn_cluster
         self.cluster.fit(X)
         logging.info("Clustering completed")
-        
+
         # Evaluation
-        self.train_eval = self.evaluate(X, y=y)
-        if y is not None:
-            logging.info("Adjusted Rand index : {}, mutual information : {}, silhouette score : {}"
-                         .format(self.train_eval['rand_index'], self.train_eval['mutual_information'], self.train_eval['silhouette_score']))
-        else:
-            logging.info("Silhouette score : {}"
-                         .format(self.train_eval['silhouette_score']))
+        self.train_eval = None
+        if evaluate:
+            self.train_eval = self.evaluate(X, y=y, metrics=metrics, sample_size=sample_size)
+            logging.info(", ".join("{} : {}".format(metric, value) for metric, value in self.train_eval.items()))
 
         return X, y, self.cluster
 
+    def fit_stream(self, patients: Iterable[Patient], sklearn_cluster: ClusterMixin = None, chunk_size: int=1000,
+                   release: bool=False, **partial_fit_params):
+        """
+        Clusters out of core: the patients are preprocessed and passed to partial_fit of the cluster one
+        chunk at a time. Only the current chunk is referenced, so for a generator of patients peak memory
+        depends on the chunk size instead of the cohort size.
+
+        Args:
+            patients (Iterable[Patient]): A list or a generator of fhir objects (e.g. Patient)
+            sklearn_cluster (ClusterMixin): Instance of a sklearn cluster with partial_fit, defaults to MiniBatchKMeans
+            chunk_size (int):   Number of patients per chunk
+            release (bool):     Whether processed chunks are released (see MLOnFHIRClassifier.fit_stream)
+            partial_fit_params: Further arguments of partial_fit
+
+        Returns:
+            object: The trained cluster
+        """
+        self.cluster = MiniBatchKMeans() if sklearn_cluster is None else sklearn_cluster
+        return self._fit_stream(patients, self.cluster, chunk_size, release, **partial_fit_params)
+
+    def partial_fit(self, data: List[Union[Patient]], sklearn_cluster: ClusterMixin = None, **partial_fit_params):
+        """
+        Continues the clustering on one chunk of patients
+
+        Args:
+            data (list):    A chunk of fhir objects (e.g. Patient)
+            sklearn_cluster (ClusterMixin): Instance of a sklearn cluster with partial_fit, to replace the
+                                            cluster (e.g. on the first chunk)
+            partial_fit_params: Further arguments of partial_fit
+
+        Returns:
+            MLOnFHIRCluster: self
+        """
+        if sklearn_cluster is not None:
+            self.cluster = sklearn_cluster
+        elif getattr(self, 'cluster', None) is None:
+            raise ValueError("No cluster to train. Pass sklearn_cluster to the first call of partial_fit")
+        self._partial_fit(data, self.cluster, **partial_fit_params)
+        return self
+
     def predict(self, X):
         return self.cluster.predict(X)
 
-    def evaluate(self, X, y=None):
+    def evaluate(self, X, y=None, metrics: List[str]=None, sample_size: int=10000):
         """
         Depending on the clustering task, evaluate the predictor and 
         store its performance.
 
+        The silhouette score is quadratic in the number of samples in time and memory, so it is
+        computed on a random sample of sample_size samples. All other metrics are linear.
+
         Args:
             X (array-like):               Test samples
             y (array-like, optional):     True labels
+            metrics (List[str]):          Metrics to compute (see supervised_metrics and unsupervised_metrics),
+                                          defaults to all metrics available with or without true labels
+            sample_size (int):            Number of samples of the silhouette score, None for all samples
             
         Returns:
             eval_dict: Dictionary containing evaluations
         """
+        if metrics is None:
+            metrics = (list(self.supervised_metrics) if y is not None else []) + list(self.unsupervised_metrics)
+        unknown = [metric for metric in metrics if metric not in self.supervised_metrics and metric not in self.unsupervised_metrics]
+        if unknown:
+            raise ValueError("Unknown metrics {}. Available are {}".format(
+                unknown, list(self.supervised_metrics) + list(self.unsupervised_metrics)))
+
         # Start by predicting clusters
         y_pred = self.predict(X)
-        
+        n_clusters = len(np.unique(y_pred))
+
         # Result dict
         eval_dict = dict()
-
-        # Check if ground truth is available:
-        if y is not None:
-            eval_dict['rand_index'] = m.adjusted_rand_score(y, y_pred)
-            eval_dict['mutual_information'] = m.adjusted_mutual_info_score(y, y_pred)
-            eval_dict['fowlkes_mallows_score'] = m.fowlkes_mallows_score(y, y_pred)
-            
-        # Compute label-agnostic metrics:
-        eval_dict['silhouette_score'] = m.silhouette_score(X, y_pred)
-        eval_dict['calinski_harabaz_score'] = m.calinski_harabaz_score(X, y_pred)
+        for metric in metrics:
+            if metric in self.supervised_metrics:
+                # Check if ground truth is available:
+                if y is None:
+                    raise ValueError("Metric {} requires true labels".format(metric))
+                eval_dict[metric] = self.supervised_metrics[metric](y, y_pred)
+            elif not 1 < n_clusters < len(X):
+                # Label-agnostic metrics are only defined for 2 to n_samples - 1 clusters
+                logging.warning("{} is not defined for {} clusters of {} samples".format(metric, n_clusters, len(X)))
+                eval_dict[metric] = np.nan
+            elif metric == 'silhouette_score':
+                eval_dict[metric] = self._sampled_silhouette_score(X, y_pred, sample_size)
+            else:
+                eval_dict[metric] = self.unsupervised_metrics[metric](X, y_pred)
 
         return eval_dict
+
+    def _sampled_silhouette_score(self, X, y_pred, sample_size: int=None):
+        """
+        Computes the silhouette score on a random sample of the samples (like sklearn's sample_size)
+
+        Returns:
+            float: The silhouette score, nan if the sample does not contain 2 to sample_size - 1 clusters
+        """
+        if sample_size is not None and sample_size < len(X):
+            indices = check_random_state(self.random_state).permutation(len(X))[:sample_size]
+            X, y_pred = np.asarray(X)[indices], np.asarray(y_pred)[indices]
+        n_clusters = len(np.unique(y_pred))
+        if not 1 < n_clusters < len(X):
+            logging.warning("silhouette_score is not defined for {} clusters of a sample of {} samples".format(
+                n_clusters, len(X)))
+            return np.nan
+        return m.silhouette_score(X, y_pred)
@@ -1,6 +1,6 @@
 from inspect import signature
 import datetime as dt
-from typing import Union, List, Type
+from typing import Union, List, Type, Iterable
 import logging
 import numpy as np
 import re
@@ -8,10 +8,11 @@ from importlib import import_module
 import types
 
 
+from fhir_objects.compact import peek
 from fhir_objects.patient import Patient
-from fhir_objects.fhir_resources import date_format
+from fhir_objects.observation_index import ObservationIndex, get_coding_key, parse_fhir_datetime
 
-from sklearn.base import BaseEstimator
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.preprocessing import LabelEncoder
 from sklearn.utils.validation import column_or_1d
 
@@ -29,6 +30,22 @@ class AbstractObservationProcessor(ABC, BaseEstimator):
     def transform(self, X, **transform_params):
         pass
 
+    # Observation attributes used by the processor (e.g. ['code', 'valueQuantity']), None for all elements.
+    # Choice attributes are requested from the server by their element (e.g. value for valueQuantity).
+    elements = None
+
+    # Codes of the observations used by the processor (e.g. [{'system': 'http://loinc.org', 'code': '39156-5'}]),
+    # None for all observations
+    codes = None
+
+    def transform_index(self, index: ObservationIndex, **transform_params):
+        """
+        Transforms the observations of a patient given as ObservationIndex. Processors that
+        look up observations by code should override this, by default transform is applied
+        to all observations.
+        """
+        return self.transform(index.observations, **transform_params)
+
     def fit(self, X, y=None, **fit_params):
         return self
 
@@ -36,6 +53,9 @@ class AbstractPatientProcessor(ABC, BaseEstimator):
     """
     Abstract class for PatientProcessors
     """
+    # NumPy dtype of the patient attribute the processor transforms (e.g. float or 'U10')
+    dtype = object
+
     def __init__(self):
         super().__init__()
 
@@ -64,9 +84,359 @@ def get_coding_condition(code_dict_list: list):
                     return all (code[k] == code_dict[k] for k in code_dict)
     return conditions
 
+def parse_fhir_dates(values):
+    """
+    Parses FHIR dates in bulk. Partial dates (e.g. 1970 or 1970-05) count from the first month or day,
+    the time of dateTimes is ignored.
+
+    Args:
+        values (array-like): FHIR dates as strings, None or empty strings for missing dates
+
+    Returns:
+        np.ndarray: datetime64[D] array, NaT for missing or invalid dates
+    """
+    values = np.asarray(values).ravel()
+    if values.dtype.kind == 'O':
+        values = np.where(np.equal(values, None), '', values)
+    values = np.ascontiguousarray(values.astype('U10'))
+
+    # The unicode code points of the first ten characters as digits, one row per character
+    chars = values.view(np.uint32).reshape(len(values), 10).T.astype(np.int32) - ord('0')
+    year = chars[0] * 1000 + chars[1] * 100 + chars[2] * 10 + chars[3]
+    has_month = chars[4] == ord('-') - ord('0')
+    month = np.where(has_month, chars[5] * 10 + chars[6], 1)
+    has_day = has_month & (chars[7] == ord('-') - ord('0'))
+    day = np.where(has_day, chars[8] * 10 + chars[9], 1)
+
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    dates = months.astype('datetime64[D]') + (day - 1)
+    days_in_month = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+
+    digits = (chars >= 0) & (chars <= 9)
+    valid = (digits[:4].all(axis=0) & (~has_month | (digits[5] & digits[6])) & (~has_day | (digits[8] & digits[9]))
+             & (month >= 1) & (month <= 12) & (day >= 1) & (day <= days_in_month))
+    dates[~valid] = np.datetime64('NaT')
+    return dates
+
+def calculate_age(birth_dates, reference_dates):
+    """
+    Calculates the age in completed years, i.e. the age increases on the birthday
+    (on March 1st in non-leap years for February 29th)
+
+    Args:
+        birth_dates (np.ndarray): datetime64[D] array of birth dates
+        reference_dates (np.ndarray): datetime64[D] date or array with one date per birth date
+
+    Returns:
+        np.ndarray: Float array of ages, nan if a date is missing
+    """
+    birth_dates = np.asarray(birth_dates, dtype='datetime64[D]')
+    reference_dates = np.asarray(reference_dates, dtype='datetime64[D]')
+
+    # Dates as yyyymmdd, so that the difference in completed years is an integer division
+    birth_year, birth_month, birth_day = _year_month_day(birth_dates)
+    reference_year, reference_month, reference_day = _year_month_day(reference_dates)
+    ages = ((reference_year * 10000 + reference_month * 100 + reference_day)
+            - (birth_year * 10000 + birth_month * 100 + birth_day)) // 10000
+
+    return np.where(np.isnat(birth_dates) | np.isnat(reference_dates), np.nan, ages)
+
+def _year_month_day(dates):
+    """
+    Converts datetime64[D] dates into year, month and day arrays with integer arithmetic
+    (http://howardhinnant.github.io/date_algorithms.html#civil_from_days), which is
+    considerably faster than casting to datetime64[Y] and datetime64[M]
+    """
+    z = dates.astype(np.int64) + 719468
+    era = np.floor_divide(z, 146097)
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = np.where(month_index < 10, month_index + 3, month_index - 9)
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+def _quantity_value(observation):
+    """
+    Returns:
+        float: The valueQuantity of an observation or nan if it has none
+    """
+    quantity = peek(observation, 'valueQuantity')
+    if quantity is not None and 'value' in quantity:
+        return float(quantity['value'])
+    return np.nan
+
+class CodedObservationProcessor(AbstractObservationProcessor):
+    """
+    Base class for ObservationProcessors that reduce the valueQuantity of all observations
+    with one of the codes in codes to a single value per patient. Processors of this class
+    are computed for a whole cohort at once by the ObservationFeatureEngine, unless they
+    override transform or transform_index.
+
+    Attributes:
+        codes (list): Dicts with system and code of the observations to be used
+                      (e.g. [{'system': 'http://loinc.org', 'code': '39156-5'}])
+        reduction (str): One of 'latest', 'earliest' (by effectiveDateTime), 'min', 'max', 'mean', 'count'
+        default_value (float): Value of patients without matching observations
+    """
+    codes = []
+    reduction = 'latest'
+    default_value = 0.0
+    elements = ['code', 'effectiveDateTime', 'valueQuantity']
+
+    reductions = ['latest', 'earliest', 'min', 'max', 'mean', 'count']
+
+    def transform(self, X, **transform_params):
+        return self._reduce(ObservationIndex(X))
+
+    def transform_index(self, index: ObservationIndex, **transform_params):
+        # Subclasses that only override transform are applied to all observations
+        if type(self).transform is not CodedObservationProcessor.transform:
+            return self.transform(index.observations, **transform_params)
+        return self._reduce(index)
+
+    @classmethod
+    def is_declarative(cls):
+        """
+        Returns:
+            bool: Whether the processor is defined by codes, reduction and default_value only, so that it
+                  can be computed from the observations of all patients at once
+        """
+        return (cls.transform is CodedObservationProcessor.transform
+                and cls.transform_index is CodedObservationProcessor.transform_index
+                and cls.reduction in CodedObservationProcessor.reductions)
+
+    def _reduce(self, index: ObservationIndex):
+        if self.reduction == 'latest':
+            observations = [index.latest(self.codes)]
+        elif self.reduction == 'earliest':
+            observations = [index.earliest(self.codes)]
+        else:
+            observations = index.get(self.codes)
+        observations = [o for o in observations if o is not None]
+        if len(observations) == 0:
+            return self.patient_attribute_name, self.default_value
+
+        if self.reduction == 'count':
+            return self.patient_attribute_name, float(len(observations))
+
+        values = [_quantity_value(o) for o in observations]
+        if self.reduction == 'min':
+            return self.patient_attribute_name, float(np.min(values))
+        if self.reduction == 'max':
+            return self.patient_attribute_name, float(np.max(values))
+        if self.reduction == 'mean':
+            return self.patient_attribute_name, float(np.mean(values))
+        return self.patient_attribute_name, values[0]
+
+class ObservationFeatureEngine:
+    """
+    Computes observation attributes for a whole cohort. The observations of all patients are
+    flattened once into arrays of patient index, code, effectiveDateTime and value, and every
+    declarative CodedObservationProcessor (see CodedObservationProcessor.is_declarative) is reduced
+    from these arrays with NumPy. Attributes of other observation processors are derived per patient
+    with transform_index.
+
+    Args:
+        preprocessor (Preprocessing): Preprocessor with the registered observation processors
+    """
+
+    def __init__(self, preprocessor):
+        self.preprocessor = preprocessor
+
+    def transform(self, patients: List[Patient], attrs: List[str]):
+        """
+        Args:
+            patients (List[Patient]): The cohort
+            attrs (List[str]): Observation attributes to be computed (e.g. bmiLatest)
+
+        Returns:
+            dict: Maps every attribute to an array with one value per patient
+        """
+        processors = {attr: self.preprocessor.get_observation_processor(attr)() for attr in attrs}
+        coded = {attr: processor for attr, processor in processors.items()
+                 if isinstance(processor, CodedObservationProcessor) and processor.is_declarative()}
+
+        columns = dict()
+        for attr in attrs:
+            if attr not in coded:
+                columns[attr] = np.array([processors[attr].transform_index(patient.observation_index)[1]
+                                          for patient in patients])
+        if coded:
+            columns.update(self._transform_coded(patients, coded))
+        return columns
+
+    def _transform_coded(self, patients: List[Patient], processors: dict):
+        # Index of every code needed by at least one processor
+        code_index = dict()
+        for processor in processors.values():
+            for code in processor.codes:
+                code_index.setdefault((code['system'], code['code']), len(code_index))
+
+        # Single pass over all observations of the cohort
+        patient_idx, code_idx, timestamps, values = [], [], [], []
+        for i, patient in enumerate(patients):
+            for observation in patient.observations:
+                c = code_index.get(get_coding_key(observation))
+                if c is None:
+                    continue
+                patient_idx.append(i)
+                code_idx.append(c)
+                timestamps.append(parse_fhir_datetime(getattr(observation, 'effectiveDateTime', None)))
+                values.append(_quantity_value(observation))
+
+        patient_idx = np.array(patient_idx, dtype=np.int64)
+        code_idx = np.array(code_idx, dtype=np.int64)
+        timestamps = np.array(timestamps, dtype='datetime64[us]')
+        values = np.array(values, dtype=float)
+        position = np.arange(len(values))
+
+        columns = dict()
+        n = len(patients)
+        for attr, processor in processors.items():
+            codes = [code_index[(code['system'], code['code'])] for code in processor.codes]
+            mask = np.isin(code_idx, codes)
+            p, t, v, pos = patient_idx[mask], timestamps[mask], values[mask], position[mask]
+
+            column = np.full(n, processor.default_value, dtype=float)
+            columns[attr] = column
+            if len(p) == 0:
+                continue
+
+            if processor.reduction == 'count':
+                counts = np.bincount(p, minlength=n)
+                column[counts > 0] = counts[counts > 0]
+            elif processor.reduction == 'mean':
+                counts = np.bincount(p, minlength=n)
+                sums = np.bincount(p, weights=v, minlength=n)
+                column[counts > 0] = sums[counts > 0] / counts[counts > 0]
+            elif processor.reduction in ['min', 'max']:
+                order = np.argsort(p, kind='stable')
+                starts = np.flatnonzero(np.r_[True, p[order][1:] != p[order][:-1]])
+                reduce = np.minimum if processor.reduction == 'min' else np.maximum
+                column[p[order][starts]] = reduce.reduceat(v[order], starts)
+            else:
+                # Sort by patient, effectiveDateTime and position, so that the first
+                # observation wins if several share the same effectiveDateTime
+                if processor.reduction == 'latest':
+                    order = np.lexsort((-pos, t, p))
+                    selected = np.r_[p[order][1:] != p[order][:-1], True]
+                else:
+                    order = np.lexsort((pos, t, p))
+                    selected = np.r_[True, p[order][1:] != p[order][:-1]]
+                column[p[order][selected]] = v[order][selected]
+        return columns
+
+class FHIRColumnTransformer(BaseEstimator, TransformerMixin):
+    """
+    Equivalent of sklearn.compose.ColumnTransformer for data matrices given as dict of typed
+    columns (see MLOnFHIR._get_data_matrix). Every transformer is applied to its column and
+    writes its result into one preallocated float matrix, so the columns are never combined
+    into an object array.
+
+    Args:
+        transformers (list): Tuples of the form (name, transformer, column name).
+                             Every transformer has to return a single column.
+
+    Attributes:
+        transformers_ (list): The fitted copies of the transformers
+    """
+
+    def __init__(self, transformers: list):
+        self.transformers = transformers
+
+    def fit(self, X: dict, y=None):
+        self.fit_transform(X, y)
+        return self
+
+    def fit_transform(self, X: dict, y=None, **fit_params):
+        self.transformers_ = [(name, clone(transformer), column) for name, transformer, column in self.transformers]
+        return self._transform(X, fit=True)
+
+    def partial_fit(self, X: dict, y=None):
+        self.partial_fit_transform(X, y)
+        return self
+
+    def partial_fit_transform(self, X: dict, y=None):
+        """
+        Fits the transformers incrementally on one chunk of rows and transforms it. Transformers with
+        partial_fit (e.g. FHIRLabelEncoder) are updated with every chunk, the others are fitted on the
+        first chunk only.
+
+        Args:
+            X (dict): Maps column names to arrays
+
+        Returns:
+            np.ndarray: One column per transformer
+        """
+        if not hasattr(self, 'transformers_'):
+            return self.fit_transform(X, y)
+        return self._transform(X, fit=False, partial=True)
+
+    def transform(self, X: dict, columns: list=None):
+        """
+        Transforms columns with the fitted transformers
+
+        Args:
+            X (dict): Maps column names to arrays
+            columns (list): Names of the columns to transform (e.g. only the features), defaults to all
+
+        Returns:
+            np.ndarray: One column per transformed column, in the order of the transformers
+        """
+        transformers = [transformer for transformer in self.transformers_ if columns is None or transformer[2] in columns]
+        return self._transform(X, fit=False, transformers=transformers)
+
+    def _transform(self, X: dict, fit: bool, transformers: list=None, partial: bool=False):
+        transformers = self.transformers_ if transformers is None else transformers
+        n_rows = len(X[transformers[0][2]]) if transformers else 0
+        result = np.empty((n_rows, len(transformers)), dtype=float)
+
+        for idx, (name, transformer, column) in enumerate(transformers):
+            # Transformers receive their column as (n_rows, 1) view
+            values = np.asarray(X[column]).reshape(-1, 1)
+            if fit:
+                transformer.fit(values)
+            elif partial and hasattr(transformer, 'partial_fit'):
+                transformer.partial_fit(values)
+            transformed = np.asarray(transformer.transform(values))
+            if transformed.size != n_rows:
+                raise ValueError("Transformer {} returned {} values for {} rows. Only transformers that return a "
+                                 "single column are supported.".format(name, transformed.size, n_rows))
+            result[:, idx] = transformed.reshape(-1)
+        return result
+
+def typed_column(values: Iterable, dtype, count: int):
+    """
+    Writes values into a new array of a given dtype. Missing values (None) become nan
+    in float columns, empty strings in string columns and False in bool columns.
+
+    Args:
+        values (Iterable): The values
+        dtype: NumPy dtype of the column (e.g. float or 'U10')
+        count (int): Number of values
+
+    Returns:
+        np.ndarray: The column
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.fromiter((np.nan if v is None else v for v in values), dtype=dtype, count=count)
+    if dtype.kind in 'biu':
+        return np.fromiter((False if v is None else v for v in values), dtype=dtype, count=count)
+
+    column = np.empty(count, dtype=dtype)
+    if dtype.kind in 'US':
+        column[:] = ['' if v is None else v for v in values]
+    else:
+        column[:] = list(values)
+    return column
+
 class Preprocessing:
     def __init__(self):
         self.registered_observation_processors = {}
+        self.registered_observation_attributes = {}
 
         # Register Patient Processor for available Observation Processors
         for attr in dir(self):
@@ -109,6 +479,7 @@ class Preprocessing:
                 "Name of patient processor will be {}".format(new_name))
             new_class = self.PatientProcessorFactory(new_name)
             self.register_patient_preprocessor(new_class)
+            self.registered_observation_attributes[tmp_obj.patient_attribute_name] = processor_class
 
 
     def register_patient_preprocessor(self, processor_class: BaseEstimator):
@@ -136,13 +507,64 @@ class Preprocessing:
         
         return self.registered_observation_processors.values()
 
+    def get_observation_elements(self):
+        """
+        Returns the observation elements needed by the registered observation processors.
+
+        Returns:
+            list: Names of the elements or None if a processor does not declare its elements
+        """
+        elements = []
+        for processor in self.get_observation_preprocessors():
+            if processor.elements is None:
+                return None
+            elements += processor.elements
+        return list(dict.fromkeys(elements))
+
+    def get_observation_codes(self):
+        """
+        Returns the codes of the observations needed by the registered observation processors.
+
+        Returns:
+            list: Dicts with system and code or None if a processor does not declare its codes
+        """
+        codes = dict()
+        for processor in self.get_observation_preprocessors():
+            if processor.codes is None:
+                return None
+            for code in processor.codes:
+                codes[(code['system'], code['code'])] = {'system': code['system'], 'code': code['code']}
+        return list(codes.values())
+
+    def get_observation_attributes(self):
+        """
+        Returns the names of the patient attributes derived by registered observation processors.
+
+        Returns:
+            list of str: Patient attribute names (e.g. bmiLatest)
+        """
+        return list(self.registered_observation_attributes.keys())
+
+    def get_observation_processor(self, patient_attribute_name: str):
+        """
+        Returns the observation processor that derives a given patient attribute.
+
+        Args:
+            patient_attribute_name (str): Name of the patient attribute (e.g. bmiLatest)
+
+        Returns:
+            AbstractObservationProcessor: The processor class or None if no processor derives the attribute
+        """
+        return self.registered_observation_attributes.get(patient_attribute_name)
+
     class PatientProcessorBaseClass(AbstractPatientProcessor):
         """
         Base class that is used for the generation of Patient Processors 
         """
+        dtype = float
 
         def transform(self, X, **transform_params):
-            return X.astype(float)
+            return np.asarray(X, dtype=float)
 
     def PatientProcessorFactory(self, class_name: str, base_class: Type[PatientProcessorBaseClass]=PatientProcessorBaseClass):
         """
@@ -163,11 +585,35 @@ class Preprocessing:
         """
 
         def transform(self, X, **transform_params):
-            return self.y
+            # Values that were not seen during fit are encoded as -1
+            X = column_or_1d(X)
+            classes = self.classes_
+            if len(classes) == 0:
+                return np.full((len(X), 1), -1)
+            # Classes added by partial_fit are not sorted
+            sorter = np.argsort(classes)
+            positions = np.minimum(np.searchsorted(classes, X, sorter=sorter), len(classes) - 1)
+            codes = sorter[positions]
+            return np.where(classes[codes] == X, codes, -1).reshape(-1, 1)
+
+        def inverse_transform(self, X):
+            # Maps codes (e.g. predictions of a classifier) back to the values
+            return self.classes_[column_or_1d(X).astype(int)]
 
         def fit(self, X, y=None, **fit_params):
-            le = LabelEncoder()
-            self.y = le.fit_transform(column_or_1d(X)).reshape(-1, 1)
+            self.classes_ = LabelEncoder().fit(column_or_1d(X)).classes_
+            return self
+
+        def partial_fit(self, X, y=None, **fit_params):
+            """
+            Adds the values of X that were not seen yet as new classes. Their codes follow the
+            codes of the known classes, so that values keep their code between chunks.
+            """
+            if not hasattr(self, 'classes_'):
+                return self.fit(X, y, **fit_params)
+            new_classes = np.setdiff1d(column_or_1d(X), self.classes_)
+            if len(new_classes):
+                self.classes_ = np.concatenate([self.classes_, new_classes])
             return self
 
 
@@ -175,6 +621,7 @@ class Preprocessing:
         """
         Encodes gender into integer values
         """
+        dtype = 'U16'
 
         def transform(self, X, **transform_params):
             return super().transform(X, **transform_params)
@@ -186,72 +633,91 @@ class Preprocessing:
     class PatientbirthDateProcessor(AbstractPatientProcessor):
         """
         Calculates the age to use birthdate as a feature
+
+        Args:
+            reference_date: Date at which the age is calculated (e.g. '2020-01-01' or a datetime.date)
+                            or an array with one date per patient (e.g. an index date). An array only
+                            applies to the patients the processor is fitted on, so it can not be used
+                            to transform other patients (e.g. with predict_patients).
+                            Defaults to the day on which the processor is fitted.
+            fill_value: Age of patients without a (valid) birthDate. Defaults to the median age of the
+                        patients the processor is fitted on, so that the feature has no missing values.
         """
 
+        # FHIR dates have at most 10 characters
+        dtype = 'U10'
+
+        def __init__(self, reference_date=None, fill_value=None):
+            super().__init__()
+            self.reference_date = reference_date
+            self.fill_value = fill_value
+
+        def fit(self, X, y=None, **fit_params):
+            if self.reference_date is None:
+                self.reference_date_ = np.datetime64(dt.date.today(), 'D')
+            elif isinstance(self.reference_date, (str, dt.date, np.datetime64)):
+                self.reference_date_ = parse_fhir_dates([str(np.datetime64(self.reference_date, 'D'))])[0]
+            else:
+                self.reference_date_ = parse_fhir_dates(self.reference_date)
+
+            if self.fill_value is not None:
+                self.fill_value_ = float(self.fill_value)
+            else:
+                ages = self._ages(X)
+                self.fill_value_ = float(np.median(ages[~np.isnan(ages)])) if not np.isnan(ages).all() else 0.0
+            return self
+
+        def _ages(self, X):
+            if np.ndim(self.reference_date_) and len(self.reference_date_) != len(X):
+                raise ValueError("The processor has a reference date for each of {} patients, but {} patients are "
+                                 "transformed. Use a single reference date to transform other patients."
+                                 .format(len(self.reference_date_), len(X)))
+            return calculate_age(parse_fhir_dates(X), self.reference_date_)
+
         def transform(self, X, **transform_params):
-            ages = []
-            for birthdate in X:
-                b_date = dt.datetime.strptime(birthdate[0], date_format)
-                ages.append([int(
-                                (dt.datetime.now().date() - b_date.date()).days / 365)])
-            return np.array(ages)
+            if not hasattr(self, 'reference_date_'):
+                self.fit(X)
+            ages = self._ages(X)
+            return np.where(np.isnan(ages), self.fill_value_, ages).reshape(-1, 1)
 
     class PatientcaseProcessor(AbstractPatientProcessor):
         """
         Encodes case/controls into binary values
         """
+        dtype = bool
 
         def transform(self, X, **transform_params):
             return X.astype(int)
 
-    class ObservationLatestBmiProcessor(AbstractObservationProcessor):
+        def inverse_transform(self, X):
+            return column_or_1d(X).astype(bool)
+
+    class ObservationLatestBmiProcessor(CodedObservationProcessor):
         """
         Class to transform the FHIR observation resource with loinc code 39156-5 (BMI)
         to be usable as patient feature.
         """
+        codes = [{'system': 'http://loinc.org', 'code': '39156-5'}]
+
         def __init__(self):
             super().__init__('bmiLatest')
-            
-        def transform(self, X, **transform_params):
-            conditions = get_coding_condition([{'system': 'http://loinc.org', 'code': '39156-5'}])
-            bmis = list(filter(conditions, X))
-            bmis = sorted(bmis, reverse=True)
-            if len(bmis) >= 1:
-                return self.patient_attribute_name, float(bmis[0].valueQuantity['value'])
-            else:
-                return self.patient_attribute_name, 0.0
 
-    class ObservationLatestWeightProcessor(AbstractObservationProcessor):
+    class ObservationLatestWeightProcessor(CodedObservationProcessor):
         """
         Class to transform the FHIR observation resource with loinc code 29463-7 (body weight)
         to be usable as patient feature.
         """
+        codes = [{'system': 'http://loinc.org', 'code': '29463-7'}]
+
         def __init__(self):
             super().__init__('weightLatest')
-            
-        def transform(self, X, **transform_params):
-            conditions = get_coding_condition([{'system': 'http://loinc.org', 'code': '29463-7'}])
-            weights = list(filter(conditions, X))
-            weights = sorted(weights, reverse=True)
-            if len(weights) >= 1:
-                return self.patient_attribute_name, float(weights[0].valueQuantity['value'])
-            else:
-                return self.patient_attribute_name, 0.0
 
-
-    class ObservationLatestHeightProcessor(AbstractObservationProcessor):
+    class ObservationLatestHeightProcessor(CodedObservationProcessor):
         """
         Class to transform the FHIR observation resource with loinc code 8302-2 (body height)
         to be usable as patient feature.
         """
+        codes = [{'system': 'http://loinc.org', 'code': '8302-2'}]
+
         def __init__(self):
             super().__init__('heightLatest')
-
-        def transform(self, X, **transform_params):
-            condition = get_coding_condition([{'system': 'http://loinc.org', 'code': '8302-2'}])
-            heights = list(filter(condition, X))
-            heights = sorted(heights, reverse=True)
-            if len(heights) >= 1:
-                return self.patient_attribute_name, float(heights[0].valueQuantity['value'])
-            else:
-                return self.patient_attribute_name, 0.0
\ No newline at end of file
@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class ResponseCache():
+    """
+    Persistent, SQLite backed cache for responses of a FHIR server.
+
+    Responses are stored by their normalized url. Within ttl seconds a stored response is
+    served without contacting the server. Afterwards it is revalidated with a conditional
+    request (If-None-Match/If-Modified-Since) and only re-downloaded if it changed.
+    If the stored responses exceed max_size bytes, the least recently used ones are evicted.
+
+    Args:
+        path (str): Path of the SQLite database file
+        ttl (float): Seconds a stored response is served without revalidation
+        max_size (int): Maximum number of bytes of stored response bodies
+    """
+
+    # Response headers that are stored along with the body. Date is the time of the server the response
+    # is valid for, which FHIRClient uses as high-water mark of searches (see FHIRClient.sync)
+    stored_headers = ['Content-Type', 'Date', 'ETag', 'Last-Modified']
+
+    def __init__(self, path: str, ttl: float=3600, max_size: int=2**30):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # The cache is used by the background page requests of the FHIRClient as well
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY, status_code INTEGER, headers TEXT, content BLOB,
+                size INTEGER, stored REAL, accessed REAL)""")
+
+    @staticmethod
+    def normalize_url(url: str):
+        """
+        Normalizes an url so that equivalent queries share a cache entry
+        (case of scheme and host, order of query parameters, empty parameters)
+
+        Returns:
+            str: The normalized url
+        """
+        parts = urlsplit(url)
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if v)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'),
+                           urlencode(query), ''))
+
+    def get(self, url: str, session: requests.Session=None):
+        """
+        Submits a GET request for an url unless a fresh response is stored
+
+        Args:
+            url (str): Url to be requested
+            session (requests.Session): Session to be used for query
+
+        Returns:
+            The requests.Response
+        """
+        key = self.normalize_url(url)
+        entry = self._load(key)
+        if entry is not None and time.time() - entry['stored'] < self.ttl:
+            return self._to_response(url, entry)
+
+        headers = dict()
+        if entry is not None:
+            if 'ETag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        r = (session or requests).get(url, headers=headers)
+
+        if r.status_code == requests.codes.not_modified and entry is not None:
+            # The stored body is still valid at the time of the revalidation
+            entry['headers'].update({h: r.headers[h] for h in self.stored_headers if h in r.headers})
+            self._revalidated(key, entry['headers'])
+            return self._to_response(url, entry)
+        if r.status_code == requests.codes.ok:
+            self._store(key, r)
+        return r
+
+    def clear(self):
+        """
+        Removes all stored responses
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses")
+
+    def _load(self, key: str):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status_code, headers, content, stored FROM responses WHERE url = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._touch(key)
+        return {'status_code': row[0], 'headers': CaseInsensitiveDict(json.loads(row[1])),
+                'content': row[2], 'stored': row[3]}
+
+    def _touch(self, key: str):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), key))
+
+    def _revalidated(self, key: str, headers: CaseInsensitiveDict):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE responses SET headers = ?, accessed = ?, stored = ? WHERE url = ?",
+                                     (json.dumps(dict(headers)), now, now, key))
+
+    def _store(self, key: str, response: requests.Response):
+        headers = {h: response.headers[h] for h in self.stored_headers if h in response.headers}
+        content = response.content
+        if len(content) > self.max_size:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (key, response.status_code, json.dumps(headers), content,
+                                      len(content), now, now))
+            self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used responses until the stored bodies fit into max_size
+        """
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in self._connection.execute(
+                "SELECT url, size FROM responses ORDER BY accessed").fetchall():
+            self._connection.execute("DELETE FROM responses WHERE url = ?", (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    @staticmethod
+    def _to_response(url: str, entry: dict):
+        response = requests.Response()
+        response.url = url
+        response.status_code = entry['status_code']
+        response.headers = entry['headers']
+        response._content = entry['content']
+        return response
@@ -0,0 +1,291 @@
+import argparse
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+
+import numpy as np
+
+from fhir_objects.patient import Patient
+from fhir_objects.observation import Observation
+from ml_on_fhir import MLOnFHIR
+
+
+def patients_from_bundle(bundle: dict):
+    """
+    Builds the patients of a FHIR bundle with the observations of the bundle that refer to them
+
+    Args:
+        bundle (dict): FHIR Bundle with Patient and Observation entries. Observations refer to their patient
+                       by Patient/<id> or by the fullUrl of its entry (e.g. urn:uuid:...)
+
+    Returns:
+        list: List of fhir_objects.Patient.patient with their observations
+    """
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+        raise ValueError("Expected a Bundle, got {}".format(
+            bundle.get('resourceType') if isinstance(bundle, dict) else type(bundle).__name__))
+    entries = bundle.get('entry', [])
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) and isinstance(entry.get('resource', {}), dict)
+                                                 for entry in entries):
+        raise ValueError("The entries of the Bundle must be objects with a resource object")
+
+    patients = []
+    observations = dict()
+    references = dict()
+    for entry in entries:
+        resource = entry.get('resource', {})
+        if resource.get('resourceType') == 'Patient':
+            patient = Patient(resource_dict=resource, observations=[])
+            patients.append(patient)
+            references['Patient/{}'.format(resource.get('id'))] = patient
+            if 'fullUrl' in entry:
+                references[entry['fullUrl']] = patient
+        elif resource.get('resourceType') == 'Observation':
+            subject = resource.get('subject')
+            reference = subject.get('reference') if isinstance(subject, dict) else None
+            observations.setdefault(reference, []).append(Observation(resource_dict=resource))
+
+    for reference, patient_observations in observations.items():
+        if reference in references:
+            references[reference].set_observations(references[reference].observations + patient_observations)
+    return patients
+
+
+def load_preprocessor(name: str):
+    """
+    Imports the preprocessor of a model, e.g. one with custom observation processors registered
+
+    Args:
+        name (str): module:attribute of a Preprocessing object or of a callable that returns one
+                    (e.g. my_processors:preprocessor or preprocessing:Preprocessing)
+
+    Returns:
+        Preprocessing: The preprocessor
+    """
+    module_name, _, attr = name.partition(':')
+    if not module_name or not attr:
+        raise ValueError("Expected module:attribute, got {}".format(name))
+    preprocessor = getattr(import_module(module_name), attr)
+    return preprocessor() if callable(preprocessor) else preprocessor
+
+
+class ScoringService():
+    """
+    Scores patients with a fitted model. Requests are collected into micro-batches by one worker
+    thread, so that concurrent requests are preprocessed and predicted together. A batch is scored
+    when it holds max_batch_size patients or when its first request has waited max_delay seconds.
+
+    Args:
+        model (MLOnFHIR): A fitted model, e.g. loaded with MLOnFHIR.load
+        max_batch_size (int): Maximum number of patients per batch
+        max_delay (float): Maximum time in seconds a request waits for other requests
+
+    Attributes:
+        stats (dict): Counters of the scored requests, patients and batches
+    """
+
+    def __init__(self, model: MLOnFHIR, max_batch_size: int=256, max_delay: float=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self.stats = {'requests': 0, 'patients': 0, 'batches': 0, 'errors': 0}
+        self._latencies = collections.deque(maxlen=10000)
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def score(self, patients: list):
+        """
+        Scores patients in the next micro-batch. Blocks until the batch is scored.
+
+        Args:
+            patients (list): List of fhir_objects.Patient.patient
+
+        Returns:
+            list: One dict per patient with its id, prediction and class probabilities (if supported),
+                  with the values of the label attribute (e.g. True and False for case)
+        """
+        start = time.perf_counter()
+        request = {'patients': patients, 'done': threading.Event(), 'result': None, 'error': None}
+        self._queue.put(request)
+        request['done'].wait()
+
+        with self._lock:
+            self.stats['requests'] += 1
+            if request['error'] is not None:
+                self.stats['errors'] += 1
+            self._latencies.append(time.perf_counter() - start)
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def get_stats(self):
+        """
+        Returns:
+            dict: The counters, the throughput in patients per second since the start of the service and
+                  the latency percentiles of the last 10000 requests in milliseconds
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            latencies = np.array(self._latencies) * 1000
+        elapsed = time.time() - self._started
+        stats['throughput'] = stats['patients'] / elapsed if elapsed > 0 else 0.0
+        stats['mean_batch_size'] = stats['patients'] / stats['batches'] if stats['batches'] else 0.0
+        for percentile in (50, 95, 99):
+            stats['latency_p{}_ms'.format(percentile)] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return stats
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        size = len(batch[0]['patients'])
+        deadline = time.perf_counter() + self.max_delay
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request['patients'])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self._predict([patient for request in batch for patient in request['patients']])
+                offset = 0
+                for request in batch:
+                    request['result'] = results[offset:offset + len(request['patients'])]
+                    offset += len(request['patients'])
+            except Exception:
+                # A request that can not be scored must not fail the other requests of its batch
+                for request in batch:
+                    try:
+                        request['result'] = self._predict(request['patients'])
+                    except Exception as e:
+                        logging.exception("Scoring failed")
+                        request['error'] = e
+
+            with self._lock:
+                self.stats['batches'] += 1
+                self.stats['patients'] += sum(len(request['patients']) for request in batch if request['error'] is None)
+            for request in batch:
+                request['done'].set()
+
+    def _predict(self, patients: list):
+        if not patients:
+            return []
+        estimator = getattr(self.model, self.model._estimator_attr)
+        if hasattr(estimator, 'predict_proba'):
+            probabilities = self.model.predict_proba_patients(patients, chunk_size=len(patients))
+            predictions = estimator.classes_[probabilities.argmax(axis=1)]
+        else:
+            probabilities = None
+            predictions = self.model.predict_patients(patients, chunk_size=len(patients))
+
+        # The estimator predicts the encoded labels, the scores have the values of the label attribute (e.g. True)
+        predictions = self.model.inverse_transform_labels(predictions).tolist()
+        if probabilities is not None:
+            classes = self.model.inverse_transform_labels(estimator.classes_).tolist()
+
+        results = []
+        for idx, patient in enumerate(patients):
+            result = {'patient': getattr(patient, 'id', None), 'prediction': predictions[idx]}
+            if probabilities is not None:
+                result['probabilities'] = dict(zip(classes, probabilities[idx].tolist()))
+            results.append(result)
+        return results
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /score with a FHIR Bundle of patients and their observations returns the scores of the
+    patients, GET /stats returns the latency and throughput of the service.
+    """
+    service = None
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+        try:
+            bundle = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            patients = patients_from_bundle(bundle)
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        try:
+            scores = self.service.score(patients)
+        except ValueError as e:
+            # Patients that can not be preprocessed or predicted (e.g. invalid values)
+            return self._send(422, {'error': str(e)})
+        except Exception:
+            # Errors of the service itself, logged by the worker
+            return self._send(500, {'error': 'Internal server error'})
+        self._send(200, {'scores': scores})
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+        self._send(200, self.service.get_stats())
+
+    def _send(self, status: int, body: dict):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class ScoringServer(ThreadingHTTPServer):
+    # Concurrent clients are expected, so more pending connections are accepted than by default
+    request_queue_size = 128
+
+
+def serve(service: ScoringService, host: str='127.0.0.1', port: int=8080):
+    """
+    Creates the HTTP server of a scoring service. Every connection is handled by its own thread.
+
+    Args:
+        service (ScoringService): The scoring service
+        host (str): Host name to listen on
+        port (int): Port to listen on, 0 for any free port
+
+    Returns:
+        ScoringServer: The server, call serve_forever to start it
+    """
+    handler = type('BoundScoringRequestHandler', (ScoringRequestHandler,), {'service': service})
+    return ScoringServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scores FHIR bundles with a model saved with MLOnFHIR.save")
+    parser.add_argument('model', help="Directory of the saved model")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-delay', type=float, default=0.005, help="Maximum wait for a batch in seconds")
+    parser.add_argument('--preprocessor', help="module:attribute of the preprocessor with the custom observation "
+                                               "processors of the model (a Preprocessing object or a callable)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    preprocessor = load_preprocessor(args.preprocessor) if args.preprocessor else None
+    model = MLOnFHIR.load(args.model, preprocessor=preprocessor)
+    server = serve(ScoringService(model, args.max_batch_size, args.max_delay), args.host, args.port)
+    logging.info("Scoring service listening on {}:{}".format(*server.server_address))
+    server.serve_forever()
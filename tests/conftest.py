@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the library are imported from src, like in the notebooks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fhir_server import StandInFHIRServer, populate
+
+
+@pytest.fixture
+def fhir_server():
+    server = populate(StandInFHIRServer()).start()
+    yield server
+    server.stop()
@@ -0,0 +1,424 @@
+"""
+Local stand-in for a FHIR STU3 server. It keeps resources in memory and answers the searches,
+histories and Bulk Data exports used by the clients, so that they can be tested without a real server.
+"""
+import datetime
+import email.utils
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import numpy as np
+
+# Choice elements of the resources, which are named <element><Type> in the json (e.g. valueQuantity)
+CHOICE_ELEMENTS = ['value', 'effective', 'performed', 'onset', 'deceased', 'abatement']
+
+BMI = {'system': 'http://loinc.org', 'code': '39156-5', 'display': 'Body Mass Index'}
+WEIGHT = {'system': 'http://loinc.org', 'code': '29463-7', 'display': 'Body Weight'}
+HEIGHT = {'system': 'http://loinc.org', 'code': '8302-2', 'display': 'Body Height'}
+HEART_RATE = {'system': 'http://loinc.org', 'code': '8867-4', 'display': 'Heart rate'}
+ABDOMINAL_PAIN = {'system': 'http://snomed.info/sct', 'code': '21522001', 'display': 'Abdominal pain'}
+HYPERTENSION = {'system': 'http://snomed.info/sct', 'code': '38341003', 'display': 'Hypertension'}
+COLONOSCOPY = {'system': 'http://snomed.info/sct', 'code': '73761001', 'display': 'Colonoscopy'}
+
+
+def base_element(name: str):
+    """
+    Returns:
+        str: The name of the element of a json property, e.g. value for valueQuantity
+    """
+    for element in CHOICE_ELEMENTS:
+        if name.startswith(element) and name[len(element):][:1].isupper():
+            return element
+    return name
+
+
+class StandInFHIRServer():
+    """
+    In-memory FHIR server on a free local port
+
+    Args:
+        page_size (int): Number of entries per page of searches without _count
+        export_polls (int): Number of status requests of a Bulk Data export that are answered with 202
+
+    Attributes:
+        url (str): Base url of the server
+        requests (list): Paths with query strings of all received requests
+        ndjson_files (dict): NDJSON files served under ndjson/<name>, each a list of lines
+        ndjson_sent (dict): Number of lines sent per NDJSON file
+        ndjson_errors (set): Names of NDJSON files that are answered with 500
+        operations (list): Operations declared for Observation in the capability statement, names (e.g. lastn)
+                           or declarations (e.g. {'name': 'lastn', 'definition': {'reference': ...}})
+        lastn (bool): Whether Observation/$lastn is answered, else it is answered with 404 even if declared
+        elements (bool): Whether _elements is supported, else searches with _elements are answered with 400
+        bundle_meta (bool): Whether search bundles contain meta.lastUpdated, else only the Date header has the time
+        etags (bool): Whether searches are answered with an ETag besides Last-Modified
+        not_modified (int): Number of conditional searches that were answered with 304
+    """
+
+    def __init__(self, page_size: int=10, export_polls: int=2):
+        self.page_size = page_size
+        self.export_polls = export_polls
+        self.operations = []
+        self.lastn = True
+        self.elements = True
+        self.bundle_meta = True
+        self.etags = True
+        self.not_modified = 0
+        self.resources = {'Patient': OrderedDict(), 'Condition': OrderedDict(), 'Observation': OrderedDict(),
+                          'Procedure': OrderedDict()}
+        self.history = []
+        self.requests = []
+        self.ndjson_files = dict()
+        self.ndjson_sent = dict()
+        self.ndjson_done = dict()
+        self.ndjson_errors = set()
+        self._export = None
+        self._now = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self._lock = threading.RLock()
+
+        handler = type('BoundStandInHandler', (StandInHandler,), {'server_state': self})
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self._httpd.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def now(self):
+        """
+        Returns:
+            str: The current time of the server as FHIR instant
+        """
+        return self._now.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def http_date(self, time: datetime.datetime=None):
+        """
+        Returns:
+            str: A time of the server (by default the current time) as HTTP date (e.g. for Date)
+        """
+        return email.utils.format_datetime(time or self._now, usegmt=True)
+
+    def last_modified(self, resource_type: str):
+        """
+        Returns:
+            datetime.datetime: Time of the last change of a resource of a type
+        """
+        with self._lock:
+            times = [time for entry_type, _, _, time in self.history if entry_type == resource_type]
+        return datetime.datetime.strptime(max(times), '%Y-%m-%dT%H:%M:%SZ').replace(
+            tzinfo=datetime.timezone.utc) if times else self._now
+
+    def count_requests(self, prefix: str):
+        """
+        Returns:
+            int: Number of received requests whose path starts with prefix (e.g. Observation?)
+        """
+        return len([request for request in self.requests if request.startswith(prefix)])
+
+    def put(self, resource: dict):
+        """
+        Creates or updates a resource. Every change advances the clock of the server by a second.
+        """
+        with self._lock:
+            self._now += datetime.timedelta(seconds=1)
+            resources = self.resources[resource['resourceType']]
+            previous = resources.get(resource['id'])
+            version = int(previous['meta']['versionId']) + 1 if previous else 1
+            resource = dict(resource, meta={'versionId': str(version), 'lastUpdated': self.now()})
+            resources[resource['id']] = resource
+            self.history.append((resource['resourceType'], resource['id'], resource, self.now()))
+            return resource
+
+    def delete(self, resource_type: str, resource_id: str):
+        with self._lock:
+            self._now += datetime.timedelta(seconds=1)
+            del self.resources[resource_type][resource_id]
+            self.history.append((resource_type, resource_id, None, self.now()))
+
+    def _matches(self, resource: dict, params: dict):
+        for param, value in params.items():
+            if param == '_id':
+                if resource['id'] not in value.split(','):
+                    return False
+            elif param == '_lastUpdated':
+                if not (value.startswith('gt') and resource['meta']['lastUpdated'] > value[2:]):
+                    return False
+            elif param == 'patient':
+                if resource.get('subject', {}).get('reference', '').split('/')[-1] not in value.split(','):
+                    return False
+            elif param == 'status':
+                if resource.get('status') not in value.split(','):
+                    return False
+            elif param == 'code':
+                codes = [tuple(code.split('|')) for code in value.split(',')]
+                if not any((coding.get('system'), coding.get('code')) in codes
+                           for coding in resource.get('code', {}).get('coding', [])):
+                    return False
+            elif param == 'code:text':
+                texts = [resource.get('code', {}).get('text', '')] + [
+                    coding.get('display', '') for coding in resource.get('code', {}).get('coding', [])]
+                if not any(value.lower() in text.lower() for text in texts):
+                    return False
+            elif param.startswith('_has:'):
+                _, resource_type, _, search_param = param.split(':', 3)
+                reference = 'Patient/' + resource['id']
+                if not any(other.get('subject', {}).get('reference') == reference
+                           and self._matches(other, {search_param: value})
+                           for other in self.resources[resource_type].values()):
+                    return False
+        return True
+
+    @staticmethod
+    def _project(resource: dict, elements: str):
+        if elements is None:
+            return resource
+        # Like a server that follows the specification, only elements are known (e.g. value, not valueQuantity)
+        names = set(elements.split(',')) | {'id', 'meta', 'resourceType'}
+        return {key: value for key, value in resource.items() if base_element(key) in names}
+
+    def search(self, resource_type: str, params: dict):
+        """
+        Returns:
+            list: The resources that match the search parameters
+        """
+        with self._lock:
+            search_params = {param: value for param, value in params.items()
+                             if param not in ['_count', '_elements', '_include', '_offset']}
+            return [resource for resource in self.resources[resource_type].values()
+                    if self._matches(resource, search_params)]
+
+    def _bundle(self, bundle_type: str, path: str, params: dict, entries: list):
+        """
+        Builds a page of a bundle with a next link if more entries follow
+        """
+        count = int(params.get('_count', self.page_size))
+        offset = int(params.get('_offset', 0))
+        bundle = {'resourceType': 'Bundle', 'type': bundle_type, 'total': len(entries),
+                  'entry': entries[offset:offset + count], 'link': []}
+        if self.bundle_meta:
+            bundle['meta'] = {'lastUpdated': self.now()}
+        if offset + count < len(entries):
+            next_params = dict(params, _offset=offset + count)
+            bundle['link'].append({'relation': 'next', 'url': '{}/{}?{}'.format(self.url, path, urlencode(next_params))})
+        return bundle
+
+    def search_bundle(self, resource_type: str, params: dict, path: str=None, resources: list=None):
+        """
+        Builds a page of a search. Patients added by _include are added to every page that refers to them.
+        """
+        resources = self.search(resource_type, params) if resources is None else resources
+        bundle = self._bundle('searchset', path or resource_type, params, resources)
+        page = bundle['entry']
+        bundle['entry'] = [{'resource': self._project(resource, params.get('_elements')), 'search': {'mode': 'match'}}
+                           for resource in page]
+        if params.get('_include'):
+            for resource in page:
+                patient_id = resource.get('subject', {}).get('reference', '').split('/')[-1]
+                if patient_id in self.resources['Patient']:
+                    bundle['entry'].append({'resource': self.resources['Patient'][patient_id],
+                                            'search': {'mode': 'include'}})
+        return bundle
+
+    def lastn_bundle(self, params: dict):
+        """
+        Builds a page of Observation/$lastn: the max latest observations of every patient and code
+        """
+        observations = self.search('Observation', {param: value for param, value in params.items() if param != 'max'})
+        groups = OrderedDict()
+        for observation in observations:
+            coding = observation['code']['coding'][0]
+            key = (observation['subject']['reference'], coding['system'], coding['code'])
+            groups.setdefault(key, []).append(observation)
+        latest = [observation for group in groups.values() for observation in
+                  sorted(group, key=lambda o: o['effectiveDateTime'], reverse=True)[:int(params.get('max', 1))]]
+        return self.search_bundle('Observation', params, 'Observation/$lastn', latest)
+
+    def history_bundle(self, resource_type: str, params: dict, resource_id: str=None):
+        """
+        Builds a page of the history of a resource type or of a resource, most recent versions first
+        """
+        with self._lock:
+            entries = []
+            for entry_type, entry_id, resource, time in reversed(self.history):
+                if entry_type != resource_type or (resource_id is not None and entry_id != resource_id):
+                    continue
+                if '_since' in params and time < params['_since']:
+                    continue
+                url = '{}/{}'.format(entry_type, entry_id)
+                if resource is None:
+                    entries.append({'request': {'method': 'DELETE', 'url': url}})
+                else:
+                    entries.append({'fullUrl': url, 'resource': resource, 'request': {'method': 'PUT', 'url': url}})
+        path = '{}/_history'.format(resource_type if resource_id is None else resource_type + '/' + resource_id)
+        return self._bundle('history', path, params, entries)
+
+    def start_export(self, resource_types: list):
+        with self._lock:
+            outputs = []
+            for resource_type in resource_types or list(self.resources):
+                name = '{}.ndjson'.format(resource_type)
+                self.ndjson_files[name] = [json.dumps(resource) for resource in self.resources[resource_type].values()]
+                outputs.append({'type': resource_type, 'url': '{}/ndjson/{}'.format(self.url, name)})
+            self._export = {'polls': self.export_polls, 'output': outputs}
+
+    def capability_statement(self):
+        return {'resourceType': 'CapabilityStatement', 'fhirVersion': '3.0.1',
+                'rest': [{'resource': [{'type': 'Observation',
+                                        'operation': [{'name': operation} if isinstance(operation, str) else operation
+                                                      for operation in self.operations]}]}]}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of StandInFHIRServer
+    """
+    server_state = None
+
+    def do_GET(self):
+        state = self.server_state
+        state.requests.append(self.path.lstrip('/'))
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        params = {param: values[0] for param, values in parse_qs(url.query).items()}
+
+        if parts == ['metadata']:
+            return self._send(200, state.capability_statement())
+        if parts == ['$export']:
+            if self.headers.get('Prefer') != 'respond-async':
+                return self._send(400, {'resourceType': 'OperationOutcome'})
+            state.start_export(params['_type'].split(',') if '_type' in params else None)
+            return self._send(202, None, {'Content-Location': state.url + '/export-status'})
+        if parts == ['export-status']:
+            if state._export['polls'] > 0:
+                state._export['polls'] -= 1
+                return self._send(202, None, {'Retry-After': '0', 'X-Progress': 'in progress'})
+            return self._send(200, {'transactionTime': state.now(), 'request': state.url + '/$export',
+                                    'output': state._export['output'], 'error': []})
+        if parts[0] == 'ndjson':
+            return self._send_ndjson(parts[1])
+
+        resource_type = parts[0]
+        if resource_type not in state.resources:
+            return self._send(404, {'resourceType': 'OperationOutcome'})
+        if parts[1:] == ['_history']:
+            return self._send(200, state.history_bundle(resource_type, params))
+        if len(parts) == 3 and parts[2] == '_history':
+            return self._send(200, state.history_bundle(resource_type, params, parts[1]))
+        if parts == ['Observation', '$lastn'] and state.lastn:
+            return self._send(200, state.lastn_bundle(params))
+        if '_elements' in params and not state.elements:
+            return self._send(400, {'resourceType': 'OperationOutcome'})
+        if len(parts) == 1:
+            return self._send_conditional(state.search_bundle(resource_type, params),
+                                          state.last_modified(resource_type))
+        return self._send(404, {'resourceType': 'OperationOutcome'})
+
+    def date_time_string(self, timestamp=None):
+        # The Date header follows the clock of the server
+        return self.server_state.http_date()
+
+    def _send_conditional(self, body: dict, last_modified: datetime.datetime):
+        """
+        Sends a search result with ETag and Last-Modified, or 304 if the client has it already
+        """
+        state = self.server_state
+        headers = {'Last-Modified': state.http_date(last_modified)}
+        if state.etags:
+            headers['ETag'] = 'W/"{}"'.format(hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest())
+
+        if 'If-None-Match' in self.headers and 'ETag' in headers:
+            modified = self.headers['If-None-Match'] != headers['ETag']
+        elif 'If-Modified-Since' in self.headers:
+            modified = last_modified > email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+        else:
+            modified = True
+        if not modified:
+            state.not_modified += 1
+            self.send_response(304)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            return self.end_headers()
+        return self._send(200, body, headers)
+
+    def _send(self, status: int, body, headers: dict=None):
+        content = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(content)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_ndjson(self, name: str):
+        state = self.server_state
+        if name in state.ndjson_errors or name not in state.ndjson_files:
+            return self._send(500 if name in state.ndjson_errors else 404, {'resourceType': 'OperationOutcome'})
+
+        done = state.ndjson_done.setdefault(name, threading.Event())
+        state.ndjson_sent[name] = 0
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/fhir+ndjson')
+        self.end_headers()
+        try:
+            for line in state.ndjson_files[name]:
+                self.wfile.write(line.encode() + b'\n')
+                state.ndjson_sent[name] += 1
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.close_connection = True
+            done.set()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def populate(server: StandInFHIRServer, n_patients: int=30, seed: int=0):
+    """
+    Adds patients with conditions, procedures and vital sign observations to a server.
+    Every third patient has abdominal pain, every fourth hypertension and every fifth a colonoscopy.
+    """
+    random_state = np.random.RandomState(seed)
+    for i in range(n_patients):
+        patient_id = 'p{}'.format(i)
+        server.put({'resourceType': 'Patient', 'id': patient_id, 'gender': ['male', 'female'][i % 2],
+                    'birthDate': '{}-{:02d}-{:02d}'.format(1940 + i, i % 12 + 1, i % 28 + 1),
+                    'name': [{'family': 'Doe', 'given': ['P{}'.format(i)]}]})
+        reference = {'reference': 'Patient/' + patient_id}
+
+        for j, (coding, modulo) in enumerate([(ABDOMINAL_PAIN, 3), (HYPERTENSION, 4)]):
+            if i % modulo == 0:
+                server.put({'resourceType': 'Condition', 'id': 'c{}-{}'.format(i, j), 'subject': reference,
+                            'code': {'coding': [coding], 'text': coding['display']},
+                            'onsetDateTime': '2015-0{}-01'.format(j + 1)})
+        if i % 5 == 0:
+            server.put({'resourceType': 'Procedure', 'id': 'pr{}'.format(i), 'subject': reference, 'status': 'completed',
+                        'code': {'coding': [COLONOSCOPY], 'text': COLONOSCOPY['display']},
+                        'performedDateTime': '2016-01-01'})
+
+        for j in range(i % 4 + 1):
+            for coding, low, high, unit in [(BMI, 18, 35, 'kg/m2'), (WEIGHT, 50, 110, 'kg'), (HEIGHT, 150, 200, 'cm'),
+                                            (HEART_RATE, 50, 100, '/min')]:
+                # Every fourth patient has no height measurements
+                if coding is HEIGHT and i % 4 == 3:
+                    continue
+                server.put({'resourceType': 'Observation', 'id': 'o{}-{}-{}'.format(i, coding['code'], j),
+                            'status': 'final', 'subject': reference, 'code': {'coding': [coding]},
+                            'effectiveDateTime': '201{}-0{}-15T10:00:00Z'.format(j, j + 1),
+                            'valueQuantity': {'value': round(float(random_state.uniform(low, high)), 1),
+                                              'unit': unit}})
+    return server
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from async_fhir_client import AsyncFHIRClient
+from fhir_client import FHIRClient
+from fhir_server import ABDOMINAL_PAIN, BMI, COLONOSCOPY, HYPERTENSION
+from preprocessing import ObservationFeatureEngine
+
+SEARCHES = [('get_patients_by_condition_text', ('Abdominal pain',)),
+            ('get_patients_by_condition_code', (HYPERTENSION['system'], HYPERTENSION['code'])),
+            ('get_patients_by_procedure_text', ('Colonoscopy',)),
+            ('get_patients_by_procedure_code', (COLONOSCOPY['system'], COLONOSCOPY['code']))]
+
+FEATURES = ['bmiLatest', 'weightLatest', 'heightLatest']
+
+
+def latest_bmi(server, patient_id):
+    observations = [o for o in server.resources['Observation'].values()
+                    if o['subject']['reference'] == 'Patient/' + patient_id and o['code']['coding'][0] == BMI]
+    return max(observations, key=lambda o: o['effectiveDateTime'])['valueQuantity']['value'] if observations else 0.0
+
+
+@pytest.mark.parametrize('method, args', SEARCHES)
+@pytest.mark.parametrize('controls', [False, True])
+def test_same_cohorts_as_sync_client(fhir_server, method, args, controls):
+    client = FHIRClient(fhir_server.url, chunk_size=4)
+    async_client = AsyncFHIRClient(fhir_server.url, chunk_size=4, max_concurrency=3)
+
+    cohort = getattr(client, method)(*args, controls=controls)
+    async_cohort = asyncio.run(getattr(async_client, method)(*args, controls=controls))
+
+    assert len(cohort) > 0
+    assert [patient.id for patient in async_cohort] == [patient.id for patient in cohort]
+    assert async_cohort.labels == cohort.labels
+    assert async_cohort.query == cohort.query
+    assert async_cohort.last_updated == cohort.last_updated
+    if controls:
+        assert set(cohort.labels['case'].values()) == {True, False}
+
+
+def test_same_observation_features_as_sync_client(fhir_server):
+    client = FHIRClient(fhir_server.url, chunk_size=4)
+    async_client = AsyncFHIRClient(fhir_server.url, chunk_size=4, max_concurrency=3)
+
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    client.load_observations(cohort)
+
+    async def load():
+        patients = await async_client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+        await async_client.load_observations(patients)
+        return patients
+
+    async_cohort = asyncio.run(load())
+    n_requests = len(fhir_server.requests)
+
+    columns = ObservationFeatureEngine(client.preprocessor).transform(cohort, FEATURES)
+    async_columns = ObservationFeatureEngine(async_client.preprocessor).transform(async_cohort, FEATURES)
+    for attr in FEATURES:
+        assert list(async_columns[attr]) == list(columns[attr])
+        assert [getattr(patient, attr) for patient in async_cohort] == list(columns[attr])
+    assert list(columns['bmiLatest']) == [latest_bmi(fhir_server, patient.id) for patient in cohort]
+
+    # All observations were loaded in bulk
+    assert len(fhir_server.requests) == n_requests
+
+
+def test_concurrent_requests_are_bounded(fhir_server):
+    async_client = AsyncFHIRClient(fhir_server.url, chunk_size=1, max_concurrency=2)
+    running = []
+    peak = []
+    get_url = async_client.client._get_url
+
+    def counting_get_url(url, session=None):
+        running.append(url)
+        peak.append(len(running))
+        try:
+            return get_url(url, session)
+        finally:
+            running.remove(url)
+
+    async_client.client._get_url = counting_get_url
+
+    async def load():
+        patients = await async_client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+        await async_client.load_observations(patients)
+        return patients
+
+    patients = asyncio.run(load())
+    assert len(patients) == 10
+    assert max(peak) == 2
+
+
+def test_blocking_methods_are_used_through_the_client(fhir_server):
+    async_client = AsyncFHIRClient(fhir_server.url, chunk_size=4)
+    assert not isinstance(async_client, FHIRClient)
+    assert not any(hasattr(async_client, method) for method in ['sync', 'iter_all_patients', 'get_bulk_export_patients'])
+
+    async def load():
+        async with async_client:
+            return await async_client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+
+    cohort = asyncio.run(load())
+    assert async_client._executor._shutdown
+
+    # The patients belong to the wrapped client, whose blocking methods still work after close
+    assert all(patient.fhir_client is async_client.client for patient in cohort)
+    assert async_client.client.sync(cohort) is cohort
+    assert all(patient.bmiLatest > 0 for patient in cohort)
@@ -0,0 +1,79 @@
+import json
+import time
+
+import pytest
+import requests
+
+from fhir_client import FHIRClient
+from fhir_objects.observation import Observation
+from fhir_objects.patient import Patient
+
+
+def test_bulk_export_polls_until_complete(fhir_server):
+    client = FHIRClient(fhir_server.url)
+
+    # The status is polled as soon as the server asks for it with Retry-After, instead of every poll_interval
+    start = time.time()
+    outputs = client.bulk_export(['Patient', 'Observation'], poll_interval=60)
+    assert time.time() - start < 10
+
+    assert fhir_server.count_requests('$export') == 1
+    assert fhir_server.count_requests('export-status') == fhir_server.export_polls + 1
+    assert [output['type'] for output in outputs] == ['Patient', 'Observation']
+
+
+def test_bulk_export_times_out(fhir_server):
+    fhir_server.export_polls = 1000
+    client = FHIRClient(fhir_server.url)
+    with pytest.raises(TimeoutError):
+        client.bulk_export(['Patient'], timeout=0.2)
+
+
+def test_iter_bulk_export_streams_all_resources(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    resources = list(client.iter_bulk_export(['Patient', 'Condition', 'Observation', 'Procedure'], max_workers=2))
+
+    for resource_type, resources_of_type in fhir_server.resources.items():
+        exported = [resource.id for resource in resources if type(resource).__name__ == resource_type]
+        assert sorted(exported) == sorted(resources_of_type)
+
+
+def test_get_bulk_export_patients_assigns_observations(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    patients = client.get_bulk_export_patients()
+    n_requests = len(fhir_server.requests)
+
+    assert len(patients) == len(fhir_server.resources['Patient'])
+    for patient in patients:
+        assert patient.observations_loaded
+        assert sorted(o.id for o in patient.observations) == sorted(
+            o['id'] for o in fhir_server.resources['Observation'].values()
+            if o['subject']['reference'] == 'Patient/' + patient.id)
+    assert all(isinstance(o, Observation) for patient in patients for o in patient.observations)
+
+    # The observations are not searched again
+    [patient.bmiLatest for patient in patients]
+    assert len(fhir_server.requests) == n_requests
+
+
+def test_iter_bulk_export_raises_errors_of_downloads(fhir_server):
+    fhir_server.ndjson_errors.add('Observation.ndjson')
+    client = FHIRClient(fhir_server.url)
+    with pytest.raises(requests.HTTPError):
+        list(client.iter_bulk_export(['Patient', 'Observation']))
+
+
+def test_closing_iter_bulk_export_stops_downloads(fhir_server):
+    n_lines = 200000
+    fhir_server.ndjson_files['large.ndjson'] = [json.dumps({'resourceType': 'Patient', 'id': 'p{}'.format(i)})
+                                               for i in range(n_lines)]
+    client = FHIRClient(fhir_server.url)
+    patients = client.iter_bulk_export(['Patient'], outputs=[{'type': 'Patient',
+                                                              'url': fhir_server.url + '/ndjson/large.ndjson'}])
+    first = [next(patients) for _ in range(10)]
+    patients.close()
+
+    assert all(isinstance(patient, Patient) for patient in first)
+    assert fhir_server.ndjson_done.get('large.ndjson') is not None
+    assert fhir_server.ndjson_done['large.ndjson'].wait(10)
+    assert fhir_server.ndjson_sent['large.ndjson'] < n_lines
@@ -0,0 +1,41 @@
+import json
+import os
+import pickle
+import sys
+
+from fhir_objects.compact import CompactObservation
+from fhir_objects.patient import Patient
+from preprocessing import ObservationFeatureEngine, Preprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import compact_memory
+
+
+def test_nested_values_are_parsed_once():
+    observation = CompactObservation(resource_dict=json.loads(compact_memory.observation_json(0)))
+    assert type(observation._code) is bytes
+    assert observation.code is observation.code
+    assert type(observation._code) is dict
+
+    observation.valueQuantity['value'] = 42.0
+    assert observation.valueQuantity['value'] == 42.0
+    assert pickle.loads(pickle.dumps(observation)).valueQuantity['value'] == 42.0
+
+
+def test_engine_keeps_values_compact():
+    observations = [CompactObservation(resource_dict=json.loads(compact_memory.observation_json(i))) for i in range(3)]
+    patient = Patient(resource_dict={'resourceType': 'Patient', 'id': '0'}, observations=observations)
+    columns = ObservationFeatureEngine(Preprocessing()).transform([patient], ['bmiLatest'])
+
+    assert list(columns['bmiLatest']) == [20.0]
+    assert all(type(observation._code) is bytes and type(observation._valueQuantity) is bytes
+               for observation in observations)
+
+
+def test_compact_observations_take_less_memory():
+    ratios = compact_memory.main(2000)
+    assert ratios[None] >= 3
+    assert ratios['engine'] >= 3
+    # Values read as attributes are kept parsed
+    assert 1.2 <= ratios['attributes'] < 2
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from sklearn.tree import DecisionTreeClassifier
+
+from feature_store import CohortFeatureStore
+from fhir_client import FHIRClient
+from fhir_objects.patient import Patient
+from fhir_server import ABDOMINAL_PAIN
+from ml_on_fhir import MLOnFHIRClassifier
+
+
+@pytest.fixture
+def client(fhir_server):
+    return FHIRClient(fhir_server.url, chunk_size=5)
+
+
+@pytest.fixture
+def cohort(client):
+    return client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+
+
+def test_store_keeps_all_labels_of_the_cohort(client, cohort, tmp_path):
+    cohort.set_label(cohort[0], 'site', 'A')
+    CohortFeatureStore.from_patients(cohort, preprocessor=client.preprocessor, chunk_size=7).save(str(tmp_path))
+    store = CohortFeatureStore.load(str(tmp_path))
+
+    assert {'id', 'case', 'matched_case', 'site', 'bmiLatest'} <= set(store.attrs)
+    assert store['case'].dtype == bool
+    for attr in ['case', 'matched_case']:
+        assert list(store[attr]) == [cohort.get_attribute(patient, attr) for patient in cohort]
+    assert list(store['site']) == ['A'] + [''] * (len(cohort) - 1)
+
+    ml = MLOnFHIRClassifier(Patient, feature_attrs=['gender', 'bmiLatest'], label_attrs=['case'],
+                            preprocessor=client.preprocessor)
+    _, y, _ = ml.fit(store, DecisionTreeClassifier())
+    _, y_cohort, _ = ml.fit(cohort, DecisionTreeClassifier())
+    assert np.array_equal(y, y_cohort)
+
+
+def test_store_of_a_list_has_no_labels(client, cohort):
+    store = CohortFeatureStore.from_patients(list(cohort), preprocessor=client.preprocessor)
+    assert 'case' not in store
+
+    ml = MLOnFHIRClassifier(Patient, feature_attrs=['gender'], label_attrs=['case'], preprocessor=client.preprocessor)
+    with pytest.raises(ValueError, match='no columns case'):
+        ml.fit(store, DecisionTreeClassifier())
@@ -0,0 +1,217 @@
+import pytest
+
+from fhir_client import FHIRClient
+from fhir_server import ABDOMINAL_PAIN, HEART_RATE, HYPERTENSION
+
+
+def test_include_results_are_constructed_once(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    fhir_server.put({'resourceType': 'Condition', 'id': 'c0-extra', 'subject': {'reference': 'Patient/p0'},
+                     'code': {'coding': [ABDOMINAL_PAIN], 'text': ABDOMINAL_PAIN['display']}})
+
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    assert [patient.id for patient in cohort].count('p0') == 1
+
+    # Later searches return the same objects
+    patients = client.get_all_patients()
+    assert next(patient for patient in patients if patient.id == 'p0') is cohort[0]
+    assert next(client.iter_patients_by_condition_code(ABDOMINAL_PAIN['system'], ABDOMINAL_PAIN['code'])) is cohort[0]
+
+
+def test_streamed_patients_are_not_mapped(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    assert len(list(client.iter_all_patients())) == len(fhir_server.resources['Patient'])
+    assert len(list(client.iter_patients_by_condition_text(ABDOMINAL_PAIN['display']))) == 10
+    assert len(list(client.iter_bulk_export(['Patient', 'Observation']))) > 0
+    assert len(client.identity_map) == 0
+
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    assert len(client.identity_map) == len(cohort)
+
+
+
+def test_closed_iterations_request_no_further_pages(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    patients = client.iter_all_patients()
+    next(patients)
+    patients.close()
+    assert fhir_server.count_requests('Patient') == 1
+
+    # The next page is requested while the rest of a page is consumed
+    patients = client.iter_all_patients()
+    for _ in range(11):
+        next(patients)
+    patients.close()
+    assert fhir_server.count_requests('Patient') == 3
+    assert len(list(client.iter_all_patients())) == len(fhir_server.resources['Patient'])
+
+
+def test_controls_are_sampled_if_elements_is_rejected(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    sample = client._sample_patient_ids(5, set())
+
+    fhir_server.elements = False
+    fhir_server.requests.clear()
+    client = FHIRClient(fhir_server.url)
+    assert client._sample_patient_ids(5, set()) == sample
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    assert list(cohort.labels['case'].values()).count(False) == 10
+    # _elements is not requested again after the server rejected it
+    assert len([request for request in fhir_server.requests if '_elements=id' in request]) == 1
+
+def test_elements_of_choice_attributes_are_requested_by_element(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    client.load_observations(cohort)
+
+    observation_search = next(request for request in fhir_server.requests if request.startswith('Observation?'))
+    assert '_elements=subject,effective,code,value&' in observation_search
+    assert all(hasattr(o, 'effectiveDateTime') and hasattr(o, 'valueQuantity')
+               for patient in cohort for o in patient.observations)
+
+    unprojected = FHIRClient(fhir_server.url, projection=False).get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    assert [patient.bmiLatest for patient in cohort] == [patient.bmiLatest for patient in unprojected]
+    assert all(patient.bmiLatest > 0 for patient in cohort)
+
+    observations = client.get_all_observations()
+    assert all(hasattr(o, 'effectiveDateTime') and hasattr(o, 'valueQuantity') for o in observations)
+    assert client._elements('Procedure') == ['identifier', 'subject', 'status', 'notDone', 'notDoneReason', 'category',
+                                             'code', 'performed', 'reasonCode', 'bodySite', 'outcome', 'report']
+
+
+def test_observations_are_retrieved_again_for_later_processors(fhir_server):
+    from preprocessing import AbstractObservationProcessor, CodedObservationProcessor
+
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    client.load_observations(cohort)
+    assert all(o.code['coding'][0]['code'] != HEART_RATE['code'] for patient in cohort for o in patient.observations)
+
+    class ObservationCountProcessor(AbstractObservationProcessor):
+        def __init__(self):
+            super().__init__('observationCount')
+
+        def transform(self, X, **transform_params):
+            return self.patient_attribute_name, float(len(X))
+
+    client.preprocessor.register_observation_processor(ObservationCountProcessor)
+    assert [patient.observationCount for patient in cohort] == [
+        float(len([o for o in fhir_server.resources['Observation'].values()
+                   if o['subject']['reference'] == 'Patient/' + patient.id])) for patient in cohort]
+    n_requests = fhir_server.count_requests('Observation?')
+
+    # All observations contain the observations of processors with codes
+    class ObservationMeanHeartRateProcessor(CodedObservationProcessor):
+        codes = [HEART_RATE]
+        reduction = 'mean'
+
+        def __init__(self):
+            super().__init__('heartRateMean')
+
+    client.preprocessor.register_observation_processor(ObservationMeanHeartRateProcessor)
+    assert all(patient.heartRateMean > 0 for patient in cohort)
+    assert fhir_server.count_requests('Observation?') == n_requests
+
+
+def condition(condition_id: str, patient_id: str, coding: dict):
+    return {'resourceType': 'Condition', 'id': condition_id, 'subject': {'reference': 'Patient/' + patient_id},
+            'code': {'coding': [coding], 'text': coding['display']}}
+
+
+def test_sync_applies_changes_of_searched_resources(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_patients_by_condition_code(HYPERTENSION['system'], HYPERTENSION['code'])
+    assert [patient.id for patient in cohort] == ['p{}'.format(i) for i in range(0, 30, 4)]
+
+    fhir_server.put(condition('c1-1', 'p1', HYPERTENSION))
+    fhir_server.put(condition('c4-1', 'p4', ABDOMINAL_PAIN))
+    fhir_server.delete('Condition', 'c8-1')
+    fhir_server.put(condition('c12-1', 'p12', HYPERTENSION))
+    fhir_server.requests.clear()
+    client.sync(cohort)
+
+    # The searched conditions are queried, not the patients with the condition
+    assert fhir_server.count_requests('Condition?code=') == 1
+    assert '_include=Condition:patient&_lastUpdated=gt' in fhir_server.requests[0]
+    assert fhir_server.count_requests('Condition?patient=') == 1
+    assert fhir_server.count_requests('Patient?') == 0
+    assert [patient.id for patient in cohort] == ['p0', 'p12', 'p16', 'p20', 'p24', 'p28', 'p1']
+
+    client.sync(cohort)
+    assert [patient.id for patient in cohort] == ['p0', 'p12', 'p16', 'p20', 'p24', 'p28', 'p1']
+
+
+def test_sync_relabels_cases_and_controls(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    control = next(patient for patient in cohort if not cohort.get_attribute(patient, 'case'))
+
+    fhir_server.put(condition('c-new', control.id, ABDOMINAL_PAIN))
+    fhir_server.delete('Condition', 'c3-0')
+    client.sync(cohort)
+
+    assert cohort.get_attribute(control, 'case') is True
+    assert cohort.get_attribute(control, 'matched_case') == control.id
+    assert [patient.id for patient in cohort].count(control.id) == 1
+    assert 'p3' not in [patient.id for patient in cohort]
+    assert all('p3' not in values for values in cohort.labels.values())
+
+
+def test_sync_requires_a_searched_cohort(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_control_patients(client.get_patients_by_condition_text(ABDOMINAL_PAIN['display']))
+    with pytest.raises(ValueError):
+        client.sync(cohort)
+
+
+LASTN_DECLARATIONS = [['lastn'],
+                      [{'name': 'last-n', 'definition': 'http://hl7.org/fhir/OperationDefinition/Observation-lastn'}],
+                      [{'name': 'last-n', 'definition': {'reference': 'OperationDefinition/Observation-lastn'}}]]
+
+
+@pytest.mark.parametrize('operations', LASTN_DECLARATIONS)
+def test_latest_observations_are_retrieved_with_lastn(fhir_server, operations):
+    expected = FHIRClient(fhir_server.url).get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    fhir_server.operations = operations
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    fhir_server.requests.clear()
+    client.load_observations(cohort)
+
+    assert fhir_server.count_requests('Observation/$lastn?') > 0
+    assert fhir_server.count_requests('Observation?') == 0
+    assert all(len(patient.observations) <= 4 for patient in cohort)
+    assert [patient.bmiLatest for patient in cohort] == [patient.bmiLatest for patient in expected]
+
+
+def test_declared_but_unsupported_lastn_falls_back_to_the_search(fhir_server):
+    fhir_server.operations = ['lastn']
+    fhir_server.lastn = False
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    client.load_observations(cohort)
+
+    assert fhir_server.count_requests('Observation/$lastn?') == 1
+    assert '_elements=' in [r for r in fhir_server.requests if r.startswith('Observation?')][-1]
+    assert not client._projection_rejected
+    assert all(patient.bmiLatest > 0 for patient in cohort)
+
+    # The operation is not requested again
+    client.load_observations(client.get_patients_by_condition_code(HYPERTENSION['system'], HYPERTENSION['code']))
+    assert fhir_server.count_requests('Observation/$lastn?') == 1
+
+
+def test_observations_of_a_cohort_are_loaded_in_bulk(fhir_server):
+    client = FHIRClient(fhir_server.url, chunk_size=4)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    fhir_server.requests.clear()
+    # Lazy access searches the observations of each patient separately
+    lazy = sum(len(patient.observations) for patient in cohort[:4])
+    assert len([request for request in fhir_server.requests if '_offset=' not in request]) == 4
+
+    fhir_server.requests.clear()
+    client.load_observations(cohort)
+    assert sum(len(patient.observations) for patient in cohort[:4]) == lazy
+    # One search (of possibly several pages) per chunk of the remaining patients
+    searches = [request for request in fhir_server.requests if '_offset=' not in request]
+    assert len(searches) == -(-(len(cohort) - 4) // 4)
@@ -0,0 +1,170 @@
+import random
+
+import numpy as np
+import pytest
+from sklearn.cluster import KMeans
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import silhouette_score
+from sklearn.tree import DecisionTreeClassifier
+
+from fhir_client import FHIRClient
+from fhir_objects.patient import Patient
+from fhir_server import ABDOMINAL_PAIN
+from ml_on_fhir import MLOnFHIRClassifier, MLOnFHIRCluster
+from preprocessing import Preprocessing
+
+
+@pytest.fixture
+def client(fhir_server):
+    return FHIRClient(fhir_server.url, chunk_size=5)
+
+
+@pytest.fixture
+def cohort(client):
+    return client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+
+
+def classifier(client):
+    return MLOnFHIRClassifier(Patient, feature_attrs=['birthDate', 'gender', 'bmiLatest'], label_attrs=['case'],
+                              preprocessor=client.preprocessor)
+
+
+@pytest.mark.parametrize('method', ['predict_patients', 'predict_proba_patients', 'fit_stream'])
+def test_streaming_keeps_the_patients_of_the_caller(fhir_server, client, cohort, method):
+    ml = classifier(client)
+    ml.fit(cohort, DecisionTreeClassifier())
+    if method == 'fit_stream':
+        getattr(ml, method)(cohort, SGDClassifier(), chunk_size=4, classes=[0, 1])
+        ml.fit(cohort, DecisionTreeClassifier())
+    else:
+        getattr(ml, method)(cohort, chunk_size=4)
+    n_requests = len(fhir_server.requests)
+
+    assert all(patient.observations_loaded for patient in cohort)
+    assert all(client.identity_map.get('Patient', patient.id) is patient for patient in cohort)
+    ml.fit(cohort, DecisionTreeClassifier())
+    assert len(fhir_server.requests) == n_requests
+    assert client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])[0] is cohort[0]
+
+
+def test_streaming_releases_patients_on_request(client, cohort):
+    ml = classifier(client)
+    ml.fit(cohort, DecisionTreeClassifier())
+    predictions = ml.predict_patients(iter(cohort), chunk_size=4, release=True)
+
+    assert len(predictions) == len(cohort)
+    assert not any(patient.observations_loaded for patient in cohort)
+    assert len(client.identity_map) == 0
+
+
+class RecordingSGDClassifier(SGDClassifier):
+    """
+    Records the labels of every chunk passed to partial_fit
+    """
+
+    def partial_fit(self, X, y, **kwargs):
+        self.seen_labels_ = getattr(self, 'seen_labels_', set()) | set(y)
+        return super().partial_fit(X, y, **kwargs)
+
+
+def test_fit_stream_on_streamed_patients(fhir_server, client, cohort):
+    ml = classifier(client)
+    estimator = ml.fit_stream(cohort, RecordingSGDClassifier(), chunk_size=7, classes=[0, 1])
+    assert estimator.seen_labels_ == {0, 1}
+    assert ml.predict_patients(client.iter_all_patients()).shape == (len(fhir_server.resources['Patient']),)
+    assert len(client.identity_map) == len(cohort)
+
+
+@pytest.mark.parametrize('stream', ['cohort', 'all_patients'])
+def test_fit_stream_requires_labels(client, cohort, stream):
+    patients = iter(cohort) if stream == 'cohort' else client.iter_all_patients()
+    with pytest.raises(ValueError, match='label case is missing'):
+        classifier(client).fit_stream(patients, SGDClassifier(), chunk_size=7, classes=[0, 1])
+
+
+def test_fit_uses_the_current_observation_processors(client, cohort):
+    ml = MLOnFHIRClassifier(Patient, feature_attrs=['bmiLatest'], label_attrs=['case'], preprocessor=client.preprocessor)
+    X, _, _ = ml.fit(cohort, DecisionTreeClassifier())
+    assert X[0, 0] == cohort[0].bmiLatest
+
+    class ObservationLatestBmiProcessor(client.preprocessor.ObservationLatestBmiProcessor):
+        reduction = 'count'
+
+    client.preprocessor.register_observation_processor(ObservationLatestBmiProcessor)
+    X, _, _ = ml.fit(cohort, DecisionTreeClassifier())
+    assert list(X[:, 0]) == [float(len([o for o in patient.observations if o.code['coding'][0]['code'] == '39156-5']))
+                             for patient in cohort]
+
+    # Changing the declaration of a processor also invalidates the memoized matrix
+    ObservationLatestBmiProcessor.reduction = 'max'
+    X, _, _ = ml.fit(cohort, DecisionTreeClassifier())
+    assert list(X[:, 0]) == [max(o.valueQuantity['value'] for o in patient.observations
+                                 if o.code['coding'][0]['code'] == '39156-5') for patient in cohort]
+
+
+def test_slices_of_a_cohort_keep_their_labels(client, cohort):
+    ml = classifier(client)
+    X, y, _ = ml.fit(cohort[:len(cohort)], DecisionTreeClassifier())
+    assert list(y) == [int(cohort.get_attribute(patient, 'case')) for patient in cohort]
+    assert set(y) == {0, 1}
+
+    head = cohort[:5]
+    assert head.labels['case'] == {patient.id: True for patient in head}
+    assert cohort.copy().labels == cohort.labels
+
+
+def test_labels_of_lists_of_cohort_patients_are_not_defaulted(client, cohort):
+    ml = classifier(client)
+    patients = list(cohort)
+    random.Random(0).shuffle(patients)
+    with pytest.raises(ValueError, match='label case is missing'):
+        ml.fit(patients, DecisionTreeClassifier())
+
+    # A shuffled slice of the cohort keeps them
+    shuffled = cohort[:]
+    random.Random(0).shuffle(shuffled)
+    _, y, _ = ml.fit(shuffled, DecisionTreeClassifier())
+    assert np.array_equal(y, [int(cohort.get_attribute(patient, 'case')) for patient in shuffled])
+
+
+class FixedClusters():
+    """
+    Cluster that assigns the last sample to its own cluster
+    """
+
+    def predict(self, X):
+        return (np.arange(len(X)) == len(X) - 1).astype(int)
+
+
+def test_cluster_evaluation(client, cohort):
+    ml = MLOnFHIRCluster(Patient, feature_attrs=['gender', 'bmiLatest'], preprocessor=client.preprocessor)
+    X, _, _ = ml.fit(cohort, KMeans(n_clusters=3, n_init=3, random_state=0), evaluate=False)
+    y = ml.predict(X)
+
+    assert set(ml.evaluate(X)) == set(MLOnFHIRCluster.unsupervised_metrics)
+    assert set(ml.evaluate(X, y)) == set(MLOnFHIRCluster.unsupervised_metrics) | set(MLOnFHIRCluster.supervised_metrics)
+    assert ml.evaluate(X, y, metrics=['rand_index']) == {'rand_index': 1.0}
+    with pytest.raises(ValueError):
+        ml.evaluate(X, metrics=['rand_index'])
+    with pytest.raises(ValueError):
+        ml.evaluate(X, metrics=['accuracy'])
+
+    # The silhouette score is computed on a sample like sklearn's sample_size
+    assert ml.evaluate(X, sample_size=None)['silhouette_score'] == pytest.approx(silhouette_score(X, y))
+    assert ml.evaluate(X, sample_size=12)['silhouette_score'] == pytest.approx(
+        silhouette_score(X, y, sample_size=12, random_state=ml.random_state))
+
+
+def test_cluster_evaluation_of_samples_with_one_cluster():
+    ml = MLOnFHIRCluster(Patient, feature_attrs=['gender'], preprocessor=Preprocessing())
+    ml.cluster = FixedClusters()
+    X = np.arange(100, dtype=float).reshape(-1, 1)
+
+    assert not np.isnan(ml.evaluate(X, sample_size=None)['silhouette_score'])
+    # Samples of 2 have either one cluster or as many clusters as samples
+    scores = ml.evaluate(X, sample_size=2)
+    assert np.isnan(scores['silhouette_score'])
+    assert not np.isnan(scores['calinski_harabasz_score'])
+
+    ml.cluster.predict = lambda X: np.zeros(len(X), dtype=int)
+    assert all(np.isnan(score) for score in ml.evaluate(X).values())
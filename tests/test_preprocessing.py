@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from fhir_client import FHIRClient
+from fhir_server import ABDOMINAL_PAIN, BMI
+from preprocessing import CodedObservationProcessor, ObservationFeatureEngine, Preprocessing, calculate_age, parse_fhir_dates
+
+
+class ObservationBmiMaxProcessor(CodedObservationProcessor):
+    codes = [BMI]
+    reduction = 'max'
+
+    def __init__(self):
+        super().__init__('bmiMax')
+
+
+class ObservationBmiRoundedProcessor(ObservationBmiMaxProcessor):
+    def transform_index(self, index, **transform_params):
+        return self.patient_attribute_name, float(np.round(self._reduce(index)[1]))
+
+    def __init__(self):
+        CodedObservationProcessor.__init__(self, 'bmiRounded')
+
+
+class ObservationBmiCountProcessor(ObservationBmiMaxProcessor):
+    def transform(self, X, **transform_params):
+        return self.patient_attribute_name, float(len([o for o in X if o.code['coding'][0]['code'] == BMI['code']]))
+
+    def __init__(self):
+        CodedObservationProcessor.__init__(self, 'bmiCount')
+
+
+@pytest.fixture
+def cohort(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    for processor in [ObservationBmiMaxProcessor, ObservationBmiRoundedProcessor, ObservationBmiCountProcessor]:
+        client.preprocessor.register_observation_processor(processor)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    client.load_observations(cohort)
+    return cohort
+
+
+def test_engine_uses_overridden_transforms(cohort):
+    attrs = ['bmiLatest', 'bmiMax', 'bmiRounded', 'bmiCount']
+    preprocessor = cohort[0].fhir_client.preprocessor
+    assert [preprocessor.get_observation_processor(attr).is_declarative() for attr in attrs] == [True, True, False, False]
+
+    columns = ObservationFeatureEngine(preprocessor).transform(cohort, attrs)
+    for attr in attrs:
+        assert list(columns[attr]) == [getattr(patient, attr) for patient in cohort]
+    assert list(columns['bmiRounded']) == list(np.round(columns['bmiMax']))
+    assert all(value >= 1 for value in columns['bmiCount'])
+
+
+def ages(birth_dates, reference_dates):
+    return list(calculate_age(parse_fhir_dates(birth_dates), parse_fhir_dates(reference_dates)))
+
+
+def test_age_increases_on_the_birthday():
+    assert ages(['1980-06-15'] * 3, ['2020-06-14', '2020-06-15', '2020-06-16']) == [39, 40, 40]
+    assert ages(['1980-12-31', '1981-01-01'], ['2020-12-31', '2020-12-31']) == [40, 39]
+    # Partial dates count from the first month or day
+    assert ages(['1980', '1980-06'], ['2019-12-31', '2020-05-31']) == [39, 39]
+
+
+def test_age_of_leap_day_births():
+    # The age increases on March 1st in non-leap years
+    assert ages(['2000-02-29'] * 4, ['2019-02-28', '2019-03-01', '2020-02-28', '2020-02-29']) == [18, 19, 19, 20]
+
+
+def test_age_of_missing_or_invalid_dates_is_nan():
+    assert all(np.isnan(ages([None, '', '1980-02-30', 'unknown'], ['2020-01-01'] * 4)))
+
+
+def test_birth_date_processor_imputes_missing_ages():
+    X = np.array(['1980-06-15', '1990-06-15', '2000-06-15', ''], dtype='U10').reshape(-1, 1)
+    processor = Preprocessing.PatientbirthDateProcessor(reference_date='2020-06-15')
+    assert list(processor.fit(X).transform(X).ravel()) == [40, 30, 20, 30]
+
+    processor = Preprocessing.PatientbirthDateProcessor(reference_date='2020-06-15', fill_value=-1)
+    assert list(processor.fit(X).transform(X).ravel()) == [40, 30, 20, -1]
+
+    # Without any birth dates the fill value is 0
+    empty = np.array([''] * 2, dtype='U10').reshape(-1, 1)
+    assert list(Preprocessing.PatientbirthDateProcessor().fit(empty).transform(empty).ravel()) == [0, 0]
+
+
+def test_birth_date_processor_reference_dates():
+    X = np.array(['1980-06-15', '1990-06-15'], dtype='U10').reshape(-1, 1)
+    processor = Preprocessing.PatientbirthDateProcessor(reference_date=['2020-06-14', '2020-06-15']).fit(X)
+    assert list(processor.transform(X).ravel()) == [39, 30]
+    with pytest.raises(ValueError):
+        processor.transform(X[:1])
+
+    processor = Preprocessing.PatientbirthDateProcessor(reference_date=np.datetime64('2000-06-15')).fit(X)
+    assert list(processor.transform(X).ravel()) == [20, 10]
@@ -0,0 +1,77 @@
+import pytest
+
+from fhir_client import FHIRClient
+from fhir_server import ABDOMINAL_PAIN
+from response_cache import ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path / 'responses.sqlite'))
+
+
+def test_fresh_responses_are_served_from_the_cache(fhir_server, cache):
+    url = fhir_server.url + '/Patient?gender=male&_count=5'
+    first = cache.get(url)
+    # Equivalent queries share the entry
+    second = cache.get(fhir_server.url + '/Patient?_count=5&gender=male&name=')
+
+    assert fhir_server.count_requests('Patient?') == 1
+    assert second.status_code == 200
+    assert second.json() == first.json()
+
+
+@pytest.mark.parametrize('etags', [True, False])
+def test_stale_responses_are_revalidated(fhir_server, cache, etags):
+    fhir_server.etags = etags
+    cache.ttl = 0
+    url = fhir_server.url + '/Condition?code:text=Hypertension'
+    first = cache.get(url)
+    second = cache.get(url)
+
+    # Revalidated with If-None-Match or, without ETag, with If-Modified-Since
+    assert fhir_server.count_requests('Condition?') == 2
+    assert fhir_server.not_modified == 1
+    assert second.json() == first.json()
+
+    fhir_server.put({'resourceType': 'Condition', 'id': 'c1-1', 'subject': {'reference': 'Patient/p1'},
+                     'code': {'coding': [], 'text': 'Hypertension'}})
+    assert cache.get(url).json()['total'] == first.json()['total'] + 1
+    assert fhir_server.not_modified == 1
+
+
+def test_least_recently_used_responses_are_evicted(fhir_server, cache):
+    urls = [fhir_server.url + '/Patient?_id=p{}'.format(i) for i in range(3)]
+    cache.max_size = len(cache.get(urls[0]).content) * 2 + 10
+    cache.get(urls[1])
+    cache.get(urls[0])
+    cache.get(urls[2])
+    fhir_server.requests.clear()
+
+    # urls[1] was used least recently
+    for url in [urls[0], urls[2], urls[1]]:
+        cache.get(url)
+    assert fhir_server.requests == ['Patient?_id=p1']
+
+
+def test_cached_searches_keep_the_time_of_the_server(fhir_server, cache):
+    fhir_server.bundle_meta = False
+    client = FHIRClient(fhir_server.url, cache=cache)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    assert cohort.last_updated == fhir_server.now()
+
+    fhir_server.put({'resourceType': 'Condition', 'id': 'c1-0', 'subject': {'reference': 'Patient/p1'},
+                     'code': {'coding': [ABDOMINAL_PAIN], 'text': ABDOMINAL_PAIN['display']}})
+    cached = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'])
+    assert cached.last_updated == cohort.last_updated
+
+    # The high-water mark of the cached search precedes the change, so sync finds it
+    client.sync(cached)
+    assert 'p1' in [patient.id for patient in cached]
+
+    # A revalidated search is valid at the time of the revalidation
+    cache.ttl = 0
+    last_updated = client.get_patients_by_condition_text('Hypertension').last_updated
+    fhir_server.put({'resourceType': 'Patient', 'id': 'p99'})
+    assert client.get_patients_by_condition_text('Hypertension').last_updated > last_updated
+    assert fhir_server.not_modified >= 1
@@ -0,0 +1,100 @@
+import threading
+
+import numpy as np
+import pytest
+import requests
+from sklearn.tree import DecisionTreeClassifier
+
+from fhir_client import FHIRClient
+from fhir_objects.patient import Patient
+from fhir_server import ABDOMINAL_PAIN, HEART_RATE
+from ml_on_fhir import MLOnFHIR, MLOnFHIRClassifier
+from preprocessing import CodedObservationProcessor, Preprocessing
+from scoring_service import ScoringService, load_preprocessor, serve
+
+
+class ObservationLatestHeartRateProcessor(CodedObservationProcessor):
+    codes = [{'system': HEART_RATE['system'], 'code': HEART_RATE['code']}]
+
+    def __init__(self):
+        super().__init__('heartRateLatest')
+
+
+def custom_preprocessor():
+    preprocessor = Preprocessing()
+    preprocessor.register_observation_processor(ObservationLatestHeartRateProcessor)
+    return preprocessor
+
+
+preprocessor = custom_preprocessor()
+
+
+def test_load_preprocessor():
+    assert load_preprocessor('test_scoring_service:preprocessor') is preprocessor
+    assert hasattr(load_preprocessor('test_scoring_service:custom_preprocessor'), 'ObservationLatestHeartRateProcessor')
+    assert isinstance(load_preprocessor('preprocessing:Preprocessing'), Preprocessing)
+    with pytest.raises(ValueError):
+        load_preprocessor('test_scoring_service')
+
+
+def test_model_with_custom_processors_is_loaded_with_the_preprocessor(fhir_server, tmp_path):
+    client = FHIRClient(fhir_server.url, preprocessor=custom_preprocessor())
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    ml = MLOnFHIRClassifier(Patient, feature_attrs=['gender', 'heartRateLatest'], label_attrs=['case'],
+                            preprocessor=client.preprocessor)
+    ml.fit(cohort, DecisionTreeClassifier())
+    ml.save(str(tmp_path))
+
+    with pytest.raises(AttributeError):
+        MLOnFHIR.load(str(tmp_path))
+    loaded = MLOnFHIR.load(str(tmp_path), preprocessor=load_preprocessor('test_scoring_service:custom_preprocessor'))
+    assert list(loaded.predict_patients(cohort)) == list(ml.predict_patients(cohort))
+
+
+@pytest.fixture
+def scoring_server(fhir_server):
+    client = FHIRClient(fhir_server.url)
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    ml = MLOnFHIRClassifier(Patient, feature_attrs=['gender', 'bmiLatest'], label_attrs=['case'],
+                            preprocessor=client.preprocessor)
+    ml.fit(cohort, DecisionTreeClassifier())
+    server = serve(ScoringService(ml, max_delay=0), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post_bundle(server, fhir_server):
+    entries = [{'resource': resource} for resource_type in ('Patient', 'Observation')
+               for resource in fhir_server.resources[resource_type].values()]
+    return requests.post('http://{}:{}/score'.format(*server.server_address),
+                         json={'resourceType': 'Bundle', 'entry': entries})
+
+
+def test_scores_have_the_values_of_the_label(fhir_server, scoring_server):
+    r = post_bundle(scoring_server, fhir_server)
+    assert r.status_code == 200
+    scores = r.json()['scores']
+    assert len(scores) == len(fhir_server.resources['Patient'])
+    assert {score['prediction'] for score in scores} <= {True, False}
+    assert all(set(score['probabilities']) == {'true', 'false'} for score in scores)
+
+
+def test_label_encoders_are_inverted():
+    processor = Preprocessing().PatientgenderProcessor().fit(np.array(['male', 'female']))
+    codes = processor.transform(np.array(['female', 'male', 'female']))
+    assert list(processor.inverse_transform(codes.astype(float))) == ['female', 'male', 'female']
+    assert list(Preprocessing().PatientcaseProcessor().inverse_transform(np.array([1.0, 0.0]))) == [True, False]
+
+
+@pytest.mark.parametrize('error, status_code', [(ValueError, 422), (RuntimeError, 500)])
+def test_only_scoring_errors_are_unprocessable(fhir_server, scoring_server, monkeypatch, error, status_code):
+    def predict_proba_patients(*args, **kwargs):
+        raise error("Scoring failed")
+
+    monkeypatch.setattr(scoring_server.RequestHandlerClass.service.model, 'predict_proba_patients',
+                        predict_proba_patients)
+    r = post_bundle(scoring_server, fhir_server)
+    assert r.status_code == status_code
+    assert ('Scoring failed' in r.json()['error']) == (status_code == 422)
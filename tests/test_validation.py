@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from sklearn.tree import DecisionTreeClassifier
+
+from feature_store import CohortFeatureStore
+from fhir_client import FHIRClient
+from fhir_objects.patient import Patient
+from fhir_server import ABDOMINAL_PAIN
+from ml_on_fhir import MLOnFHIRClassifier
+
+
+@pytest.fixture
+def client(fhir_server):
+    return FHIRClient(fhir_server.url, chunk_size=5)
+
+
+@pytest.fixture(params=['cohort', 'store'])
+def data(request, client):
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    if request.param == 'store':
+        return CohortFeatureStore.from_patients(cohort, preprocessor=client.preprocessor)
+    return cohort
+
+
+def classifier(client):
+    return MLOnFHIRClassifier(Patient, feature_attrs=['gender', 'bmiLatest'], label_attrs=['case'],
+                              preprocessor=client.preprocessor)
+
+
+def matched_cases(data):
+    if isinstance(data, CohortFeatureStore):
+        return np.asarray(data['matched_case'])
+    return np.array([data.get_attribute(patient, 'matched_case') for patient in data])
+
+
+def test_cross_validate_keeps_matched_patients_in_one_fold(client, data):
+    results = classifier(client).cross_validate(data, DecisionTreeClassifier(random_state=0), cv=4,
+                                                groups='matched_case', return_indices=True)
+    assert len(results['test_score']) == 4
+
+    groups = matched_cases(data)
+    for test in results['indices']['test']:
+        test_groups = set(groups[test])
+        assert all(group not in test_groups for group in np.delete(groups, test))
+    assert sorted(np.concatenate(results['indices']['test'])) == list(range(len(groups)))
+
+
+def test_cross_validate_without_groups(client, data):
+    results = classifier(client).cross_validate(data, DecisionTreeClassifier(random_state=0), cv=3)
+    assert len(results['test_score']) == 3
+
+
+@pytest.mark.parametrize('n_iter', [None, 2])
+def test_search(client, data, n_iter):
+    search = classifier(client).search(data, DecisionTreeClassifier(random_state=0), {'max_depth': [1, 2, 3]},
+                                       cv=3, groups='matched_case', n_iter=n_iter)
+    assert search.best_params_['max_depth'] in [1, 2, 3]
+    assert len(search.cv_results_['params']) == (3 if n_iter is None else 2)
+
+
+def test_groups_of_a_store_require_the_column(client):
+    cohort = client.get_patients_by_condition_text(ABDOMINAL_PAIN['display'], controls=True)
+    store = CohortFeatureStore.from_patients(cohort, attrs=['id', 'gender', 'case', 'bmiLatest'],
+                                             preprocessor=client.preprocessor)
+    with pytest.raises(ValueError, match='matched_case'):
+        classifier(client).cross_validate(store, DecisionTreeClassifier(), groups='matched_case')